@@ -0,0 +1,119 @@
+"""End-to-end latency benchmark: time to first match and per-stage breakdown of Shazam Forever, headless, with a file player as input and a local mock Shazam server"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Stage times recorded by the app, and the name of the stage ending at each
+STAGES = (('recorded', 'record'), ('signature', 'signature'), ('request', 'request'), ('shown', 'UI'))
+
+
+def breakdown(times):
+    """Seconds spent in each stage of one recognition"""
+    durations = {}
+    previous = times['capture']
+    for stage, name in STAGES:
+        if stage in times:
+            durations[name] = times[stage] - previous
+            previous = times[stage]
+    durations['total'] = times['shown'] - times['capture']
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure capture-to-display latency of Shazam Forever without a microphone')
+    parser.add_argument('files', nargs='+', help='Audio files to play, also catalogued by the mock server')
+    parser.add_argument('--fast', action='store_true', help='Play the files as fast as possible instead of in real time')
+    parser.add_argument('--recognitions', type=int, default=5, help='Recognitions to measure, one after the other')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='Latency of the mock server')
+    parser.add_argument('--timeout', type=float, default=300.0, help='Give up after this many seconds')
+    parser.add_argument('--json', help='Write the stage times of every recognition to this file')
+    args = parser.parse_args()
+
+    # The app writes its history, cache and archive under HOME; keep them out of the real one
+    os.environ['HOME'] = tempfile.mkdtemp(prefix='shazam-latency-')
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    sys.path.insert(0, REPO_DIR)
+
+    from custom_shazam_api import Shazam
+    from custom_shazam_api.loadtest import start_mock_server_thread
+    from custom_shazam_api.matcher import LocalMatcher
+    from custom_shazam_api.mock_server import MockShazamServer, add_files_to_catalogue
+    from custom_shazam_api.ratelimit import install_request_guard
+    from custom_shazam_api.sources import FilePlayerSource
+    server = MockShazamServer(add_files_to_catalogue(LocalMatcher(), args.files), latency_ms=args.latency_ms)
+    Shazam.api_url = start_mock_server_thread(server)
+
+    from PyQt6.QtWidgets import QApplication
+    from PyQt6.QtCore import QTimer
+    import shazam_forever
+
+    app = QApplication([])
+    window = shazam_forever.ShazamApp()
+    window.set_audio_source(FilePlayerSource(args.files, realtime=not args.fast))
+    # Recognitions follow each other much faster than the real request budget allows
+    window.request_guard_options.update(rate=1000.0, burst=1000)
+    window.request_guard = install_request_guard(**window.request_guard_options)
+
+    poll_timer = QTimer()
+    state = {'shown': 0, 'idle_since': None, 'deadline': time.monotonic() + args.timeout}
+
+    def start():
+        window.start_listening()
+        window.timer.stop()  # The next recognition starts as soon as the previous one is shown
+        poll_timer.start(10)
+
+    def poll():
+        shown = len(window.recognition_timings)
+        if shown >= args.recognitions or time.monotonic() > state['deadline']:
+            poll_timer.stop()
+            window.stop_listening()
+            app.quit()
+            return
+        # Windows skipped by the change gate never reach the UI: try again once the pipeline stays idle
+        idle = not window.recognition_pipeline.busy()
+        state['idle_since'] = (state['idle_since'] or time.monotonic()) if idle else None
+        if shown > state['shown'] or (idle and time.monotonic() - state['idle_since'] > 0.5):
+            state['shown'] = shown
+            state['idle_since'] = None
+            window.record_and_identify()
+
+    poll_timer.timeout.connect(poll)
+    QTimer.singleShot(0, start)
+    app.exec()
+
+    timings = list(window.recognition_timings)
+    if not timings:
+        print('No recognition was shown before the timeout')
+        sys.exit(1)
+
+    matched = sum(timing['matched'] for timing in timings)
+    first_match = window.first_match_seconds
+    print(f"{len(timings)} recognitions of {', '.join(os.path.basename(path) for path in args.files)} "
+          f"({'fast' if args.fast else 'real time'}), {matched} matched, server {server.stats}")
+    print(f"time to first match: {f'{first_match * 1000:.1f} ms' if first_match is not None else 'no match'}"
+          f" (includes starting the worker processes)")
+
+    durations = [breakdown(timing['times']) for timing in timings]
+    print('per stage (median / min / max):')
+    for name in [name for _, name in STAGES] + ['total']:
+        values = [duration[name] for duration in durations if name in duration]
+        print(f"  {name:10} {statistics.median(values) * 1000:8.1f} ms {min(values) * 1000:8.1f} ms "
+              f"{max(values) * 1000:8.1f} ms")
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({'time_to_first_match': first_match, 'server': server.stats,
+                       'recognitions': [dict(timing, stages=duration) for timing, duration in zip(timings, durations)]},
+                      json_file, indent=2)
+
+    sys.exit(0 if matched else 1)
+
+
+if __name__ == '__main__':
+    main()
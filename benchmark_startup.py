@@ -0,0 +1,101 @@
+"""Cold-start benchmark: import and first-window times of the library and the app, each in a fresh interpreter"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Each stage runs in a new process and prints {"name": seconds since it started}
+STAGES = {
+    'package': """
+import time; start = time.perf_counter()
+import custom_shazam_api
+print(json.dumps({'import': time.perf_counter() - start}))
+""",
+    'client': """
+import time; start = time.perf_counter()
+from custom_shazam_api import Shazam
+print(json.dumps({'import': time.perf_counter() - start}))
+""",
+    'app_modules': """
+import time; start = time.perf_counter()
+import custom_shazam_api.gate, custom_shazam_api.pool, custom_shazam_api.cache
+import custom_shazam_api.archive, custom_shazam_api.requery, custom_shazam_api.ratelimit
+print(json.dumps({'import': time.perf_counter() - start}))
+""",
+    'app': """
+import time; start = time.perf_counter()
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+from PyQt6.QtWidgets import QApplication
+from PyQt6.QtCore import QTimer
+import shazam_forever
+imported = time.perf_counter() - start
+app = QApplication([])
+window = shazam_forever.ShazamApp()
+window.show()
+app.processEvents()
+shown = time.perf_counter() - start
+QTimer.singleShot(0, app.quit)  # Queued after the deferred device enumeration
+app.exec()
+print(json.dumps({'import': imported, 'window_shown': shown, 'devices_listed': time.perf_counter() - start}))
+""",
+}
+
+
+def run_stage(code, env, import_time=False):
+    command = [sys.executable] + (['-X', 'importtime'] if import_time else []) + ['-c', 'import json, os\n' + code]
+    start = time.perf_counter()
+    completed = subprocess.run(command, cwd=REPO_DIR, env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'failed')
+    timings = json.loads(completed.stdout.strip().splitlines()[-1])
+    timings['process_wall'] = wall
+    return timings, completed.stderr
+
+
+def top_imports(importtime_output, count=15):
+    """Slowest imports by cumulative time, from -X importtime output"""
+    rows = []
+    for line in importtime_output.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit():
+                rows.append((int(cumulative), name.rstrip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure cold-start times of custom_shazam_api and Shazam Forever')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES))
+    parser.add_argument('--importtime', action='store_true', help='Also list the slowest imports of each stage')
+    args = parser.parse_args()
+
+    # The app writes its history, cache and archive under HOME; keep them out of the real one
+    env = dict(os.environ, HOME=tempfile.mkdtemp(prefix='shazam-startup-'), PYTHONPATH=REPO_DIR)
+
+    for stage in args.stages:
+        try:
+            runs = [run_stage(STAGES[stage], env)[0] for _ in range(args.runs)]
+        except RuntimeError as e:
+            print(f"{stage}: skipped ({e})")
+            continue
+
+        print(f"{stage} ({args.runs} runs, median / min):")
+        for metric in runs[0]:
+            values = [run[metric] for run in runs]
+            print(f"  {metric:16} {statistics.median(values) * 1000:8.1f} ms {min(values) * 1000:8.1f} ms")
+
+        if args.importtime:
+            for cumulative, name in top_imports(run_stage(STAGES[stage], env, import_time=True)[1]):
+                print(f"    {cumulative / 1000:8.1f} ms {name}")
+
+
+if __name__ == '__main__':
+    main()
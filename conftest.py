@@ -0,0 +1,2 @@
+# test_pyqt.py is a window to check PyQt6 by hand, not a test module
+collect_ignore = ['test_pyqt.py']
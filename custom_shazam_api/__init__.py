@@ -1 +1,9 @@
-from .api import Shazam
\ No newline at end of file
+# Submodules (and requests, soundfile, Numba...) are imported on first use,
+# so that importing the package, or one light submodule, stays fast
+
+
+def __getattr__(name):
+    if name == 'Shazam':
+        from .api import Shazam
+        return Shazam
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
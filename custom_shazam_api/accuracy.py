@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+"""
+    Accuracy of the float32 audio path (Shazam.float_dtype = np.float32)
+    against the float64 one, for the same audio files.
+
+    Both paths decode, downmix, resample and fingerprint the file; the
+    report gives how many int16 samples differ, how many peaks are
+    identical or within a bin of the float64 ones, whether a LocalMatcher
+    indexed with the float64 signature still matches the float32 excerpts,
+    and the memory used per second of audio.
+
+        python -m custom_shazam_api.accuracy song.flac other.wav
+"""
+from typing import List, Optional
+import time
+
+import numpy as np
+
+from .api import Shazam
+from .matcher import LocalMatcher
+from .signature_format import DecodedMessage
+from .spectrogram import SpectrogramSession, BINS, HOP
+
+
+def signature_peaks(signature : DecodedMessage) -> set:
+
+    return {
+        (band, peak.fft_pass_number, peak.corrected_peak_frequency_bin, peak.peak_magnitude)
+        for band, peaks in signature.frequency_band_to_sound_peaks.items()
+        for peak in peaks
+    }
+
+
+def compare_signatures(reference : DecodedMessage, candidate : DecodedMessage, bin_tolerance : int = 64) -> dict:
+
+    """
+        Compare the peaks of two signatures of the same audio. Peaks match
+        when they share band and FFT pass, with corrected frequency bins
+        (64 units per FFT bin) at most `bin_tolerance` apart.
+    """
+
+    reference_peaks = signature_peaks(reference)
+    candidate_peaks = signature_peaks(candidate)
+
+    by_position = {}
+    for band, fft_pass_number, frequency_bin, magnitude in candidate_peaks:
+        by_position.setdefault((band, fft_pass_number), []).append((frequency_bin, magnitude))
+
+    matched = 0
+    bin_errors = []
+    magnitude_errors = []
+
+    for band, fft_pass_number, frequency_bin, magnitude in reference_peaks:
+        candidates = [
+            (abs(other_bin - frequency_bin), abs(other_magnitude - magnitude))
+            for other_bin, other_magnitude in by_position.get((band, fft_pass_number), ())
+            if abs(other_bin - frequency_bin) <= bin_tolerance
+        ]
+        if candidates:
+            bin_error, magnitude_error = min(candidates)
+            matched += 1
+            bin_errors.append(bin_error)
+            magnitude_errors.append(magnitude_error)
+
+    return {
+        'reference_peaks': len(reference_peaks),
+        'candidate_peaks': len(candidate_peaks),
+        'identical_peaks': len(reference_peaks & candidate_peaks),
+        'matched_peaks': matched,
+        'recall': matched / len(reference_peaks) if reference_peaks else 1.,
+        'precision': matched / len(candidate_peaks) if candidate_peaks else 1.,
+        'max_bin_error': max(bin_errors, default = 0),
+        'max_magnitude_error': max(magnitude_errors, default = 0),
+    }
+
+
+def fingerprint(song_data : bytes, dtype) -> dict:
+
+    """Decode and fingerprint a file in the given precision, with timings and memory use"""
+
+    previous_dtype = Shazam.float_dtype
+    Shazam.float_dtype = dtype
+
+    try:
+        shazam = Shazam(song_data)
+
+        start = time.perf_counter()
+        audio = shazam.normalizateAudioData(song_data)
+        decode_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        session = SpectrogramSession(dtype)
+        session.feed(audio)
+        signature = session.signature()
+        session_seconds = time.perf_counter() - start
+
+        signature_generator = shazam.createSignatureGenerator(audio)
+        signature_generator.samples_processed = 0
+        excerpts = []
+        while True:
+            excerpt = signature_generator.get_next_signature()
+            if not excerpt:
+                break
+            excerpts.append(excerpt)
+
+    finally:
+        Shazam.float_dtype = previous_dtype
+
+    itemsize = np.dtype(dtype).itemsize
+
+    return {
+        'audio': audio,
+        'signature': signature,
+        'excerpts': excerpts,
+        'decode_seconds': decode_seconds,
+        'session_seconds': session_seconds,
+        # Float samples at 16 KHz (more before resampling), and power plus spread frames
+        'bytes_per_second': {
+            'samples': 16000 * itemsize,
+            'frames': 2 * (16000 // HOP) * BINS * itemsize,
+        },
+    }
+
+
+def float32_report(song_data : bytes) -> dict:
+
+    reference = fingerprint(song_data, np.float64)
+    candidate = fingerprint(song_data, np.float32)
+
+    matcher = LocalMatcher()
+    matcher.add_track({'key': 'reference'}, reference['signature'])
+
+    sample_differences = np.abs(reference['audio'].astype(np.int32) - candidate['audio'].astype(np.int32))
+
+    return {
+        'seconds': len(reference['audio']) / 16000,
+        'differing_samples': int(np.count_nonzero(sample_differences)),
+        'max_sample_difference': int(sample_differences.max(initial = 0)),
+        'signature': compare_signatures(reference['signature'], candidate['signature']),
+        'excerpts': [compare_signatures(*pair) for pair in zip(reference['excerpts'], candidate['excerpts'])],
+        'excerpts_matched': sum(
+            matcher.best_match(excerpt) is not None for excerpt in candidate['excerpts']
+        ),
+        'excerpts_matched_float64': sum(
+            matcher.best_match(excerpt) is not None for excerpt in reference['excerpts']
+        ),
+        'timings': {
+            'float64': {'decode': reference['decode_seconds'], 'session': reference['session_seconds']},
+            'float32': {'decode': candidate['decode_seconds'], 'session': candidate['session_seconds']},
+        },
+        'bytes_per_second': {'float64': reference['bytes_per_second'], 'float32': candidate['bytes_per_second']},
+    }
+
+
+def main(argv : Optional[List[str]] = None):
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Compare the float32 audio path with the float64 one')
+    parser.add_argument('audio', nargs = '+', help = 'Audio files (any format libsndfile reads)')
+    args = parser.parse_args(argv)
+
+    for path in args.audio:
+
+        with open(path, 'rb') as audio_file:
+            report = float32_report(audio_file.read())
+
+        signature = report['signature']
+
+        print('%s (%.1f s)' % (path, report['seconds']))
+        print('  int16 samples differing: %d (max %d)' % (report['differing_samples'], report['max_sample_difference']))
+        print('  whole-file peaks: %(identical_peaks)d identical, %(matched_peaks)d/%(reference_peaks)d within a bin '
+              '(recall %(recall).4f, precision %(precision).4f, max magnitude error %(max_magnitude_error)d)' % signature)
+        print('  excerpts matched by the float64 index: %d/%d float32, %d/%d float64' % (
+            report['excerpts_matched'], len(report['excerpts']),
+            report['excerpts_matched_float64'], len(report['excerpts'])))
+        for dtype in ('float64', 'float32'):
+            print('  %s: decode %.3f s, spectrogram %.3f s, %d KB/s of samples, %d KB/s of frames' % (
+                dtype, report['timings'][dtype]['decode'], report['timings'][dtype]['session'],
+                report['bytes_per_second'][dtype]['samples'] // 1024, report['bytes_per_second'][dtype]['frames'] // 1024))
+
+    return report
+
+
+if __name__ == '__main__':
+    main()
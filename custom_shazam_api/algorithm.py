@@ -4,12 +4,22 @@ from numpy import fft, array as nparray, maximum, log, hanning, mean, abs, round
 from typing import Dict, List, Set, Sequence, Union, Optional, Any
 from struct import pack, unpack
 from enum import IntEnum
+from contextlib import contextmanager
 from copy import copy
+import threading
+import numpy
+
+from .signature_format import DecodedMessage, FrequencyPeak, RawSignatureHeader, FrequencyBand
+from . import kernels
 
 HANNING_MATRIX = hanning(2050)[1:-1] # Wipe trailing and leading zeroes
 
+ZERO_SAMPLES = [0] * 2048 # Copied into the ring buffers when starting a new signature
+ZERO_SPREAD_FFT = [0] * 1025
 
-from .signature_format import DecodedMessage, FrequencyPeak, RawSignatureHeader, FrequencyBand
+MIN_DROPPED_SAMPLES = 16000 * 16 # Processed input is dropped in chunks of at least this many samples
+
+BANDS = (FrequencyBand._250_520, FrequencyBand._520_1450, FrequencyBand._1450_3500, FrequencyBand._3500_5500) # By kernel band index
 
 
 class RingBuffer(list):
@@ -25,6 +35,13 @@ class RingBuffer(list):
         self.buffer_size : int = buffer_size
         self.num_written : int = 0
     
+    def reset(self):
+        
+        # Values are left in place, for the owner to overwrite or zero them
+        
+        self.position = 0
+        self.num_written = 0
+    
     def append(self, value : Any):
         
         self[self.position] = value
@@ -33,6 +50,62 @@ class RingBuffer(list):
         self.position %= self.buffer_size
         self.num_written += 1
         
+class SignatureBudget:
+    
+    """
+        Size limits of the signatures of a SignatureGenerator, on top of its
+        MAX_TIME_SECONDS and MAX_PEAKS stop rule.
+        
+        By default a signature goes on until it is both MAX_TIME_SECONDS
+        long and MAX_PEAKS peaks large; with `stop_at_first_limit`, it ends
+        as soon as either is reached. Once finished, it is pruned to at most
+        `band_caps[band]` peaks in each band, then `max_total_peaks` overall,
+        keeping the strongest peaks (in their original order), so that dense
+        audio gives smaller payloads.
+    """
+    
+    def __init__(self, band_caps : Optional[Dict[FrequencyBand, int]] = None,
+                 max_total_peaks : Optional[int] = None, stop_at_first_limit : bool = False):
+        
+        self.band_caps : Dict[FrequencyBand, int] = dict(band_caps or {})
+        self.max_total_peaks : Optional[int] = max_total_peaks
+        self.stop_at_first_limit : bool = stop_at_first_limit
+    
+    def prune(self, signature : DecodedMessage) -> DecodedMessage:
+        
+        """Apply the peak caps to a signature in place, and return it"""
+        
+        peaks_by_band = signature.frequency_band_to_sound_peaks
+        
+        for band, cap in self.band_caps.items():
+            if len(peaks_by_band.get(band, ())) > cap:
+                peaks_by_band[band] = strongest_peaks(peaks_by_band[band], cap)
+        
+        if self.max_total_peaks is not None and sum(len(peaks) for peaks in peaks_by_band.values()) > self.max_total_peaks:
+            
+            kept = {id(peak) for peak in strongest_peaks(
+                [peak for peaks in peaks_by_band.values() for peak in peaks], self.max_total_peaks)}
+            
+            for band, peaks in list(peaks_by_band.items()):
+                peaks_by_band[band] = [peak for peak in peaks if id(peak) in kept]
+        
+        for band in [band for band, peaks in peaks_by_band.items() if not peaks]:
+            del peaks_by_band[band]
+        
+        return signature
+
+"""
+    The `count` peaks of highest magnitude (the earliest first on ties),
+    in their original order.
+"""
+
+def strongest_peaks(peaks : List[FrequencyPeak], count : int) -> List[FrequencyPeak]:
+    
+    ranked = sorted(range(len(peaks)), key = lambda index: (-peaks[index].peak_magnitude, index))
+    
+    return [peaks[index] for index in sorted(ranked[:max(count, 0)])]
+
+
 class SignatureGenerator:
     
     def __init__(self):
@@ -44,6 +117,12 @@ class SignatureGenerator:
         
         self.samples_processed : int = 0 # Number of samples processed out of "self.input_pending_processing"
         
+        self.input_offset : int = 0 # Number of processed samples since dropped from the start of "self.input_pending_processing"
+        
+        self.pending_array : Optional[numpy.ndarray] = None # Float copy of the above, for the compiled backend
+        
+        self.dtype = numpy.float64 # Or numpy.float32, for the samples, FFTs and ring buffers of the compiled backend
+        
         # Used when processing input:
         
         self.ring_buffer_of_samples : RingBuffer[int] = RingBuffer(buffer_size = 2048, default_value = 0)
@@ -51,12 +130,18 @@ class SignatureGenerator:
         self.fft_outputs : RingBuffer[List[float]] = RingBuffer(buffer_size = 256, default_value = [0. * 1025]) # Lists of 1025 floats, premultiplied with a Hanning function before being passed through FFT, computed from the ring buffer every new 128 samples
         
         self.spread_ffts_output : RingBuffer[List[float]] = RingBuffer(buffer_size = 256, default_value = [0] * 1025)
+        
+        self.compiled_buffers : Optional[Dict[str, numpy.ndarray]] = None # Ring buffers, state and peaks of the compiled backend, allocated on first use
 
         # How much data to send to Shazam at once?
 
         self.MAX_TIME_SECONDS = 3.1
         self.MAX_PEAKS = 255
         
+        self.budget : Optional[SignatureBudget] = None # Stop rule variant and peak caps, see SignatureBudget
+        
+        self.signature_peaks : int = 0 # Running count of the peaks of self.next_signature, before pruning
+        
         # The object that will hold information about the next fingerpring
         # to be produced
         
@@ -65,6 +150,52 @@ class SignatureGenerator:
         self.next_signature.number_samples = 0
         self.next_signature.frequency_band_to_sound_peaks = {}
     
+    """
+        Bring the generator back to its freshly constructed state (no
+        input, default settings) without reallocating its buffers, so that
+        one instance can be reused for many recordings (see
+        SignatureGeneratorPool).
+    """
+    
+    def reset(self):
+        
+        self.input_pending_processing.clear()
+        self.samples_processed = 0
+        self.input_offset = 0
+        self.pending_array = None
+        
+        self.dtype = numpy.float64
+        self.MAX_TIME_SECONDS = 3.1
+        self.MAX_PEAKS = 255
+        self.budget = None
+        
+        self.reset_signature_state()
+    
+    """
+        Start a new signature: zero the ring buffers in place. Only the
+        sample and spread buffers need it, FFT outputs are always written
+        before being read.
+    """
+    
+    def reset_signature_state(self):
+        
+        self.next_signature = DecodedMessage()
+        self.next_signature.sample_rate_hz = 16000
+        self.next_signature.number_samples = 0
+        self.next_signature.frequency_band_to_sound_peaks = {}
+        
+        self.signature_peaks = 0
+        
+        if self.ring_buffer_of_samples.num_written: # Left untouched by the compiled backend
+            
+            self.ring_buffer_of_samples[:] = ZERO_SAMPLES
+            self.ring_buffer_of_samples.reset()
+            self.fft_outputs.reset()
+            
+            for spread_fft in self.spread_ffts_output:
+                spread_fft[:] = ZERO_SPREAD_FFT
+            self.spread_ffts_output.reset()
+    
     """
         Add data to be generated a signature for, which will be
         processed when self.get_next_signature() is called. This
@@ -75,6 +206,22 @@ class SignatureGenerator:
         
         self.input_pending_processing += s16le_mono_samples
     
+    """
+        Whether the signature being generated should take more samples:
+        until it reaches both MAX_TIME_SECONDS and MAX_PEAKS, or either one
+        with SignatureBudget.stop_at_first_limit.
+    """
+    
+    def wants_more_input(self) -> bool:
+        
+        within_time = self.next_signature.number_samples / self.next_signature.sample_rate_hz < self.MAX_TIME_SECONDS
+        within_peaks = self.signature_peaks < self.MAX_PEAKS
+        
+        if self.budget is not None and self.budget.stop_at_first_limit:
+            return within_time and within_peaks
+        
+        return within_time or within_peaks
+    
     """
         Consume some of the samples fed to self.feed_input(), and return
         a Shazam signature (DecodedMessage object) to be sent to servers
@@ -86,32 +233,137 @@ class SignatureGenerator:
     
     def get_next_signature(self) -> Optional[DecodedMessage]:
         
-        if len(self.input_pending_processing) - self.samples_processed < 128:
+        if len(self.input_pending_processing) - (self.samples_processed - self.input_offset) < 128:
             return None
         
-        while (len(self.input_pending_processing) - self.samples_processed >= 128 and
-            (self.next_signature.number_samples / self.next_signature.sample_rate_hz < self.MAX_TIME_SECONDS or
-            sum(len(peaks) for peaks in self.next_signature.frequency_band_to_sound_peaks.values()) < self.MAX_PEAKS
-            )):
-            
-            self.process_input(self.input_pending_processing[self.samples_processed:self.samples_processed + 128])
+        if kernels.get_backend() != kernels.BACKEND_PYTHON and kernels.compiled_kernel() is not None:
             
-            self.samples_processed += 128
+            self.process_input_compiled()
+        
+        else:
+        
+            while (len(self.input_pending_processing) - (self.samples_processed - self.input_offset) >= 128 and
+                self.wants_more_input()):
+                
+                position = self.samples_processed - self.input_offset
+                self.process_input(self.input_pending_processing[position:position + 128])
+                
+                self.samples_processed += 128
 
         returned_signature = self.next_signature
-
-        self.next_signature = DecodedMessage()
-        self.next_signature.sample_rate_hz = 16000
-        self.next_signature.number_samples = 0
-        self.next_signature.frequency_band_to_sound_peaks = {}
         
-        self.ring_buffer_of_samples : RingBuffer[int] = RingBuffer(buffer_size = 2048, default_value = 0)
-        self.fft_outputs : RingBuffer[List[float]] = RingBuffer(buffer_size = 256, default_value = [0. * 1025])
-        self.spread_ffts_output : RingBuffer[List[float]] = RingBuffer(buffer_size = 256, default_value = [0] * 1025)
+        if self.budget is not None:
+            self.budget.prune(returned_signature)
+        
+        self.reset_signature_state()
+        self.drop_processed_input()
         
         return returned_signature
+    
+    """
+        Drop processed samples from the start of the input once they make up
+        most of it, so that an instance fed continuously doesn't grow without
+        bound. self.samples_processed keeps counting from the first sample.
+    """
+    
+    def drop_processed_input(self):
+        
+        processed = self.samples_processed - self.input_offset
+        
+        if processed >= MIN_DROPPED_SAMPLES and processed * 2 >= len(self.input_pending_processing):
+            
+            del self.input_pending_processing[:processed]
+            
+            if self.pending_array is not None:
+                self.pending_array = self.pending_array[processed:].copy()
+            
+            self.input_offset = self.samples_processed
 
     
+    """
+        Same as the loop of self.get_next_signature() over
+        self.process_input(), but with batched FFTs and the compiled
+        spreading/recognition kernel of kernels.py. The ring buffers live
+        in NumPy arrays allocated once per instance (and zeroed in place for
+        each signature), so the RingBuffer attributes are not updated along
+        the way.
+    """
+    
+    def process_input_compiled(self):
+        
+        # NumPy copy of the pending samples, refreshed when more were fed
+        
+        if (self.pending_array is None or len(self.pending_array) != len(self.input_pending_processing) or
+            self.pending_array.dtype != self.dtype):
+            self.pending_array = numpy.array(self.input_pending_processing, dtype = self.dtype)
+        
+        window = HANNING_MATRIX.astype(self.dtype, copy = False)
+        
+        if self.compiled_buffers is None or self.compiled_buffers['fft_ring'].dtype != self.dtype:
+            self.compiled_buffers = {
+                'state': numpy.zeros(4, dtype = numpy.int64),
+                'fft_ring': numpy.zeros((256, 1025), dtype = self.dtype), # Always written before being read
+                'spread_ring': numpy.zeros((256, 1025), dtype = self.dtype),
+                'peaks_out': numpy.empty((16 * kernels.MAX_PEAKS_PER_FRAME, 4), dtype = numpy.int64),
+            }
+        
+        state = self.compiled_buffers['state']
+        fft_ring = self.compiled_buffers['fft_ring']
+        spread_ring = self.compiled_buffers['spread_ring']
+        peaks_out = self.compiled_buffers['peaks_out']
+        
+        state.fill(0)
+        spread_ring.fill(0)
+        
+        history = numpy.zeros(2048 - 128, dtype = self.dtype) # The ring buffer of samples starts zeroed for each signature
+        process_frames = kernels.compiled_kernel()
+        stopped = False
+        
+        while not stopped and len(self.pending_array) - (self.samples_processed - self.input_offset) >= 128:
+            
+            position = self.samples_processed - self.input_offset
+            
+            # FFT about as many frames as the signature still needs, then smaller batches
+            # if it goes on to reach MAX_PEAKS
+            
+            frames_wanted = -int(-(self.MAX_TIME_SECONDS * 16000 - state[kernels.NUMBER_SAMPLES]) // 128)
+            batch_frames = min(max(frames_wanted, 32), 512, (len(self.pending_array) - position) // 128)
+            excerpts = numpy.concatenate((history, self.pending_array[position:position + batch_frames * 128]))
+            
+            fft_results = fft.rfft(window * numpy.lib.stride_tricks.sliding_window_view(excerpts, 2048)[::128], axis = 1)
+            
+            frames_done = 0
+            
+            while frames_done < batch_frames:
+                
+                consumed, written = process_frames(
+                    fft_results[frames_done:], fft_ring, spread_ring, state, float(self.MAX_TIME_SECONDS), self.MAX_PEAKS,
+                    self.budget is not None and self.budget.stop_at_first_limit,
+                    peaks_out, kernels.OTHER_OFFSETS, kernels.NEIGHBOR_OFFSETS
+                )
+                
+                for fft_number, magnitude, corrected_bin, band in peaks_out[:written].tolist():
+                    self.next_signature.frequency_band_to_sound_peaks.setdefault(BANDS[band], []).append(
+                        FrequencyPeak(fft_number, magnitude, corrected_bin, 16000)
+                    )
+                
+                frames_done += consumed
+                
+                self.next_signature.number_samples = int(state[kernels.NUMBER_SAMPLES])
+                self.signature_peaks = int(state[kernels.SIGNATURE_PEAKS])
+                
+                # Stopped early either because peaks_out is full, or because
+                # the stop condition of get_next_signature() was met
+                
+                if frames_done < batch_frames and not self.wants_more_input():
+                    stopped = True
+                    break
+            
+            history = excerpts[frames_done * 128:frames_done * 128 + 2048 - 128]
+            self.samples_processed += frames_done * 128
+        
+        self.next_signature.number_samples = int(state[kernels.NUMBER_SAMPLES])
+    
     def process_input(self, s16le_mono_samples : List[int]):
     
         self.next_signature.number_samples += len(s16le_mono_samples)
@@ -262,3 +514,54 @@ class SignatureGenerator:
                             FrequencyPeak(fft_number, int(peak_magnitude), int(corrected_peak_frequency_bin), 16000)
                         )
                         
+                        self.signature_peaks += 1
+                        
+
+
+class SignatureGeneratorPool:
+    
+    """
+        Idle SignatureGenerator instances, reset and kept for the next
+        recording so that long-running listeners and worker processes don't
+        rebuild their buffers each time. Thread-safe; at most `max_idle`
+        instances are kept.
+    """
+    
+    def __init__(self, max_idle : int = 4):
+        
+        self.max_idle : int = max_idle
+        self.idle : List[SignatureGenerator] = []
+        self.lock = threading.Lock()
+    
+    def acquire(self) -> SignatureGenerator:
+        
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        
+        return SignatureGenerator()
+    
+    def release(self, signature_generator : SignatureGenerator):
+        
+        signature_generator.reset() # Also drops its input, not to hold audio while idle
+        
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(signature_generator)
+    
+    @contextmanager
+    def generator(self):
+        
+        signature_generator = self.acquire()
+        
+        try:
+            yield signature_generator
+        finally:
+            self.release(signature_generator)
+
+"""
+    Pool shared by the code of this process (each worker process of a
+    ProcessPoolExecutor has its own).
+"""
+
+generator_pool = SignatureGeneratorPool()
@@ -1,12 +1,12 @@
 from io import BytesIO
-import requests
+from concurrent.futures import Executor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 import uuid
 import time
 import json
-import soundfile as sf
 import numpy as np
 
-from .algorithm import SignatureGenerator
+from .algorithm import SignatureBudget, SignatureGenerator, generator_pool
+from .spectrogram import SpectrogramSession
 from .signature_format import DecodedMessage
 
 LANG = 'en-US'
@@ -21,8 +21,67 @@ HEADERS = {
     "User-Agent": "Shazam/3685 CFNetwork/1197 Darwin/20.0.0"
 }
 
+# (start, length) in seconds of the windows raced by recognizeSongMultiResolution:
+# short windows come back first, longer ones hold more peaks for hard audio
+MULTI_RESOLUTION_WINDOWS = ((0, 3), (1, 3), (2, 3), (0, 5), (0, 8))
+
+
+def isConfidentMatch(results: dict) -> bool:
+    return 'track' in results and bool(results.get('matches'))
+
+
+def resampleLinear(audio: np.ndarray, newLength: int) -> np.ndarray:
+    # Same as the np.interp() call of normalizateAudioData(), but in the
+    # dtype of `audio` (np.interp always works in float64), in blocks
+    result = np.empty(newLength, dtype=audio.dtype)
+    step = len(audio) / (newLength - 1) if newLength > 1 else 0.
+    for start in range(0, newLength, 1 << 16):
+        positions = np.arange(start, min(start + (1 << 16), newLength)) * step
+        left = np.minimum(positions.astype(np.intp), len(audio) - 1)
+        right = np.minimum(left + 1, len(audio) - 1)
+        fraction = (positions - left).astype(audio.dtype)
+        result[start:start + len(positions)] = audio[left] + (audio[right] - audio[left]) * fraction
+    return result
+
+
+def generateWindowSignature(audio: np.ndarray, maxTimeSeconds: float, budget: SignatureBudget = None) -> DecodedMessage:
+    # Module-level so that it can run in a process pool, reusing the generators of each process
+    with generator_pool.generator() as signature_generator:
+        signature_generator.feed_input(audio.tolist())
+        signature_generator.MAX_TIME_SECONDS = maxTimeSeconds
+        signature_generator.budget = budget
+        return signature_generator.get_next_signature()
+
+
+def pooled_session(maxConnections: int = 8):
+    # A requests.Session keeping up to `maxConnections` upstream connections
+    # alive, for Shazam.session when requests are sent from several threads
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=maxConnections, pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
 
 class Shazam:
+    # Optional RequestGuard (see ratelimit.py) shared by every instance of
+    # the process, for rate limiting, circuit breaking and retries
+    guard = None
+    # Endpoint, with two %s for the request UUIDs; can be pointed at a local
+    # stand-in such as mock_server.py
+    api_url = API_URL
+    # np.float32 decodes, downmixes, resamples and generates signatures in
+    # single precision, halving memory traffic (see accuracy.py)
+    float_dtype = np.float64
+    # Optional SignatureBudget (per-band peak caps, stop rule) for the
+    # signatures sent, trading payload size against accuracy
+    signature_budget = None
+    # Optional requests.Session shared by every instance, keeping upstream
+    # connections alive between requests (see pooled_session())
+    session = None
+    
     def __init__(self, songData: bytes):
         self.songData = songData
         self.MAX_TIME_SECONDS = 8
@@ -40,7 +99,86 @@ class Shazam:
             
             yield currentOffset, results
     
+    def recognizeSongMultiResolution(self, windows=MULTI_RESOLUTION_WINDOWS, executor: Executor = None,
+                                     isConfident=isConfidentMatch):
+        """
+        Compute signatures for several windows of the clip in parallel and
+        race their requests. Yields (offset, results) as responses arrive
+        and stops at the first confident one: signatures and requests that
+        have not started yet are cancelled, but requests already in flight
+        run to completion in the background (their responses are dropped).
+        The signature behind the last yielded result is kept in self.lastSignature.
+        By default every window is read from one SpectrogramSession, so the
+        FFTs of overlapping windows are computed once (windows then see the
+        audio before their start, as in streaming). Pass a ProcessPoolExecutor
+        as `executor` to generate independent signatures on several cores.
+        """
+        self.audio = self.normalizateAudioData(self.songData)
+        duration = len(self.audio) / 16000
+        
+        # Clip windows to the recording, dropping the ones that end up identical
+        spans = []
+        for start, length in windows:
+            if start < duration:
+                span = (start, min(length, duration - start))
+                if span not in spans:
+                    spans.append(span)
+        
+        requestExecutor = ThreadPoolExecutor(max_workers=len(spans) or 1)
+        
+        futures = {}
+        if executor is None:
+            # One spectrogram pass serves every window: signatures are ready at once
+            session = SpectrogramSession(self.float_dtype)
+            session.feed(self.audio[:int(max((start + length for start, length in spans), default=0) * 16000)])
+            for start, length in spans:
+                signature = session.signature(int(start * 16000), int((start + length) * 16000))
+                if self.signature_budget is not None:
+                    self.signature_budget.prune(signature)
+                futures[requestExecutor.submit(self.sendRecognizeRequest, signature)] = (start, signature)
+        else:
+            for start, length in spans:
+                window = self.audio[int(start * 16000):int((start + length) * 16000)]
+                futures[executor.submit(generateWindowSignature, window, length, self.signature_budget)] = (start, None)
+        
+        pending = set(futures)
+        lastError = None
+        yielded = False
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    start, signature = futures[future]
+                    try:
+                        if signature is None:
+                            # A signature is ready: send it right away
+                            signature = future.result()
+                            if signature:
+                                requestFuture = requestExecutor.submit(self.sendRecognizeRequest, signature)
+                                futures[requestFuture] = (start, signature)
+                                pending.add(requestFuture)
+                            continue
+                        results = future.result()
+                    except Exception as e:
+                        lastError = e
+                        continue
+                    
+                    self.lastSignature = signature
+                    yielded = True
+                    yield start + signature.number_samples / 16000, results
+                    
+                    if isConfident(results):
+                        return
+            
+            if not yielded and lastError is not None:
+                raise lastError
+        finally:
+            for future in pending:
+                future.cancel()
+            requestExecutor.shutdown(wait=False, cancel_futures=True)
+    
     def sendRecognizeRequest(self, sig: DecodedMessage) -> dict:
+        import requests  # Deferred, like soundfile below, to keep `import custom_shazam_api` fast
         data = {
             'timezone': TIME_ZONE,
             'signature': {
@@ -51,42 +189,72 @@ class Shazam:
             'context': {},
             'geolocation': {}
                 }
-        r = requests.post(
-            API_URL % (str(uuid.uuid4()).upper(), str(uuid.uuid4()).upper()), 
+        client = self.session if self.session is not None else requests
+        send = lambda: client.post(
+            self.api_url % (str(uuid.uuid4()).upper(), str(uuid.uuid4()).upper()), 
             headers=HEADERS,
             json=data
         )
+        if self.guard is not None:
+            r = self.guard.call(send)
+        else:
+            r = send()
+            r.raise_for_status()
         return r.json()
     
     def normalizateAudioData(self, songData: bytes) -> np.ndarray:
+        import soundfile as sf
         # Read audio data using soundfile
         with BytesIO(songData) as audio_file:
-            audio_data, sample_rate = sf.read(audio_file)
-            
-            # Convert to mono if stereo
-            if len(audio_data.shape) > 1:
-                audio_data = np.mean(audio_data, axis=1)
-            
-            # Resample to 16kHz if needed
-            if sample_rate != 16000:
-                # Simple linear resampling
-                duration = len(audio_data) / sample_rate
-                new_length = int(duration * 16000)
-                audio_data = np.interp(
-                    np.linspace(0, len(audio_data), new_length),
-                    np.arange(len(audio_data)),
-                    audio_data
-                )
-            
-            # Convert to 16-bit PCM
-            audio_data = (audio_data * 32767).astype(np.int16)
+            try:
+                sound_file = sf.SoundFile(audio_file)
+            except RuntimeError:
+                # Not a format libsndfile reads (AAC, Opus in MP4, MP3 on older libsndfile...): decode with ffmpeg
+                from .decoder import decode_pcm
+                return decode_pcm(songData)
             
-            return audio_data
+            with sound_file:
+                # Recordings captured natively as 16kHz 16-bit mono are used as they are
+                if sound_file.samplerate == 16000 and sound_file.channels == 1 and sound_file.subtype == 'PCM_16':
+                    return sound_file.read(dtype='int16')
+                
+                audio_data, sample_rate = sound_file.read(dtype=np.dtype(self.float_dtype).name), sound_file.samplerate
+                
+                # Convert to mono if stereo
+                if len(audio_data.shape) > 1:
+                    audio_data = np.mean(audio_data, axis=1)
+                
+                # Resample to 16kHz if needed
+                if sample_rate != 16000:
+                    # Simple linear resampling
+                    duration = len(audio_data) / sample_rate
+                    new_length = int(duration * 16000)
+                    if audio_data.dtype != np.float64:
+                        audio_data = resampleLinear(audio_data, new_length)
+                    else:
+                        audio_data = np.interp(
+                            np.linspace(0, len(audio_data), new_length),
+                            np.arange(len(audio_data)),
+                            audio_data
+                        )
+                
+                # Convert to 16-bit PCM
+                audio_data = (audio_data * 32767).astype(np.int16)
+                
+                return audio_data
     
-    def createSignatureGenerator(self, audio: np.ndarray) -> SignatureGenerator:
-        signature_generator = SignatureGenerator()
+    def createSignatureGenerator(self, audio: np.ndarray, signature_generator: SignatureGenerator = None) -> SignatureGenerator:
+        # Pass a generator (e.g. from generator_pool) to reuse its buffers; it is reset first
+        if signature_generator is None:
+            signature_generator = SignatureGenerator()
+        else:
+            signature_generator.reset()
         signature_generator.feed_input(audio.tolist())
         signature_generator.MAX_TIME_SECONDS = self.MAX_TIME_SECONDS
+        signature_generator.dtype = self.float_dtype
+        signature_generator.budget = self.signature_budget
         if len(audio) > 12 * 3 * 16000:  # If longer than 36 seconds
-            signature_generator.samples_processed += 16000 * (int(len(audio) / (16 * 16000)) - 6)
+            # Skip ahead, never back: below 96 seconds the formula is negative, which used to
+            # read the end of the clip first (Python backend) or fail (compiled backend)
+            signature_generator.samples_processed += 16000 * max(0, int(len(audio) / (16 * 16000)) - 6)
         return signature_generator 
\ No newline at end of file
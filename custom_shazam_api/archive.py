@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+"""
+    Append-only archive of signatures, so that what was heard can be kept
+    for months (a signature is a few hundred bytes) and replayed against
+    Shazam or a local matcher later, without keeping any audio.
+
+    Layout (all integers little-endian):
+
+        File header     b'SZSIGARC' + version (uint32) + reserved (uint32)
+        Record          magic (uint32) + body size (uint32) + CRC-32 of body (uint32) + body
+        Record body     timestamp (float64) + device size (uint16) + result size (uint32)
+                        + signature size (uint32) + device (UTF-8) + result (JSON)
+                        + signature (DecodedMessage.encode_to_binary() output)
+        Index footer    (record offset (uint64), timestamp (float64)) per record
+                        + index offset (uint64) + record count (uint64) + b'SZSIGIDX'
+
+    The footer is written when the writer is closed and stripped again when
+    appending, so an archive whose writer crashed simply has no footer: the
+    reader then rebuilds the index by walking the length-prefixed records.
+"""
+from typing import Callable, Iterator, List, Optional, Tuple, Union
+from binascii import crc32
+import threading
+import struct
+import json
+import time
+import mmap
+import os
+
+import numpy as np
+
+from .signature_format import DecodedMessage
+
+FILE_MAGIC = b'SZSIGARC'
+FILE_VERSION = 1
+FILE_HEADER = struct.Struct('<8sII')
+
+RECORD_MAGIC = 0x5a535243
+RECORD_HEADER = struct.Struct('<III')
+RECORD_BODY_HEADER = struct.Struct('<dHII')
+
+FOOTER_MAGIC = b'SZSIGIDX'
+FOOTER_TRAILER = struct.Struct('<QQ8s')
+INDEX_ENTRY_DTYPE = np.dtype([('offset', '<u8'), ('timestamp', '<f8')])
+
+
+class ArchiveRecord:
+
+    def __init__(self, timestamp : float, device : str, result : Optional[dict], signature_bytes : bytes):
+
+        self.timestamp = timestamp
+        self.device = device
+        self.result = result # Whatever the caller stored, None for unidentified windows
+        self.signature_bytes = signature_bytes
+
+    @property
+    def signature(self) -> DecodedMessage:
+
+        return DecodedMessage.decode_from_binary(self.signature_bytes)
+
+
+def scan_records(data : Union[bytes, mmap.mmap], start : int, end : int) -> List[Tuple[int, float]]:
+
+    """Walk records from `start`, stopping at the first truncated or corrupt one"""
+
+    entries = []
+    offset = start
+
+    while offset + RECORD_HEADER.size + RECORD_BODY_HEADER.size <= end:
+
+        magic, body_size, checksum = RECORD_HEADER.unpack_from(data, offset)
+        body_start = offset + RECORD_HEADER.size
+
+        if magic != RECORD_MAGIC or body_start + body_size > end:
+            break
+        if crc32(data[body_start:body_start + body_size]) & 0xffffffff != checksum:
+            break
+
+        entries.append((offset, RECORD_BODY_HEADER.unpack_from(data, body_start)[0]))
+        offset = body_start + body_size
+
+    return entries
+
+
+def read_footer(data : Union[bytes, mmap.mmap], size : int) -> Optional[np.ndarray]:
+
+    """Return the index stored in the footer, or None if there is no valid footer"""
+
+    if size < FILE_HEADER.size + FOOTER_TRAILER.size:
+        return None
+
+    index_offset, count, magic = FOOTER_TRAILER.unpack_from(data, size - FOOTER_TRAILER.size)
+
+    if magic != FOOTER_MAGIC or index_offset + count * INDEX_ENTRY_DTYPE.itemsize != size - FOOTER_TRAILER.size:
+        return None
+
+    return np.frombuffer(data, dtype = INDEX_ENTRY_DTYPE, count = count, offset = index_offset).copy()
+
+
+class SignatureArchiveWriter:
+
+    def __init__(self, path : str):
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._index : List[Tuple[int, float]] = []
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self._file = open(path, 'r+b')
+            self._reopen()
+        else:
+            self._file = open(path, 'w+b')
+            self._file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, 0))
+
+    def _reopen(self):
+
+        data = self._file.read()
+
+        magic, version, reserved = FILE_HEADER.unpack_from(data, 0)
+        if magic != FILE_MAGIC or version != FILE_VERSION:
+            raise ValueError('%s is not a signature archive' % self.path)
+
+        index = read_footer(data, len(data))
+
+        if index is not None:
+            self._index = [(int(offset), float(timestamp)) for offset, timestamp in index]
+            end = FOOTER_TRAILER.unpack_from(data, len(data) - FOOTER_TRAILER.size)[0]
+        else:
+            self._index = scan_records(data, FILE_HEADER.size, len(data))
+            end = FILE_HEADER.size
+            if self._index:
+                last_offset = self._index[-1][0]
+                end = last_offset + RECORD_HEADER.size + RECORD_HEADER.unpack_from(data, last_offset)[1]
+
+        # Drop the footer (or a partially written record) before appending
+
+        self._file.truncate(end)
+        self._file.seek(end)
+
+    def __len__(self) -> int:
+
+        return len(self._index)
+
+    def append(self, signature : Union[DecodedMessage, bytes], timestamp : Optional[float] = None,
+               device : str = '', result : Optional[dict] = None) -> int:
+
+        """Append a record and return its position in the archive"""
+
+        if isinstance(signature, DecodedMessage):
+            signature = signature.encode_to_binary()
+        if timestamp is None:
+            timestamp = time.time()
+
+        device_bytes = device.encode('utf-8')
+        result_bytes = json.dumps(result, separators = (',', ':')).encode('utf-8') if result is not None else b''
+
+        body = (RECORD_BODY_HEADER.pack(timestamp, len(device_bytes), len(result_bytes), len(signature)) +
+                device_bytes + result_bytes + signature)
+
+        with self._lock:
+            offset = self._file.tell()
+            self._file.write(RECORD_HEADER.pack(RECORD_MAGIC, len(body), crc32(body) & 0xffffffff) + body)
+            self._index.append((offset, timestamp))
+
+            return len(self._index) - 1
+
+    def flush(self):
+
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+
+        """Write the index footer and close the file"""
+
+        with self._lock:
+            if self._file.closed:
+                return
+
+            index_offset = self._file.tell()
+            self._file.write(np.array(self._index, dtype = INDEX_ENTRY_DTYPE).tobytes())
+            self._file.write(FOOTER_TRAILER.pack(index_offset, len(self._index), FOOTER_MAGIC))
+            self._file.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.close()
+
+
+class SignatureArchiveReader:
+
+    def __init__(self, path : str):
+
+        self.path = path
+
+        with open(path, 'rb') as archive_file:
+            self._mmap = mmap.mmap(archive_file.fileno(), 0, access = mmap.ACCESS_READ)
+
+        magic, version, reserved = FILE_HEADER.unpack_from(self._mmap, 0)
+        if magic != FILE_MAGIC or version != FILE_VERSION:
+            raise ValueError('%s is not a signature archive' % path)
+
+        index = read_footer(self._mmap, len(self._mmap))
+
+        if index is None:
+            index = np.array(scan_records(self._mmap, FILE_HEADER.size, len(self._mmap)), dtype = INDEX_ENTRY_DTYPE)
+
+        self.index : np.ndarray = index # Structured array of (offset, timestamp)
+
+    def __len__(self) -> int:
+
+        return len(self.index)
+
+    def __getitem__(self, position : int) -> ArchiveRecord:
+
+        body_start = int(self.index['offset'][position]) + RECORD_HEADER.size
+
+        timestamp, device_size, result_size, signature_size = RECORD_BODY_HEADER.unpack_from(self._mmap, body_start)
+
+        start = body_start + RECORD_BODY_HEADER.size
+        device = self._mmap[start:start + device_size].decode('utf-8')
+        start += device_size
+        result = json.loads(self._mmap[start:start + result_size]) if result_size else None
+        start += result_size
+
+        return ArchiveRecord(timestamp, device, result, self._mmap[start:start + signature_size])
+
+    def __iter__(self) -> Iterator[ArchiveRecord]:
+
+        for position in range(len(self)):
+            yield self[position]
+
+    def between(self, start_time : float, end_time : float) -> Iterator[ArchiveRecord]:
+
+        """Records with start_time <= timestamp < end_time"""
+
+        for position in np.flatnonzero((self.index['timestamp'] >= start_time) & (self.index['timestamp'] < end_time)):
+            yield self[int(position)]
+
+    def unidentified(self) -> Iterator[ArchiveRecord]:
+
+        """Records stored without a result, worth re-querying later"""
+
+        for record in self:
+            if record.result is None:
+                yield record
+
+    def close(self):
+
+        self._mmap.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.close()
+
+
+def replay(records : Iterator[ArchiveRecord],
+           recognize : Optional[Callable[[DecodedMessage], dict]] = None) -> Iterator[Tuple[ArchiveRecord, dict]]:
+
+    """
+        Send archived signatures again, through Shazam.sendRecognizeRequest
+        by default or any callable taking a DecodedMessage (e.g. a local
+        matcher), yielding (record, response) pairs.
+    """
+
+    if recognize is None:
+        from .api import Shazam
+        recognize = Shazam(b'').sendRecognizeRequest
+
+    for record in records:
+        yield record, recognize(record.signature)
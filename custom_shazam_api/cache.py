@@ -0,0 +1,361 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+"""
+    Bounded cache of recent recordings (or just their signatures), kept as
+    evidence of what was heard.
+
+    Entries are tracked in an in-memory index that is persisted next to the
+    files, so the cache directory is only scanned once, when migrating from
+    the old one-WAV-plus-metadata-JSON layout. Encoding, writing and
+    eviction happen on a single background thread; callers only enqueue.
+    Besides after each write, entries are evicted once at startup and then
+    every `evict_interval` seconds, so that they also expire while nothing
+    is being recorded.
+"""
+from collections import OrderedDict
+from io import BytesIO
+from typing import Dict, Optional
+import threading
+import queue
+import json
+import time
+import os
+
+import numpy as np
+
+from .algorithm import generator_pool
+
+FORMAT_WAV = 'wav'
+FORMAT_FLAC = 'flac'
+FORMAT_OPUS = 'opus'
+FORMAT_SIGNATURE = 'signature'
+
+FILE_EXTENSIONS = {
+    FORMAT_WAV: '.wav',
+    FORMAT_FLAC: '.flac',
+    FORMAT_OPUS: '.ogg',
+    FORMAT_SIGNATURE: '.sig',
+}
+
+INDEX_FILE_NAME = 'index.json'
+
+
+class CacheEntry:
+
+    def __init__(self, key : str, file_name : str, size : int, created : float, metadata : Optional[dict] = None):
+
+        self.key = key
+        self.file_name = file_name
+        self.size = size
+        self.created = created
+        self.metadata = metadata
+
+    def to_json(self) -> dict:
+
+        return {
+            'key': self.key,
+            'file_name': self.file_name,
+            'size': self.size,
+            'created': self.created,
+            'metadata': self.metadata,
+        }
+
+    @classmethod
+    def from_json(cls, data : dict):
+
+        return cls(data['key'], data['file_name'], data['size'], data['created'], data.get('metadata'))
+
+
+class RecordingCache:
+
+    def __init__(self, cache_dir : str, max_bytes : int = 256 * 1024 * 1024, max_age_seconds : float = 14 * 24 * 3600,
+                 storage_format : str = FORMAT_FLAC, evict_interval : float = 3600.):
+
+        if storage_format not in FILE_EXTENSIONS:
+            raise ValueError('Unknown cache storage format: %s' % storage_format)
+
+        if storage_format == FORMAT_OPUS:
+            import soundfile as sf
+            if 'OPUS' not in sf.available_subtypes('OGG'):
+                print('Opus is not supported by this libsndfile, caching recordings as FLAC instead')
+                storage_format = FORMAT_FLAC
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.storage_format = storage_format
+        self.evict_interval = evict_interval # Seconds between two evictions of an idle writer
+
+        os.makedirs(self.cache_dir, exist_ok = True)
+
+        self._lock = threading.Lock()
+        self._entries : Dict[str, CacheEntry] = OrderedDict() # Oldest first
+        self._total_bytes = 0
+
+        self._load_index()
+
+        self._queue : queue.Queue = queue.Queue()
+        self._queue.put(('evict', None, None, None)) # What expired (or the size limit went down) since the last run
+        self._writer = threading.Thread(target = self._write_loop, name = 'recording-cache-writer', daemon = True)
+        self._writer.start()
+
+    @property
+    def total_bytes(self) -> int:
+
+        return self._total_bytes
+
+    def __len__(self) -> int:
+
+        return len(self._entries)
+
+    def __contains__(self, key : str) -> bool:
+
+        return key in self._entries
+
+    def get_entry(self, key : str) -> Optional[CacheEntry]:
+
+        with self._lock:
+            return self._entries.get(key)
+
+    def get_path(self, key : str) -> Optional[str]:
+
+        entry = self.get_entry(key)
+
+        return os.path.join(self.cache_dir, entry.file_name) if entry else None
+
+    def put(self, key : str, audio_bytes : bytes, signature : Optional[bytes] = None):
+
+        """
+            Queue a recording (any file format libsndfile reads) for storage.
+            When caching signatures only, a precomputed binary signature can
+            be passed to avoid generating it again.
+        """
+
+        self._queue.put(('put', key, audio_bytes, signature))
+
+    def set_metadata(self, key : str, metadata : dict):
+
+        """Attach metadata (e.g. the identified song) to a cached recording"""
+
+        self._queue.put(('metadata', key, metadata, None))
+
+    def flush(self):
+
+        """Block until every queued write has been performed"""
+
+        self._queue.join()
+
+    def close(self):
+
+        self._queue.put(None)
+        self._writer.join()
+
+    def _write_loop(self):
+
+        next_eviction = time.monotonic() + self.evict_interval
+
+        while True:
+
+            try:
+                task = self._queue.get(timeout = max(0., next_eviction - time.monotonic()))
+                queued = True
+            except queue.Empty: # Nothing written for a while
+                task = ('evict', None, None, None)
+                queued = False
+
+            try:
+                if task is None:
+                    return
+
+                action, key, payload, signature = task
+
+                if action == 'put':
+                    self._store(key, payload, signature)
+                elif action == 'metadata':
+                    self._update_metadata(key, payload)
+                else:
+                    next_eviction = time.monotonic() + self.evict_interval
+
+                self._evict()
+                self._save_index()
+
+            except Exception as e:
+                print('Error writing to the recording cache: %s' % e)
+
+            finally:
+                if queued:
+                    self._queue.task_done()
+
+    def _store(self, key : str, audio_bytes : bytes, signature : Optional[bytes]):
+
+        file_name = key + FILE_EXTENSIONS[self.storage_format]
+        path = os.path.join(self.cache_dir, file_name)
+
+        if self.storage_format == FORMAT_SIGNATURE:
+
+            # Computed before the file is opened, so that nothing is left behind when there is no signature
+            if signature is None:
+                signature = self._compute_signature(audio_bytes)
+                if signature is None:
+                    print('Warning: recording %s is too short for a signature, not cached' % key)
+                    return
+
+            with open(path, 'wb') as signature_file:
+                signature_file.write(signature)
+
+        elif self.storage_format == FORMAT_WAV:
+
+            with open(path, 'wb') as audio_file:
+                audio_file.write(audio_bytes)
+
+        else:
+
+            import soundfile as sf # Only on the writer thread, off the startup path
+
+            audio_data, sample_rate = sf.read(BytesIO(audio_bytes), dtype = 'float32')
+
+            if self.storage_format == FORMAT_OPUS:
+                # Opus only supports a few sample rates, and 16 KHz is all the recognizer uses anyway
+                audio_data = resample(audio_data, sample_rate, 16000)
+                sf.write(path, audio_data, 16000, format = 'OGG', subtype = 'OPUS')
+            else:
+                sf.write(path, audio_data, sample_rate, format = 'FLAC', subtype = 'PCM_16')
+
+        entry = CacheEntry(key, file_name, os.path.getsize(path), time.time())
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._total_bytes -= previous.size
+                entry.metadata = previous.metadata
+            self._entries[key] = entry
+            self._total_bytes += entry.size
+
+    def _compute_signature(self, audio_bytes : bytes) -> Optional[bytes]:
+
+        """The binary signature of a recording, or None if it is too short to have one"""
+
+        import soundfile as sf
+
+        audio_data, sample_rate = sf.read(BytesIO(audio_bytes), dtype = 'float32')
+
+        with generator_pool.generator() as signature_generator:
+            signature_generator.feed_input((resample(audio_data, sample_rate, 16000) * 32767).astype(np.int16).tolist())
+            signature = signature_generator.get_next_signature()
+
+        return signature.encode_to_binary() if signature is not None else None
+
+    def _update_metadata(self, key : str, metadata : dict):
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.metadata = metadata
+
+    def _evict(self):
+
+        expired_before = time.time() - self.max_age_seconds
+        evicted = []
+
+        with self._lock:
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if oldest.created >= expired_before and self._total_bytes <= self.max_bytes:
+                    break
+                del self._entries[oldest.key]
+                self._total_bytes -= oldest.size
+                evicted.append(oldest)
+
+        for entry in evicted:
+            try:
+                os.remove(os.path.join(self.cache_dir, entry.file_name))
+            except FileNotFoundError:
+                pass
+
+    def _load_index(self):
+
+        index_path = os.path.join(self.cache_dir, INDEX_FILE_NAME)
+
+        if os.path.exists(index_path):
+            try:
+                with open(index_path) as index_file:
+                    entries = [CacheEntry.from_json(data) for data in json.load(index_file)]
+            except (ValueError, KeyError) as e:
+                print('Ignoring corrupt recording cache index: %s' % e)
+                entries = self._migrate_legacy_files()
+        else:
+            entries = self._migrate_legacy_files()
+
+        for entry in sorted(entries, key = lambda entry: entry.created):
+            if not os.path.exists(os.path.join(self.cache_dir, entry.file_name)):
+                continue
+            self._entries[entry.key] = entry
+            self._total_bytes += entry.size
+
+    def _migrate_legacy_files(self) -> list:
+
+        # One-time scan of the old layout: recording_<timestamp>.wav files
+        # with optional (and often orphaned) recording_<timestamp>_metadata.json
+
+        entries = []
+
+        for file_name in os.listdir(self.cache_dir):
+
+            path = os.path.join(self.cache_dir, file_name)
+
+            if file_name.endswith('_metadata.json'):
+                wav_path = path[:-len('_metadata.json')] + '.wav'
+                if not os.path.exists(wav_path):
+                    os.remove(path)
+                continue
+
+            key, extension = os.path.splitext(file_name)
+
+            if extension not in FILE_EXTENSIONS.values():
+                continue
+
+            metadata = None
+            metadata_path = os.path.join(self.cache_dir, key + '_metadata.json')
+
+            if os.path.exists(metadata_path):
+                try:
+                    with open(metadata_path) as metadata_file:
+                        metadata = json.load(metadata_file)
+                except ValueError:
+                    pass
+                os.remove(metadata_path)
+
+            entries.append(CacheEntry(key, file_name, os.path.getsize(path), os.path.getmtime(path), metadata))
+
+        return entries
+
+    def _save_index(self):
+
+        with self._lock:
+            data = [entry.to_json() for entry in self._entries.values()]
+
+        index_path = os.path.join(self.cache_dir, INDEX_FILE_NAME)
+
+        with open(index_path + '.tmp', 'w') as index_file:
+            json.dump(data, index_file)
+
+        os.replace(index_path + '.tmp', index_path)
+
+
+def resample(audio_data : np.ndarray, sample_rate : int, new_sample_rate : int) -> np.ndarray:
+
+    """Downmix to mono and linearly resample, like Shazam.normalizateAudioData"""
+
+    if audio_data.ndim > 1:
+        audio_data = np.mean(audio_data, axis = 1)
+
+    if sample_rate == new_sample_rate:
+        return audio_data
+
+    new_length = int(len(audio_data) / sample_rate * new_sample_rate)
+
+    return np.interp(
+        np.linspace(0, len(audio_data), new_length),
+        np.arange(len(audio_data)),
+        audio_data
+    ).astype(audio_data.dtype)
@@ -0,0 +1,303 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+"""
+    Streaming decoder for compressed audio (MP3, AAC, Opus... whatever
+    ffmpeg reads): ffmpeg runs as a subprocess writing raw s16le 16 KHz
+    mono to a pipe, which is read in chunks and fed to the signature code
+    as it arrives. Files of any length are fingerprinted at ffmpeg's speed
+    in bounded memory, instead of being decoded into memory whole.
+
+        stream_signature()  one signature of the whole file, through a
+                            SpectrogramSession trimmed behind its peaks
+                            (the same as generate_signature_parallel())
+        iter_signatures()   successive request-sized signatures, through a
+                            SignatureGenerator, like Shazam.recognizeSong()
+
+    DecoderPool fingerprints batches of files in worker processes, each
+    running its own ffmpeg, with a bounded number of files in flight:
+
+        python -m custom_shazam_api.decoder --workers 4 --archive music.sigarc *.mp3
+"""
+from concurrent.futures import Future, ProcessPoolExecutor
+from collections import deque
+from typing import Iterator, List, Optional, Tuple, Union
+import subprocess
+import threading
+import argparse
+import time
+import os
+
+import numpy as np
+
+from .signature_format import DecodedMessage
+
+FFMPEG = 'ffmpeg' # Looked up on PATH, where the app puts its bundled copy
+SAMPLE_RATE = 16000
+DEFAULT_CHUNK_SECONDS = 1. # Memory use grows with it (about 11 MB at 1 s, 80 MB at 10 s), speed hardly does
+
+AudioInput = Union[str, bytes] # A file path, or the contents of a file
+
+
+class DecodeError(Exception):
+
+    pass
+
+
+def ffmpeg_command(input_name : str, ffmpeg : str = FFMPEG) -> List[str]:
+
+    return [ffmpeg, '-nostdin', '-hide_banner', '-loglevel', 'error', '-i', input_name,
+            '-vn', '-ac', '1', '-ar', str(SAMPLE_RATE), '-f', 's16le', '-acodec', 'pcm_s16le', 'pipe:1']
+
+
+def iter_pcm_chunks(source : AudioInput, chunk_seconds : float = DEFAULT_CHUNK_SECONDS,
+                    ffmpeg : str = FFMPEG) -> Iterator[np.ndarray]:
+
+    """Decode with ffmpeg, yielding int16 16 KHz mono chunks as they come out of the pipe"""
+
+    from_bytes = not isinstance(source, str)
+
+    try:
+        process = subprocess.Popen(ffmpeg_command('pipe:0' if from_bytes else source, ffmpeg),
+                                   stdin = subprocess.PIPE if from_bytes else subprocess.DEVNULL,
+                                   stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+    except OSError as e:
+        raise DecodeError('Could not run %s: %s' % (ffmpeg, e))
+
+    # Both are drained by threads, so that ffmpeg never blocks on a full pipe
+
+    errors = []
+    helpers = [threading.Thread(target = lambda: errors.append(process.stderr.read()), daemon = True)]
+
+    if from_bytes:
+
+        def write_input():
+            try:
+                process.stdin.write(source)
+                process.stdin.close()
+            except OSError:
+                pass # ffmpeg stopped reading: it failed, or the caller stopped early
+
+        helpers.append(threading.Thread(target = write_input, daemon = True))
+
+    for helper in helpers:
+        helper.start()
+
+    chunk_bytes = int(chunk_seconds * SAMPLE_RATE) * 2
+
+    try:
+        while True:
+
+            data = process.stdout.read(chunk_bytes)
+            if len(data) < 2:
+                break
+
+            yield np.frombuffer(data[:len(data) // 2 * 2], dtype = '<i2')
+
+        returncode = process.wait()
+
+        for helper in helpers:
+            helper.join()
+
+        if returncode != 0:
+            message = b''.join(errors).decode('utf-8', 'replace').strip().splitlines()
+            raise DecodeError('ffmpeg failed with status %d: %s' % (returncode, message[-1] if message else 'no output'))
+
+    finally:
+        if process.poll() is None: # Closed before the end of the file
+            process.kill()
+            process.wait()
+        process.stdout.close()
+
+
+def decode_pcm(source : AudioInput, ffmpeg : str = FFMPEG) -> np.ndarray:
+
+    """The whole audio, as int16 16 KHz mono samples (in memory: use the functions below for long files)"""
+
+    chunks = list(iter_pcm_chunks(source, ffmpeg = ffmpeg))
+
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype = np.int16)
+
+
+def stream_signature(source : AudioInput, chunk_seconds : float = DEFAULT_CHUNK_SECONDS, dtype = np.float64,
+                     ffmpeg : str = FFMPEG) -> DecodedMessage:
+
+    """Signature of the whole audio, the same as generate_signature_parallel() of its decoded samples"""
+
+    from .spectrogram import SpectrogramSession, HOP, peaks_to_signature
+
+    session = SpectrogramSession(dtype)
+    peaks = []
+
+    for chunk in iter_pcm_chunks(source, chunk_seconds, ffmpeg):
+
+        session.feed(chunk)
+
+        # Keep the peaks found so far, and let the session drop what they were found from
+
+        if len(session.computed_peaks):
+            peaks.append(session.computed_peaks.copy())
+        session.trim(session.peaks_computed_until * HOP)
+
+    return peaks_to_signature(np.concatenate(peaks) if peaks else session.computed_peaks,
+                              0, session.samples_fed // HOP * HOP)
+
+
+def iter_signatures(source : AudioInput, max_time_seconds : float = 8., lookahead_seconds : float = 16.,
+                    chunk_seconds : float = DEFAULT_CHUNK_SECONDS, dtype = np.float64,
+                    ffmpeg : str = FFMPEG) -> Iterator[Tuple[float, DecodedMessage]]:
+
+    """
+        (offset in seconds, signature) of successive windows, as
+        Shazam.recognizeSong() sends them. A signature is only generated
+        once `lookahead_seconds` of audio are waiting (or at the end), so
+        that it doesn't stop short of what it would take from the whole file.
+    """
+
+    from .algorithm import generator_pool
+
+    with generator_pool.generator() as signature_generator:
+
+        signature_generator.MAX_TIME_SECONDS = max_time_seconds
+        signature_generator.dtype = dtype
+
+        def waiting() -> int:
+            return (len(signature_generator.input_pending_processing) -
+                    (signature_generator.samples_processed - signature_generator.input_offset))
+
+        for chunk in iter_pcm_chunks(source, chunk_seconds, ffmpeg):
+
+            signature_generator.feed_input(chunk.tolist())
+
+            while waiting() >= lookahead_seconds * SAMPLE_RATE:
+                signature = signature_generator.get_next_signature()
+                yield signature_generator.samples_processed / SAMPLE_RATE, signature
+
+        while True:
+            signature = signature_generator.get_next_signature()
+            if not signature:
+                break
+            yield signature_generator.samples_processed / SAMPLE_RATE, signature
+
+
+def _fingerprint(source : AudioInput, dtype, ffmpeg : str) -> Tuple[DecodedMessage, float]:
+
+    # Worker side of DecoderPool: the signature, and the seconds it took
+
+    start = time.perf_counter()
+    signature = stream_signature(source, dtype = dtype, ffmpeg = ffmpeg)
+
+    return signature, time.perf_counter() - start
+
+
+class DecoderPool:
+
+    """Worker processes decoding and fingerprinting files, one ffmpeg each at a time"""
+
+    def __init__(self, max_workers : Optional[int] = None, dtype = np.float64, ffmpeg : str = FFMPEG):
+
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.dtype = dtype
+        self.ffmpeg = ffmpeg
+
+        self._executor : Optional[ProcessPoolExecutor] = None
+
+    def submit(self, source : AudioInput) -> Future:
+
+        """Future of (whole-file signature, seconds spent in the worker)"""
+
+        if self._executor is None:
+            from .pool import worker_context # Not forked from a multithreaded caller, see worker_context()
+            self._executor = ProcessPoolExecutor(max_workers = self.max_workers, mp_context = worker_context())
+
+        return self._executor.submit(_fingerprint, source, self.dtype, self.ffmpeg)
+
+    def fingerprint(self, sources : Iterator[AudioInput], max_pending : Optional[int] = None) -> Iterator[tuple]:
+
+        """
+            (source, (signature, seconds) or the exception raised) in the
+            order of `sources`, with at most `max_pending` files submitted
+            ahead (twice the workers by default), so that a batch of any size
+            runs in bounded memory.
+        """
+
+        max_pending = max_pending or 2 * self.max_workers
+        pending : deque = deque()
+
+        def result(source : AudioInput, future : Future):
+            try:
+                return source, future.result()
+            except Exception as e:
+                return source, e
+
+        for source in sources:
+            pending.append((source, self.submit(source)))
+            if len(pending) >= max_pending:
+                yield result(*pending.popleft())
+
+        while pending:
+            yield result(*pending.popleft())
+
+    def shutdown(self):
+
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.shutdown()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Fingerprint audio files of any format ffmpeg reads, streaming them through ffmpeg')
+    parser.add_argument('files', nargs = '+')
+    parser.add_argument('--workers', type = int, help = 'Files decoded at once (default: one per CPU)')
+    parser.add_argument('--archive', help = 'Append the signatures to this signature archive, with the file as device')
+    parser.add_argument('--float32', action = 'store_true', help = 'Generate signatures in single precision')
+    parser.add_argument('--ffmpeg', default = FFMPEG)
+    args = parser.parse_args()
+
+    writer = None
+    if args.archive:
+        from .archive import SignatureArchiveWriter
+        writer = SignatureArchiveWriter(args.archive)
+
+    start = time.perf_counter()
+    audio_seconds = 0.
+    failures = 0
+
+    try:
+        with DecoderPool(args.workers, np.float32 if args.float32 else np.float64, args.ffmpeg) as pool:
+            for path, result in pool.fingerprint(args.files):
+
+                if isinstance(result, Exception):
+                    failures += 1
+                    print('%s: %s' % (path, result))
+                    continue
+
+                signature, seconds = result
+                duration = signature.number_samples / SAMPLE_RATE
+                audio_seconds += duration
+                peaks = sum(len(band_peaks) for band_peaks in signature.frequency_band_to_sound_peaks.values())
+                print('%s: %.1f s of audio, %d peaks, %.2f s (%.0fx real time)' % (
+                    path, duration, peaks, seconds, duration / seconds if seconds else 0.))
+
+                if writer is not None:
+                    writer.append(signature, device = path)
+
+    finally:
+        if writer is not None:
+            writer.close()
+
+    elapsed = time.perf_counter() - start
+    print('%d files, %.1f s of audio in %.1f s (%.0fx real time), %d failed' % (
+        len(args.files), audio_seconds, elapsed, audio_seconds / elapsed if elapsed else 0., failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+"""
+    Registry of audio devices: enumerated once, then watched for changes
+    by a background thread, so that the recording hot path only looks up a
+    cached set of available input devices.
+
+    PortAudio only notices added or removed devices when re-initialized,
+    which sounddevice has no public API for and which would also kill open
+    streams. So the watcher only re-reads the device list, once a minute by
+    default; re-initialization is left to explicit requests (the user asking
+    for a refresh, a recording failing on a device), and waits until no
+    stream is open: recorders wrap their streams in
+    `with registry.stream_open():`.
+
+    Listeners receive (added, removed) lists of device dicts, on the
+    watcher thread. Devices are identified by (name, host API, ordinal)
+    since PortAudio indexes can shift when devices come and go, the ordinal
+    telling identical devices (several "USB Audio Device" units) apart in
+    index order. PortAudio has no serial numbers, so when one of several
+    identical devices goes away, the ones after it take its place.
+"""
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+import threading
+
+DeviceKey = Tuple[str, int]
+DeviceId = Tuple[str, int, int]
+
+
+def device_key(device : dict) -> DeviceKey:
+
+    return device['name'], device.get('hostapi', 0)
+
+
+def device_ids(devices : List[dict]) -> Dict[int, DeviceId]:
+
+    """(name, host API, ordinal among the devices with that name and host API) of each device, by index"""
+
+    seen : Counter = Counter()
+    ids = {}
+
+    for device in sorted(devices, key = lambda device: device['index']):
+        key = device_key(device)
+        ids[device['index']] = key + (seen[key],)
+        seen[key] += 1
+
+    return ids
+
+
+def enumerate_devices(reinitialize : bool = False) -> List[dict]:
+
+    """
+        List devices with sounddevice, re-initializing PortAudio first to
+        pick up hot-plugged ones. That goes through sounddevice's private
+        _terminate() and _initialize() (present as of the pinned 0.4.6, but
+        not part of its API), so it only happens when asked for, never on a
+        timer.
+    """
+
+    import sounddevice as sd
+
+    if reinitialize:
+        sd._terminate()
+        sd._initialize()
+
+    return [dict(device) for device in sd.query_devices()]
+
+
+class DeviceRegistry:
+
+    def __init__(self, interval : float = 60., enumerate_function : Callable[[bool], List[dict]] = enumerate_devices):
+
+        self.interval = interval # Seconds between two rescans of the watcher thread (never re-initializing)
+        self._enumerate = enumerate_function # Called with whether PortAudio may be re-initialized
+
+        self._lock = threading.Lock()
+        self._devices : List[dict] = []
+        self._input_names : Dict[int, str] = {} # Index to name of the input devices
+        self._ids : Dict[int, DeviceId] = {} # Index to id of every device
+        self._enumerated = False
+        self._open_streams = 0
+        self._reinitialize_pending = False # Asked for while a stream was open
+
+        self._listeners : List[Callable[[List[dict], List[dict]], None]] = []
+        self._stop = threading.Event()
+        self._thread : Optional[threading.Thread] = None
+
+    def add_listener(self, callback : Callable[[List[dict], List[dict]], None]):
+
+        self._listeners.append(callback)
+
+    def set_enumerate_function(self, enumerate_function : Callable[[bool], List[dict]]):
+
+        """List devices with another function (e.g. of another audio source), from the next enumeration on"""
+
+        with self._lock:
+            self._enumerate = enumerate_function
+            self._enumerated = False # The next enumeration is a first one: listeners are not notified
+
+    def devices(self) -> List[dict]:
+
+        """Cached device list (enumerated on first use)"""
+
+        if not self._enumerated:
+            self.refresh()
+
+        return list(self._devices)
+
+    def input_devices(self) -> List[dict]:
+
+        return [device for device in self.devices() if device['max_input_channels'] > 0]
+
+    def is_available(self, index : int, name : Optional[str] = None) -> bool:
+
+        """Whether an input device (with this name, if given) is at this index, from the cache (no PortAudio call)"""
+
+        if not self._enumerated:
+            self.refresh()
+
+        return index in self._input_names and (name is None or self._input_names[index] == name)
+
+    def device_id(self, index : int) -> Optional[DeviceId]:
+
+        if not self._enumerated:
+            self.refresh()
+
+        return self._ids.get(index)
+
+    def find_id(self, device_id : DeviceId) -> Optional[dict]:
+
+        """The device with this id, wherever PortAudio has numbered it now"""
+
+        for device in self.devices():
+            if self._ids.get(device['index']) == device_id:
+                return device
+
+        return None
+
+    def find(self, name : str, hostapi : Optional[int] = None) -> Optional[dict]:
+
+        for device in self.devices():
+            if device['name'] == name and (hostapi is None or device.get('hostapi', 0) == hostapi):
+                return device
+
+        return None
+
+    @contextmanager
+    def stream_open(self):
+
+        """Mark a stream as open, holding off PortAudio re-initialization until it is closed"""
+
+        with self._lock:
+            self._open_streams += 1
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._open_streams -= 1
+
+    def request_reinitialize(self):
+
+        """Re-initialize PortAudio at the next refresh with no stream open (e.g. after a recording failed)"""
+
+        with self._lock:
+            self._reinitialize_pending = True
+
+    def refresh(self, reinitialize : bool = False) -> Tuple[List[dict], List[dict]]:
+
+        """
+            Enumerate now, notify listeners of changes and return (added,
+            removed). With `reinitialize`, PortAudio is re-initialized first
+            to find hot-plugged devices, or at a later refresh if a stream
+            is open now.
+        """
+
+        with self._lock:
+
+            reinitialize = reinitialize or self._reinitialize_pending
+            self._reinitialize_pending = reinitialize and self._open_streams > 0
+
+            devices = self._enumerate(reinitialize and self._open_streams == 0)
+
+            ids = device_ids(devices)
+            previous : Dict[DeviceId, dict] = {self._ids[device['index']]: device for device in self._devices}
+            current : Dict[DeviceId, dict] = {ids[device['index']]: device for device in devices}
+
+            added = [device for key, device in current.items() if key not in previous]
+            removed = [device for key, device in previous.items() if key not in current]
+            moved = any(previous[key]['index'] != device['index'] for key, device in current.items() if key in previous)
+
+            first_enumeration = not self._enumerated
+
+            self._devices = devices
+            self._input_names = {device['index']: device['name'] for device in devices if device['max_input_channels'] > 0}
+            self._ids = ids
+            self._enumerated = True
+
+        if first_enumeration:
+            return [], []
+
+        if added or removed or moved:
+            for listener in self._listeners:
+                try:
+                    listener(added, removed)
+                except Exception as e:
+                    print('Warning: device listener failed: %s' % e)
+
+        return added, removed
+
+    def start(self):
+
+        """Start watching for device changes in the background"""
+
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target = self._watch, name = 'device-watcher', daemon = True)
+        self._thread.start()
+
+    def stop(self):
+
+        self._stop.set()
+
+        if self._thread is not None:
+            self._thread.join(timeout = 2)
+            self._thread = None
+
+    def _watch(self):
+
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print('Warning: could not enumerate audio devices: %s' % e)
@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+"""
+    Cheap local pre-filter that decides whether a freshly recorded window
+    is worth a full signature plus a network request.
+
+    A window is skipped when it is (digitally) silent, when its level is
+    below a configurable threshold, or when its band-energy profile is
+    close enough to the last window that was actually sent for
+    recognition. Everything here is a handful of vectorized NumPy calls,
+    so a 5 second window at 44.1 KHz is gated in a couple of milliseconds.
+"""
+from typing import Dict, Optional, Tuple
+import time
+
+import numpy as np
+
+
+# Decisions reported by ChangeGate.check()
+
+REASON_FIRST_WINDOW = 'first_window'
+REASON_CHANGED = 'changed'
+REASON_FORCED = 'forced'
+REASON_SILENT = 'silent'
+REASON_BELOW_THRESHOLD = 'below_threshold'
+REASON_UNCHANGED = 'unchanged'
+
+# Band edges in Hz: log-spaced over the range the signature generator
+# actually keeps peaks for (250 Hz - 5.5 KHz, see FrequencyBand)
+
+BAND_EDGES_HZ = np.geomspace(250, 5500, 17)
+
+
+def to_mono_float(samples : np.ndarray) -> np.ndarray:
+
+    """Return float32 mono samples in [-1, 1] from float or int16 PCM"""
+
+    samples = np.asarray(samples)
+
+    if samples.ndim > 1:
+        samples = samples.mean(axis = 1)
+
+    if samples.dtype.kind in 'iu':
+        return samples.astype(np.float32) / 32768
+
+    return samples.astype(np.float32, copy = False)
+
+
+def to_dbfs(value : float) -> float:
+
+    return float(20 * np.log10(max(value, 1e-10)))
+
+
+class GateDecision:
+
+    def __init__(self, should_recognize : bool, reason : str, rms_dbfs : float, peak_dbfs : float,
+                 similarity : Optional[float] = None, elapsed_ms : float = 0.):
+
+        self.should_recognize = should_recognize
+        self.reason = reason
+        self.rms_dbfs = rms_dbfs
+        self.peak_dbfs = peak_dbfs
+        self.similarity = similarity
+        self.elapsed_ms = elapsed_ms
+
+    def describe(self) -> str:
+
+        description = '%s (rms %.1f dBFS, peak %.1f dBFS' % (self.reason, self.rms_dbfs, self.peak_dbfs)
+
+        if self.similarity is not None:
+            description += ', similarity %.3f' % self.similarity
+
+        return description + ', %.2f ms)' % self.elapsed_ms
+
+
+class ChangeGate:
+
+    def __init__(self, silence_dbfs : float = -60., threshold_dbfs : float = -45.,
+                 similarity_threshold : float = 0.985, max_consecutive_skips : int = 4,
+                 frame_size : int = 2048, max_frames : int = 48):
+
+        self.silence_dbfs = silence_dbfs # Peak level under which a window is considered silent
+        self.threshold_dbfs = threshold_dbfs # RMS level under which a window is too quiet to be matched
+        self.similarity_threshold = similarity_threshold # Profile similarity above which a window is "the same content"
+        self.max_consecutive_skips = max_consecutive_skips # Force a recognition after this many "unchanged" skips
+        self.frame_size = frame_size
+        self.max_frames = max_frames # Frames analyzed per window, evenly spread, which bounds the cost of long windows
+
+        self._band_layouts : Dict[Tuple[int, int], Tuple[np.ndarray, np.ndarray]] = {}
+        self.reset()
+
+    def reset(self):
+
+        """Forget the reference window, e.g. after switching devices"""
+
+        self.reference_profile : Optional[np.ndarray] = None
+        self.consecutive_skips = 0
+
+    def check(self, samples : np.ndarray, sample_rate : int) -> GateDecision:
+
+        """Decide whether the given window should be sent for recognition"""
+
+        start = time.perf_counter()
+
+        samples = to_mono_float(samples)
+
+        if len(samples):
+            rms = float(np.sqrt(np.dot(samples, samples) / len(samples)))
+            peak = float(max(samples.max(), -samples.min()))
+        else:
+            rms = peak = 0.
+
+        return self.check_levels(samples, sample_rate, to_dbfs(rms), to_dbfs(peak), start)
+
+    def check_levels(self, samples : np.ndarray, sample_rate : int, rms_dbfs : float, peak_dbfs : float,
+                     start : Optional[float] = None) -> GateDecision:
+
+        """Same as check(), with levels already measured by the caller"""
+
+        if start is None:
+            start = time.perf_counter()
+
+        if peak_dbfs < self.silence_dbfs:
+            return self._skip(REASON_SILENT, rms_dbfs, peak_dbfs, None, start)
+
+        if rms_dbfs < self.threshold_dbfs:
+            return self._skip(REASON_BELOW_THRESHOLD, rms_dbfs, peak_dbfs, None, start)
+
+        profile = self.compute_profile(to_mono_float(samples), sample_rate)
+
+        if self.reference_profile is None or profile is None:
+            reason = REASON_FIRST_WINDOW
+            similarity = None
+        else:
+            similarity = float(np.dot(profile, self.reference_profile))
+
+            if similarity < self.similarity_threshold:
+                reason = REASON_CHANGED
+            elif self.consecutive_skips < self.max_consecutive_skips:
+                return self._skip(REASON_UNCHANGED, rms_dbfs, peak_dbfs, similarity, start)
+            else:
+                reason = REASON_FORCED
+
+        self.reference_profile = profile
+        self.consecutive_skips = 0
+
+        return GateDecision(True, reason, rms_dbfs, peak_dbfs, similarity, (time.perf_counter() - start) * 1000)
+
+    def compute_profile(self, samples : np.ndarray, sample_rate : int) -> Optional[np.ndarray]:
+
+        """
+            Unit-norm descriptor of a window: mean and spread over time of
+            the log band energies, so that windows of the same recording
+            score close to 1 whatever their exact alignment.
+        """
+
+        num_frames = len(samples) // self.frame_size
+
+        if num_frames < 2:
+            return None
+
+        window, band_starts = self._get_band_layout(sample_rate)
+
+        frames = samples[:num_frames * self.frame_size].reshape(num_frames, self.frame_size)
+
+        if num_frames > self.max_frames:
+            frames = frames[np.linspace(0, num_frames - 1, self.max_frames).astype(np.intp)]
+
+        spectrum = np.fft.rfft(frames * window, axis = 1)
+        power = spectrum.real ** 2 + spectrum.imag ** 2
+
+        band_energies = np.log10(np.add.reduceat(power, band_starts, axis = 1)[:, :-1] + 1e-10)
+
+        profile = np.concatenate((band_energies.mean(axis = 0), band_energies.std(axis = 0)))
+        profile -= profile.mean()
+
+        norm = np.linalg.norm(profile)
+
+        return profile / norm if norm else None
+
+    def _get_band_layout(self, sample_rate : int) -> Tuple[np.ndarray, np.ndarray]:
+
+        key = (sample_rate, self.frame_size)
+
+        if key not in self._band_layouts:
+
+            bin_hz = sample_rate / self.frame_size
+            band_starts = np.round(BAND_EDGES_HZ / bin_hz).astype(np.intp)
+            band_starts = np.clip(band_starts, 0, self.frame_size // 2)
+
+            self._band_layouts[key] = (np.hanning(self.frame_size).astype(np.float32), band_starts)
+
+        return self._band_layouts[key]
+
+    def _skip(self, reason : str, rms_dbfs : float, peak_dbfs : float, similarity : Optional[float],
+              start : float) -> GateDecision:
+
+        if reason == REASON_UNCHANGED:
+            self.consecutive_skips += 1
+
+        return GateDecision(False, reason, rms_dbfs, peak_dbfs, similarity, (time.perf_counter() - start) * 1000)
+
+
+class LevelMeter:
+
+    """
+        Running RMS/peak meter fed from an audio capture callback. Block
+        statistics are folded into updates of about `update_hz` per second
+        (passed to `on_level` as linear RMS and peak), and the totals for
+        the whole window are kept so that the gate does not have to measure
+        the recording a second time.
+    """
+
+    def __init__(self, sample_rate : int, update_hz : float = 20., on_level = None):
+
+        self.samples_per_update = max(1, int(sample_rate / update_hz))
+        self.on_level = on_level
+
+        self.reset()
+
+    def reset(self):
+
+        self.total_sum_squares = 0.
+        self.total_samples = 0
+        self.total_peak = 0.
+
+        self._pending_sum_squares = 0.
+        self._pending_samples = 0
+        self._pending_peak = 0.
+
+    def process(self, block : np.ndarray):
+
+        """Account for a block of float or int16 samples, mono or (frames, channels)"""
+
+        if not len(block):
+            return
+
+        flat = block.reshape(-1)
+        if flat.dtype.kind in 'iu':
+            flat = flat.astype(np.float32) / 32768
+        channels = len(flat) // len(block)
+
+        sum_squares = float(np.dot(flat, flat)) / channels
+        peak = float(max(flat.max(), -flat.min()))
+
+        self.total_sum_squares += sum_squares
+        self.total_samples += len(block)
+        self.total_peak = max(self.total_peak, peak)
+
+        self._pending_sum_squares += sum_squares
+        self._pending_samples += len(block)
+        self._pending_peak = max(self._pending_peak, peak)
+
+        if self._pending_samples >= self.samples_per_update:
+
+            if self.on_level is not None:
+                self.on_level(float(np.sqrt(self._pending_sum_squares / self._pending_samples)), self._pending_peak)
+
+            self._pending_sum_squares = 0.
+            self._pending_samples = 0
+            self._pending_peak = 0.
+
+    @property
+    def rms(self) -> float:
+
+        return float(np.sqrt(self.total_sum_squares / self.total_samples)) if self.total_samples else 0.
+
+    @property
+    def rms_dbfs(self) -> float:
+
+        return to_dbfs(self.rms)
+
+    @property
+    def peak_dbfs(self) -> float:
+
+        return to_dbfs(self.total_peak)
@@ -0,0 +1,277 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+"""
+    Optional compiled backend for SignatureGenerator's per-frame peak
+    spreading and peak recognition, using Numba when it is installed
+    (pip install numba). The FFTs are batched with NumPy, and the power
+    spectrum and the stateful spreading/recognition run frame by frame in
+    a JIT-compiled loop over ring buffers held in NumPy arrays, with the
+    same stop rule as get_next_signature().
+
+    The backend is chosen at import (Numba when installed, unless the
+    SHAZAM_SIGNATURE_BACKEND environment variable says "python"), and can
+    be switched at runtime with set_backend(). Numba itself is only
+    imported, and the kernel compiled, when the first signature needs it. check_parity() compares both
+    backends on the same audio:
+
+        python -m custom_shazam_api.kernels [audio file]
+"""
+from importlib.util import find_spec
+from typing import Callable, Optional
+import threading
+import os
+
+import numpy as np
+
+NUMBA_INSTALLED = find_spec('numba') is not None
+
+BACKEND_PYTHON = 'python'
+BACKEND_NUMBA = 'numba'
+
+# Layout of the int64 state array shared with the kernel
+
+POSITION = 0 # Next slot of both ring buffers
+NUM_WRITTEN = 1 # FFT passes in the current signature
+NUMBER_SAMPLES = 2 # Samples in the current signature
+SIGNATURE_PEAKS = 3 # Peaks in the current signature
+
+MAX_PEAKS_PER_FRAME = 1005 # Bins 10 to 1014
+
+OTHER_OFFSETS = np.array([-53, -45, *range(165, 201, 7), *range(214, 250, 7)], dtype = np.int64)
+NEIGHBOR_OFFSETS = np.array([*range(-10, -3, 3), -3, 1, *range(2, 9, 3)], dtype = np.int64)
+
+
+def _process_frames(fft_results, fft_ring, spread_ring, state, max_time_seconds, max_peaks, stop_at_first_limit,
+                    peaks_out, other_offsets, neighbor_offsets):
+
+    """
+        Finish do_fft() (power spectrum) and run
+        do_peak_spreading_and_recognition() for each row of `fft_results`
+        while get_next_signature() would keep going (see
+        SignatureGenerator.wants_more_input()), appending (fft_number,
+        magnitude, corrected bin, band) rows to `peaks_out`. Return the
+        number of frames consumed and of peaks written.
+    """
+
+    consumed = 0
+    written = 0
+
+    while consumed < fft_results.shape[0]:
+
+        within_time = state[NUMBER_SAMPLES] / 16000. < max_time_seconds
+        within_peaks = state[SIGNATURE_PEAKS] < max_peaks
+        if not ((within_time and within_peaks) if stop_at_first_limit else (within_time or within_peaks)):
+            break
+        if written + MAX_PEAKS_PER_FRAME > peaks_out.shape[0]:
+            break
+
+        state[NUMBER_SAMPLES] += 128
+        position = state[POSITION]
+
+        for bin_position in range(1025):
+            value = fft_results[consumed, bin_position]
+            fft_ring[position, bin_position] = max((value.real ** 2 + value.imag ** 2) / (1 << 17), 0.0000000001)
+
+        # Frequency-domain then time-domain spreading
+
+        for bin_position in range(1025):
+
+            max_value = fft_ring[position, bin_position]
+            if bin_position < 1023:
+                max_value = max(max_value, fft_ring[position, bin_position + 1], fft_ring[position, bin_position + 2])
+            spread_ring[position, bin_position] = max_value
+
+            for former_fft_num in (-1, -3, -6):
+                former = (position + 256 + former_fft_num) % 256
+                if spread_ring[former, bin_position] > max_value:
+                    max_value = spread_ring[former, bin_position]
+                spread_ring[former, bin_position] = max_value
+
+        position = (position + 1) % 256
+        state[POSITION] = position
+        state[NUM_WRITTEN] += 1
+        consumed += 1
+
+        if state[NUM_WRITTEN] < 46:
+            continue
+
+        # Peak recognition on the FFT pass 45 frames back
+
+        fft_minus_46 = (position + 256 - 46) % 256
+        fft_minus_49 = (position + 256 - 49) % 256
+
+        for bin_position in range(10, 1015):
+
+            value = fft_ring[fft_minus_46, bin_position]
+
+            if value < 1 / 64 or value < spread_ring[fft_minus_49, bin_position - 1]:
+                continue
+
+            max_neighbor = 0.
+            for neighbor_offset in neighbor_offsets:
+                max_neighbor = max(spread_ring[fft_minus_49, bin_position + neighbor_offset], max_neighbor)
+
+            if value <= max_neighbor:
+                continue
+
+            for other_offset in other_offsets:
+                max_neighbor = max(spread_ring[(position + 256 + other_offset) % 256, bin_position - 1], max_neighbor)
+
+            if value <= max_neighbor:
+                continue
+
+            peak_magnitude = np.log(max(1 / 64, value)) * 1477.3 + 6144
+            peak_magnitude_before = np.log(max(1 / 64, fft_ring[fft_minus_46, bin_position - 1])) * 1477.3 + 6144
+            peak_magnitude_after = np.log(max(1 / 64, fft_ring[fft_minus_46, bin_position + 1])) * 1477.3 + 6144
+
+            peak_variation_1 = peak_magnitude * 2 - peak_magnitude_before - peak_magnitude_after
+            peak_variation_2 = (peak_magnitude_after - peak_magnitude_before) * 32 / peak_variation_1
+
+            corrected_peak_frequency_bin = bin_position * 64 + peak_variation_2
+
+            frequency_hz = corrected_peak_frequency_bin * (16000 / 2 / 1024 / 64)
+
+            if frequency_hz < 250:
+                continue
+            elif frequency_hz < 520:
+                band = 0
+            elif frequency_hz < 1450:
+                band = 1
+            elif frequency_hz < 3500:
+                band = 2
+            elif frequency_hz <= 5500:
+                band = 3
+            else:
+                continue
+
+            peaks_out[written, 0] = state[NUM_WRITTEN] - 46
+            peaks_out[written, 1] = int(peak_magnitude)
+            peaks_out[written, 2] = int(corrected_peak_frequency_bin)
+            peaks_out[written, 3] = band
+            written += 1
+            state[SIGNATURE_PEAKS] += 1
+
+    return consumed, written
+
+
+_compiled_kernel = None
+_compile_lock = threading.Lock()
+_backend = BACKEND_PYTHON
+
+
+def compiled_kernel() -> Optional[Callable]:
+
+    """The JIT-compiled _process_frames(), compiled (or loaded from Numba's cache) on first use"""
+
+    global _compiled_kernel, NUMBA_INSTALLED
+
+    with _compile_lock:
+
+        if _compiled_kernel is None and NUMBA_INSTALLED:
+            try:
+                import numba
+                _compiled_kernel = numba.njit(cache = True, nogil = True)(_process_frames)
+            except Exception as e:
+                print('Warning: Numba is unusable (%s), generating signatures in Python' % e)
+                NUMBA_INSTALLED = False
+                set_backend(BACKEND_PYTHON)
+
+        return _compiled_kernel
+
+
+def available_backends() -> list:
+
+    return [BACKEND_PYTHON] + ([BACKEND_NUMBA] if NUMBA_INSTALLED else [])
+
+
+def get_backend() -> str:
+
+    return _backend
+
+
+def set_backend(backend : str):
+
+    """Select the backend used by every SignatureGenerator of this process"""
+
+    global _backend
+
+    if backend not in available_backends():
+        raise ValueError('Signature backend %r is not available (have: %s)' % (backend, ', '.join(available_backends())))
+
+    _backend = backend
+
+
+_preferred = os.environ.get('SHAZAM_SIGNATURE_BACKEND', BACKEND_NUMBA)
+set_backend(_preferred if _preferred in available_backends() else BACKEND_PYTHON)
+
+
+def check_parity(s16le_mono_samples : Optional[np.ndarray] = None, seconds : float = 12.) -> dict:
+
+    """
+        Generate every signature of the audio (noise when none is given)
+        with each available backend; report whether they are identical and
+        the real-time factor of each.
+    """
+
+    import time
+    from .algorithm import SignatureGenerator
+
+    if s16le_mono_samples is None:
+        random = np.random.default_rng(0)
+        s16le_mono_samples = (random.standard_normal(int(seconds * 16000)) * 3000).astype(np.int16)
+
+    samples = s16le_mono_samples.tolist()
+    previous_backend = get_backend()
+    report = {'seconds': len(samples) / 16000, 'real_time_factor': {}}
+    outputs = {}
+
+    try:
+        for backend in available_backends():
+
+            set_backend(backend)
+
+            if backend != BACKEND_PYTHON: # Leave JIT compilation out of the timing
+                warm_up = SignatureGenerator()
+                warm_up.feed_input(samples[:16000])
+                warm_up.get_next_signature()
+
+            start = time.perf_counter()
+
+            signature_generator = SignatureGenerator()
+            signature_generator.feed_input(samples)
+            signatures = []
+            while True:
+                signature = signature_generator.get_next_signature()
+                if not signature:
+                    break
+                signatures.append(signature.encode_to_binary())
+
+            report['real_time_factor'][backend] = report['seconds'] / (time.perf_counter() - start)
+            outputs[backend] = signatures
+
+    finally:
+        set_backend(previous_backend)
+
+    reference = outputs[BACKEND_PYTHON]
+    report['signatures'] = len(reference)
+    report['identical'] = all(output == reference for output in outputs.values())
+
+    return report
+
+
+if __name__ == '__main__':
+
+    import sys
+
+    samples = None
+    if len(sys.argv) > 1:
+        from .api import Shazam
+        with open(sys.argv[1], 'rb') as audio_file:
+            song_data = audio_file.read()
+        samples = Shazam(song_data).normalizateAudioData(song_data)
+
+    report = check_parity(samples)
+
+    print('%d signatures over %.1f s of audio, backends identical: %s' % (report['signatures'], report['seconds'], report['identical']))
+    for backend, factor in report['real_time_factor'].items():
+        print('  %s: %.0fx real time' % (backend, factor))
@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+"""
+    Load generator for the recognition client stack, meant to run against
+    mock_server.py rather than the real endpoint.
+
+    N client threads recognize the given audio files in a loop, either
+    through the whole stack (decode, resample, signature, request) or by
+    re-sending precomputed signatures to isolate the request path, and the
+    run reports recognitions per second and latency percentiles.
+
+        python -m custom_shazam_api.loadtest --spawn-server --clients 16 --requests 500 sample.wav
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+import argparse
+import threading
+import asyncio
+import time
+
+import numpy as np
+
+from .api import Shazam
+from .matcher import LocalMatcher
+from .mock_server import MockShazamServer, add_audio_to_catalogue, mock_api_url
+
+MODE_FULL = 'full'
+MODE_REQUEST = 'request'
+MODE_SERVICE = 'service' # Upload the audio to a recognition service (service.py)
+
+
+def start_server_thread(server, host : str = '127.0.0.1', port : int = 0, name : str = 'mock-shazam-server') -> Tuple[str, int]:
+
+    """Run an asyncio server (anything with `await server.start(host, port)`) on a background event loop"""
+
+    started = threading.Event()
+    address = []
+
+    def run():
+        loop = asyncio.new_event_loop()
+        address.extend(loop.run_until_complete(server.start(host, port)))
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target = run, name = name, daemon = True).start()
+    started.wait()
+
+    return address[0], address[1]
+
+
+def start_mock_server_thread(server : MockShazamServer, host : str = '127.0.0.1', port : int = 0) -> str:
+
+    """Run a mock server on a background event loop, returning its api_url"""
+
+    return mock_api_url(*start_server_thread(server, host, port))
+
+
+def run_load_test(song_datas : List[bytes], api_url : str, clients : int = 8, total_requests : int = 100,
+                  mode : str = MODE_FULL, service_url : Optional[str] = None) -> dict:
+
+    """In service mode, requests go to the service at `service_url`, which forwards them to `api_url` itself"""
+
+    import requests
+
+    Shazam.api_url = api_url
+
+    # Precompute signatures up front in request mode, so only the request path is measured
+
+    signatures = []
+    if mode == MODE_REQUEST:
+        for song_data in song_datas:
+            shazam = Shazam(song_data)
+            signatures.append(shazam.createSignatureGenerator(shazam.normalizateAudioData(song_data)).get_next_signature())
+
+    latencies = []
+    outcomes = {'matched': 0, 'unmatched': 0}
+    lock = threading.Lock()
+    sessions = threading.local() # One keep-alive connection to the service per client
+
+    def one_request(number : int):
+
+        start = time.perf_counter()
+
+        try:
+            if mode == MODE_SERVICE:
+                if not hasattr(sessions, 'session'):
+                    sessions.session = requests.Session()
+                reply = sessions.session.post(service_url + '/recognize', data = song_datas[number % len(song_datas)],
+                                              headers = {'Content-Type': 'application/octet-stream'})
+                reply.raise_for_status()
+                response = reply.json()['response']
+            elif mode == MODE_REQUEST:
+                response = Shazam(b'').sendRecognizeRequest(signatures[number % len(signatures)])
+            else:
+                response = next(Shazam(song_datas[number % len(song_datas)]).recognizeSong())[1]
+            outcome = 'matched' if 'track' in response else 'unmatched'
+        except requests.HTTPError as e:
+            outcome = 'HTTP %d' % e.response.status_code
+        except Exception as e:
+            outcome = type(e).__name__
+
+        elapsed = time.perf_counter() - start
+
+        with lock:
+            latencies.append(elapsed)
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers = clients) as executor:
+        list(executor.map(one_request, range(total_requests)))
+
+    duration = time.perf_counter() - start
+    latencies_ms = np.array(latencies) * 1000
+
+    report = {
+        'mode': mode,
+        'clients': clients,
+        'requests': total_requests,
+        'duration_s': duration,
+        'recognitions_per_s': total_requests / duration,
+        'outcomes': outcomes,
+        'latency_ms': {
+            'p50': float(np.percentile(latencies_ms, 50)),
+            'p90': float(np.percentile(latencies_ms, 90)),
+            'p99': float(np.percentile(latencies_ms, 99)),
+            'max': float(latencies_ms.max()),
+        },
+    }
+
+    if mode == MODE_SERVICE:
+        report['service'] = requests.get(service_url + '/metrics').json()
+
+    return report
+
+
+def main(argv : Optional[List[str]] = None):
+
+    parser = argparse.ArgumentParser(description = 'Load test the recognition client against a mock Shazam server')
+    parser.add_argument('audio', nargs = '+', help = 'Audio files to recognize (any format libsndfile reads)')
+    parser.add_argument('--url', help = 'api_url of a running mock server (with two %%s)')
+    parser.add_argument('--service-url', help = 'Base URL of a running recognition service, in service mode')
+    parser.add_argument('--spawn-server', action = 'store_true', help = 'Run a mock server in-process, seeded with the audio files '
+                                                                         '(and a recognition service in front of it, in service mode)')
+    parser.add_argument('--clients', type = int, default = 8)
+    parser.add_argument('--requests', type = int, default = 100)
+    parser.add_argument('--mode', choices = (MODE_FULL, MODE_REQUEST, MODE_SERVICE), default = MODE_FULL)
+    parser.add_argument('--workers', type = int, help = 'Signature workers of the spawned service')
+    parser.add_argument('--connections', type = int, default = 8, help = 'Upstream connections of the spawned service')
+    parser.add_argument('--latency-ms', type = float, default = 0.)
+    parser.add_argument('--latency-jitter-ms', type = float, default = 0.)
+    parser.add_argument('--error-rate', type = float, default = 0.)
+    parser.add_argument('--rate-limit-rate', type = float, default = 0.)
+    args = parser.parse_args(argv)
+
+    song_datas = []
+    for path in args.audio:
+        with open(path, 'rb') as audio_file:
+            song_datas.append(audio_file.read())
+
+    api_url = args.url
+
+    if args.spawn_server or not api_url:
+        matcher = LocalMatcher()
+        for path, song_data in zip(args.audio, song_datas):
+            add_audio_to_catalogue(matcher, {'key': path, 'title': path, 'subtitle': 'Load test'}, song_data)
+        api_url = start_mock_server_thread(MockShazamServer(
+            matcher, latency_ms = args.latency_ms, latency_jitter_ms = args.latency_jitter_ms,
+            error_rate = args.error_rate, rate_limit_rate = args.rate_limit_rate
+        ))
+
+    service_url = args.service_url
+
+    if args.mode == MODE_SERVICE and (args.spawn_server or not service_url):
+        from .pool import RecognitionPool
+        from .service import RecognitionService
+        Shazam.api_url = api_url # Forwarded to by the service, from this process
+        service_url = 'http://%s:%d' % start_server_thread(
+            RecognitionService(RecognitionPool(args.workers), args.connections), name = 'recognition-service')
+
+    report = run_load_test(song_datas, api_url, args.clients, args.requests, args.mode, service_url)
+
+    print('%(requests)d %(mode)s recognitions with %(clients)d clients in %(duration_s).2f s: %(recognitions_per_s).1f/s' % report)
+    print('Latency (ms): p50 %(p50).1f, p90 %(p90).1f, p99 %(p99).1f, max %(max).1f' % report['latency_ms'])
+    print('Outcomes: %s' % ', '.join('%s %d' % item for item in sorted(report['outcomes'].items())))
+
+    if 'service' in report:
+        service = report['service']
+        print('Service: %(requests)d requests, %(signatures)d signatures, %(upstream_requests)d upstream requests, '
+              '%(shared)d answered from an identical request in flight, %(overloaded)d turned away' % service)
+        print('Service latency (ms): %s' % ', '.join('%s p50 %.1f p99 %.1f' % (stage, values['p50'], values['p99'])
+                                                     for stage, values in service['latency_ms'].items() if values))
+
+    return report
+
+
+if __name__ == '__main__':
+    main()
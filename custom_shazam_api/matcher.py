@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+"""
+    A small local matcher for signatures, answering with responses shaped
+    like Shazam's ("matches" plus "track" when something was found).
+
+    Peaks are paired into (frequency, frequency, time delta) landmarks, and
+    a query matches a reference track when enough of its landmarks agree on
+    the same time offset. It is nowhere near Shazam's catalogue, but it is
+    enough to test the client offline, or to replay archived signatures
+    against a handful of known tracks.
+"""
+from collections import defaultdict, Counter
+from typing import Dict, Iterator, List, Optional, Tuple
+import uuid
+
+from .signature_format import DecodedMessage
+
+FAN_OUT = 5 # Peaks paired with each anchor peak
+MAX_DELTA_FFT_PASSES = 64 # ~0.5 s at 128 samples per FFT pass
+FREQUENCY_QUANTIZATION = 128 # corrected_peak_frequency_bin units (64 per FFT bin)
+
+
+def iter_landmarks(signature : DecodedMessage) -> Iterator[Tuple[Tuple[int, int, int], int]]:
+
+    """Yield ((frequency 1, frequency 2, time delta), anchor fft_pass_number) pairs"""
+
+    peaks = sorted(
+        (peak.fft_pass_number, peak.corrected_peak_frequency_bin // FREQUENCY_QUANTIZATION)
+        for peaks in signature.frequency_band_to_sound_peaks.values()
+        for peak in peaks
+    )
+
+    for position, (anchor_time, anchor_frequency) in enumerate(peaks):
+
+        for other_time, other_frequency in peaks[position + 1:position + 1 + FAN_OUT]:
+
+            delta = other_time - anchor_time
+            if 0 < delta <= MAX_DELTA_FFT_PASSES:
+                yield (anchor_frequency, other_frequency, delta), anchor_time
+
+
+class LocalMatcher:
+
+    def __init__(self, min_aligned_landmarks : int = 8):
+
+        self.min_aligned_landmarks = min_aligned_landmarks
+        self.tracks : List[dict] = []
+        self._index : Dict[Tuple[int, int, int], List[Tuple[int, int]]] = defaultdict(list)
+
+    def add_track(self, track : dict, signature : DecodedMessage) -> int:
+
+        """Index a reference signature for a track (a Shazam-like "track" dict)"""
+
+        track_id = len(self.tracks)
+        self.tracks.append(track)
+
+        for landmark, anchor_time in iter_landmarks(signature):
+            self._index[landmark].append((track_id, anchor_time))
+
+        return track_id
+
+    def add_signature(self, track_id : int, signature : DecodedMessage):
+
+        """Index another signature (e.g. a later excerpt) of an existing track"""
+
+        for landmark, anchor_time in iter_landmarks(signature):
+            self._index[landmark].append((track_id, anchor_time))
+
+    def best_match(self, signature : DecodedMessage) -> Optional[Tuple[int, int, int]]:
+
+        """Return (track_id, offset in FFT passes, aligned landmarks) of the best match, or None"""
+
+        votes : Counter = Counter()
+
+        for landmark, query_time in iter_landmarks(signature):
+            for track_id, track_time in self._index.get(landmark, ()):
+                votes[track_id, track_time - query_time] += 1
+
+        if not votes:
+            return None
+
+        (track_id, offset), count = votes.most_common(1)[0]
+
+        if count < self.min_aligned_landmarks:
+            return None
+
+        return track_id, offset, count
+
+    def recognize(self, signature : DecodedMessage) -> dict:
+
+        """Answer like the Shazam endpoint would"""
+
+        response = {'tagid': str(uuid.uuid4()).upper(), 'matches': []}
+
+        match = self.best_match(signature)
+
+        if match is not None:
+            track_id, offset, count = match
+            track = self.tracks[track_id]
+            response['matches'].append({
+                'id': str(track.get('key', track_id)),
+                'offset': max(offset, 0) * 128 / signature.sample_rate_hz,
+                'score': count,
+            })
+            response['track'] = track
+
+        return response
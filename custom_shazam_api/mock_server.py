@@ -0,0 +1,259 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+"""
+    Local stand-in for the Shazam tag endpoint, for offline tests and load
+    tests of the client stack. Built on asyncio streams only.
+
+    Incoming signature URIs are decoded with DecodedMessage.decode_from_uri
+    and answered from a catalogue (see LocalMatcher), with configurable
+    latency, server errors and 429s.
+
+        python -m custom_shazam_api.mock_server --port 8765 --catalogue catalogue.json --error-rate 0.01
+
+    A catalogue is a JSON list of {"track": {...}, "audio": "file.wav"} or
+    {"track": {...}, "signature_uri": "data:audio/vnd.shazam.sig;base64,..."}
+    entries. With --match-any, any valid signature matches the first track.
+"""
+from typing import Callable, List, Optional, Tuple
+from urllib.parse import urlsplit
+import argparse
+import asyncio
+import random
+import json
+import time
+import os
+
+from .signature_format import DecodedMessage
+from .matcher import LocalMatcher
+from .parallel import generate_signature_parallel
+
+TAG_PATH_PREFIX = '/discovery/v5/'
+
+STATUS_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 409: 'Conflict',
+                  413: 'Payload Too Large', 415: 'Unsupported Media Type', 422: 'Unprocessable Entity', 429: 'Too Many Requests',
+                  500: 'Internal Server Error', 502: 'Bad Gateway', 503: 'Service Unavailable'}
+
+
+async def serve_http(reader : asyncio.StreamReader, writer : asyncio.StreamWriter, handle : Callable,
+                     max_body_bytes : Optional[int] = None):
+
+    """
+        Serve the HTTP/1.1 requests of one keep-alive connection, answering
+        each with the JSON of `await handle(method, target, headers, body)`,
+        which returns (status, payload, extra headers). Header names are
+        lowercased. Bodies over `max_body_bytes` are answered with a 413,
+        exceptions raised by `handle` with a 500.
+    """
+
+    try:
+        while True:
+
+            request_line = await reader.readline()
+            if not request_line:
+                break
+
+            method, target, version = request_line.decode('latin-1').split()
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, value = line.decode('latin-1').split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+
+            length = int(headers.get('content-length', 0))
+            too_large = max_body_bytes is not None and length > max_body_bytes
+
+            if too_large: # Not read: the connection is closed after the answer
+                status, payload, extra_headers = 413, {'error': 'body over %d bytes' % max_body_bytes}, {}
+            else:
+                body = await reader.readexactly(length)
+                try:
+                    status, payload, extra_headers = await handle(method, target, headers, body)
+                except Exception as e: # A bug in the handler: answer, and keep serving the connection
+                    print('Warning: %s %s failed: %s: %s' % (method, target, type(e).__name__, e))
+                    status, payload, extra_headers = 500, {'error': 'internal server error'}, {}
+
+            data = json.dumps(payload).encode('utf-8')
+            response_headers = {'Content-Type': 'application/json', 'Content-Length': str(len(data))}
+            response_headers.update(extra_headers)
+
+            writer.write(('HTTP/1.1 %d %s\r\n' % (status, STATUS_REASONS.get(status, ''))).encode('latin-1'))
+            writer.write(''.join('%s: %s\r\n' % item for item in response_headers.items()).encode('latin-1'))
+            writer.write(b'\r\n' + data)
+            await writer.drain()
+
+            if too_large or headers.get('connection', '').lower() == 'close':
+                break
+
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+
+    finally:
+        writer.close()
+
+
+def mock_api_url(host : str, port : int) -> str:
+
+    """A Shazam.api_url pointing at a mock server"""
+
+    return 'http://%s:%d%sen/US/iphone/-/tag/%%s/%%s?sync=true' % (host, port, TAG_PATH_PREFIX)
+
+
+def load_catalogue(path : str, matcher : LocalMatcher):
+
+    with open(path) as catalogue_file:
+        entries = json.load(catalogue_file)
+
+    for entry in entries:
+
+        if 'signature_uri' in entry:
+            matcher.add_track(entry['track'], DecodedMessage.decode_from_uri(entry['signature_uri']))
+            continue
+
+        audio_path = os.path.join(os.path.dirname(path), entry['audio'])
+        with open(audio_path, 'rb') as audio_file:
+            add_audio_to_catalogue(matcher, entry['track'], audio_file.read())
+
+
+def add_audio_to_catalogue(matcher : LocalMatcher, track : dict, song_data : bytes) -> int:
+
+    """Index the whole of an audio file, as one continuous signature, under one track"""
+
+    from .api import Shazam
+
+    return matcher.add_track(track, generate_signature_parallel(Shazam(song_data).normalizateAudioData(song_data)))
+
+
+def add_files_to_catalogue(matcher : LocalMatcher, paths : List[str]) -> LocalMatcher:
+
+    """Index audio files, each under a track named after it and shaped like Shazam's"""
+
+    for path in paths:
+        track = {
+            'title': os.path.splitext(os.path.basename(path))[0],
+            'subtitle': 'Local File',
+            'genres': {'primary': 'Test'},
+            'sections': [{'metapages': [{}, {'caption': 'Local Album'}]}],
+        }
+        with open(path, 'rb') as audio_file:
+            add_audio_to_catalogue(matcher, track, audio_file.read())
+
+    return matcher
+
+
+class MockShazamServer:
+
+    def __init__(self, matcher : Optional[LocalMatcher] = None, match_any : bool = False,
+                 latency_ms : float = 0., latency_jitter_ms : float = 0.,
+                 error_rate : float = 0., rate_limit_rate : float = 0., retry_after : int = 1):
+
+        self.matcher = matcher or LocalMatcher()
+        self.match_any = match_any
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.error_rate = error_rate # Share of requests answered with a 5xx
+        self.rate_limit_rate = rate_limit_rate # Share of requests answered with a 429
+        self.retry_after = retry_after
+
+        self.stats = {'requests': 0, 'matches': 0, 'no_matches': 0, 'errors': 0, 'rate_limited': 0, 'bad_requests': 0}
+        self._server : Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host : str = '127.0.0.1', port : int = 8765) -> Tuple[str, int]:
+
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def serve_forever(self):
+
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def stop(self):
+
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle_connection(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter):
+
+        await serve_http(reader, writer, lambda method, target, headers, body: self.handle_request(method, target, body))
+
+    async def handle_request(self, method : str, target : str, body : bytes) -> Tuple[int, dict, dict]:
+
+        path = urlsplit(target).path
+
+        if method == 'GET' and path == '/stats':
+            return 200, self.stats, {}
+
+        if method != 'POST' or not path.startswith(TAG_PATH_PREFIX):
+            return 404, {'error': 'not found'}, {}
+
+        self.stats['requests'] += 1
+
+        delay = self.latency_ms + random.uniform(-self.latency_jitter_ms, self.latency_jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+
+        draw = random.random()
+
+        if draw < self.rate_limit_rate:
+            self.stats['rate_limited'] += 1
+            return 429, {'error': 'too many requests'}, {'Retry-After': str(self.retry_after)}
+
+        if draw < self.rate_limit_rate + self.error_rate:
+            self.stats['errors'] += 1
+            return random.choice((500, 503)), {'error': 'injected failure'}, {}
+
+        try:
+            signature = DecodedMessage.decode_from_uri(json.loads(body)['signature']['uri'])
+        except Exception as e:
+            self.stats['bad_requests'] += 1
+            return 400, {'error': 'invalid signature: %s' % e}, {}
+
+        response = self.matcher.recognize(signature)
+
+        if 'track' not in response and self.match_any and self.matcher.tracks:
+            response['matches'].append({'id': str(self.matcher.tracks[0].get('key', 0)), 'offset': 0.})
+            response['track'] = self.matcher.tracks[0]
+
+        response['timestamp'] = int(time.time() * 1000)
+        self.stats['matches' if 'track' in response else 'no_matches'] += 1
+
+        return 200, response, {}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Local stand-in for the Shazam recognition endpoint')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8765)
+    parser.add_argument('--catalogue', help = 'JSON catalogue of tracks with reference audio or signatures')
+    parser.add_argument('--match-any', action = 'store_true', help = 'Answer every valid signature with the first track')
+    parser.add_argument('--latency-ms', type = float, default = 0.)
+    parser.add_argument('--latency-jitter-ms', type = float, default = 0.)
+    parser.add_argument('--error-rate', type = float, default = 0.)
+    parser.add_argument('--rate-limit-rate', type = float, default = 0.)
+    args = parser.parse_args()
+
+    matcher = LocalMatcher()
+    if args.catalogue:
+        load_catalogue(args.catalogue, matcher)
+
+    server = MockShazamServer(matcher, args.match_any, args.latency_ms, args.latency_jitter_ms,
+                              args.error_rate, args.rate_limit_rate)
+
+    async def run():
+        host, port = await server.start(args.host, args.port)
+        print('Mock Shazam server on %s (%d tracks)' % (mock_api_url(host, port), len(matcher.tracks)))
+        await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
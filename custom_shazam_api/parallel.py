@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+"""
+    Multi-core signature generation for long audio.
+
+    The audio is split into chunks of frames, processed in parallel by
+    worker processes reading the PCM from shared memory. Each chunk starts
+    WARMUP_FRAMES hops early, so the ring buffers hold the same samples and
+    spread frames as in a serial pass by the time its first own frame is
+    examined, and runs PEAK_DELAY hops past its end so its last frames get
+    their peaks. The peak lists are then concatenated in frame order.
+
+    The output is exactly the signature of a single SpectrogramSession (or
+    fresh SignatureGenerator) pass over the whole audio.
+"""
+from concurrent.futures import Executor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Optional
+import os
+
+import numpy as np
+
+from .spectrogram import SpectrogramSession, PEAK_DTYPE, PEAK_DELAY, HOP, FFT_SIZE, OTHER_FRAME_OFFSETS, peaks_to_signature
+from .signature_format import DecodedMessage
+
+# A peak of frame j compares against spread frames down to j - 45, each an
+# FFT over the 2048 samples (16 hops) before it; time spreading only looks
+# forward. Frames from j - 45 - 16 on must therefore see real audio.
+
+WARMUP_FRAMES = -min(OTHER_FRAME_OFFSETS) + FFT_SIZE // HOP + 3
+
+
+def _attach(name : str) -> shared_memory.SharedMemory:
+
+    # Pool workers share the resource tracker of the process that created
+    # the block, which unlinks it; Python 3.13+ can skip tracking entirely
+
+    try:
+        return shared_memory.SharedMemory(name = name, track = False)
+    except TypeError:
+        return shared_memory.SharedMemory(name = name)
+
+
+def chunk_peaks(memory_name : str, number_samples : int, first_frame : int, end_frame : int,
+                dtype = np.float64) -> np.ndarray:
+
+    """Peaks of frames [first_frame, end_frame) of the shared PCM, as a serial pass finds them"""
+
+    memory = _attach(memory_name)
+
+    try:
+        pcm = np.ndarray((number_samples,), dtype = np.int16, buffer = memory.buf)
+
+        warmup_frame = max(0, first_frame - WARMUP_FRAMES)
+        last_sample = min(number_samples, (end_frame + PEAK_DELAY) * HOP)
+
+        session = SpectrogramSession(dtype)
+        session.feed(pcm[warmup_frame * HOP:last_sample])
+
+        peaks = session.computed_peaks.copy()
+        del pcm
+
+    finally:
+        memory.close()
+
+    peaks['frame'] += warmup_frame
+
+    return peaks[(peaks['frame'] >= first_frame) & (peaks['frame'] < end_frame)]
+
+
+def generate_peaks_parallel(s16le_mono_samples : np.ndarray, executor : Optional[Executor] = None,
+                            max_workers : Optional[int] = None, chunk_seconds : float = 20.,
+                            dtype = np.float64) -> np.ndarray:
+
+    """Peak table (see spectrogram.PEAK_DTYPE) of the whole audio, computed in chunks across processes"""
+
+    samples = np.ascontiguousarray(s16le_mono_samples, dtype = np.int16)
+
+    total_frames = len(samples) // HOP
+    chunk_frames = max(int(chunk_seconds * 16000) // HOP, WARMUP_FRAMES)
+    bounds = [(start, min(start + chunk_frames, total_frames)) for start in range(0, total_frames, chunk_frames)]
+
+    if len(bounds) <= 1:
+        session = SpectrogramSession(dtype)
+        session.feed(samples)
+        return session.computed_peaks
+
+    memory = shared_memory.SharedMemory(create = True, size = max(1, samples.nbytes))
+    own_executor = executor is None
+
+    try:
+        np.ndarray(samples.shape, dtype = np.int16, buffer = memory.buf)[:] = samples
+
+        if own_executor:
+            from .pool import worker_context # Not forked from a multithreaded caller, see worker_context()
+            executor = ProcessPoolExecutor(max_workers = max_workers or min(len(bounds), os.cpu_count() or 1),
+                                           mp_context = worker_context())
+
+        futures = [executor.submit(chunk_peaks, memory.name, len(samples), start, end, dtype) for start, end in bounds]
+
+        return np.concatenate([future.result() for future in futures]) if futures else np.empty(0, dtype = PEAK_DTYPE)
+
+    finally:
+        if own_executor and executor is not None:
+            executor.shutdown()
+        memory.close()
+        memory.unlink()
+
+
+def generate_signature_parallel(s16le_mono_samples : np.ndarray, executor : Optional[Executor] = None,
+                                max_workers : Optional[int] = None, chunk_seconds : float = 20.,
+                                dtype = np.float64) -> DecodedMessage:
+
+    """Signature of the whole audio, identical to a serial pass, computed across processes"""
+
+    peaks = generate_peaks_parallel(s16le_mono_samples, executor, max_workers, chunk_seconds, dtype)
+
+    return peaks_to_signature(peaks, 0, len(s16le_mono_samples) // HOP * HOP)
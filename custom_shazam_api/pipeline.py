@@ -0,0 +1,264 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+"""
+    Bounded multi-stage pipeline (capture -> signature -> request -> UI in
+    Shazam Forever): when a stage is slow, work waits in short queues and
+    is dropped or merged there, instead of piling up without limit.
+
+    A Stage starts work on an item with `run(item)`, which returns a Future
+    (of an executor, of a thread, or completed by a UI handler). The result
+    of the Future goes on to the next stage, unless it is None. At most
+    `max_in_flight` items of a stage run at once, and at most one per key
+    when the stage has a `key` function. Items waiting for a slot are held
+    in a queue of at most `max_queued` items, and when it is full:
+
+        DROP_OLDEST: the oldest waiting item is dropped
+        DROP_NEWEST: the new item is dropped
+        COALESCE:    the new item replaces the waiting item with the same
+                     key, then the oldest one is dropped if still full
+
+    Each stage keeps metrics (queue depth and its peak, items in flight,
+    received, dropped, coalesced, completed and failed counts, average wait
+    and run times), see Pipeline.metrics().
+"""
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, List, Optional
+import threading
+import time
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+COALESCE = 'coalesce'
+
+
+def map_future(future : Future, function : Callable[[Any], Any]) -> Future:
+
+    """A Future of function(result of `future`), failing or cancelled like `future`"""
+
+    mapped = Future()
+
+    def done(source : Future):
+
+        if source.cancelled():
+            mapped.cancel()
+            return
+
+        try:
+            mapped.set_result(function(source.result()))
+        except Exception as e:
+            mapped.set_exception(e)
+
+    future.add_done_callback(done)
+
+    return mapped
+
+
+def completed_future(result : Any = None) -> Future:
+
+    future = Future()
+    future.set_result(result)
+
+    return future
+
+
+class Stage:
+
+    def __init__(self, name : str, run : Callable[[Any], Future], max_queued : int = 2, max_in_flight : int = 1,
+                 policy : str = DROP_OLDEST, key : Optional[Callable[[Any], Hashable]] = None):
+
+        if policy not in (DROP_OLDEST, DROP_NEWEST, COALESCE):
+            raise ValueError('Unknown queue policy: %r' % policy)
+        if policy == COALESCE and key is None:
+            raise ValueError('Stage %r coalesces items, so it needs a key function' % name)
+
+        self.name = name
+        self.run = run
+        self.max_queued = max_queued
+        self.max_in_flight = max_in_flight
+        self.policy = policy
+        self.key = key
+
+        self.queue : deque = deque() # (item, key, time queued)
+        self.in_flight = 0
+        self.keys_in_flight : set = set()
+
+        self.max_queued_seen = 0
+        self.counters : Dict[str, int] = dict.fromkeys(('received', 'dropped', 'coalesced', 'started', 'completed', 'failed'), 0)
+        self.wait_seconds = 0.
+        self.run_seconds = 0.
+
+    def metrics(self) -> dict:
+
+        finished = self.counters['completed'] + self.counters['failed']
+
+        return dict(
+            self.counters,
+            queued = len(self.queue),
+            max_queued_seen = self.max_queued_seen,
+            in_flight = self.in_flight,
+            average_wait_seconds = self.wait_seconds / self.counters['started'] if self.counters['started'] else 0.,
+            average_run_seconds = self.run_seconds / finished if finished else 0.,
+        )
+
+
+class Pipeline:
+
+    def __init__(self, stages : List[Stage], on_drop : Optional[Callable[[str, Any], None]] = None,
+                 on_error : Optional[Callable[[str, Any, BaseException], None]] = None):
+
+        self.stages = list(stages)
+        self.on_drop = on_drop # Called with (stage name, item) for each item dropped from a queue
+        self.on_error = on_error # Called with (stage name, item, exception) when a stage fails
+
+        self._index = {stage.name: index for index, stage in enumerate(self.stages)}
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def stage(self, name : str) -> Stage:
+
+        return self.stages[self._index[name]]
+
+    def put(self, item : Any, stage : Optional[str] = None) -> bool:
+
+        """
+            Submit an item to a stage (the first one by default), and return
+            whether it was accepted (started or queued) rather than dropped.
+            Callbacks, and `run` of the stages, may be called from any thread.
+        """
+
+        return self._put(self._index[stage] if stage is not None else 0, item)
+
+    def busy(self, *names : str) -> bool:
+
+        """Whether any item is queued or in flight in the given stages (all by default)"""
+
+        with self._lock:
+            return any(stage.queue or stage.in_flight for stage in self.stages if not names or stage.name in names)
+
+    def metrics(self) -> Dict[str, dict]:
+
+        with self._lock:
+            return {stage.name: stage.metrics() for stage in self.stages}
+
+    def describe(self) -> str:
+
+        return ', '.join(
+            '%s %d queued (peak %d) %d running %d dropped' % (
+                name, metrics['queued'], metrics['max_queued_seen'], metrics['in_flight'], metrics['dropped'])
+            for name, metrics in self.metrics().items()
+        )
+
+    def close(self):
+
+        """Refuse new items and forget queued ones; work in flight runs to completion"""
+
+        with self._lock:
+            self.closed = True
+            for stage in self.stages:
+                stage.queue.clear()
+
+    def _put(self, index : int, item : Any) -> bool:
+
+        stage = self.stages[index]
+        key = stage.key(item) if stage.key is not None else None
+        dropped = []
+
+        with self._lock:
+
+            if self.closed:
+                return False
+
+            stage.counters['received'] += 1
+
+            if stage.policy == COALESCE:
+                for position, (queued_item, queued_key, queued_at) in enumerate(stage.queue):
+                    if queued_key == key:
+                        del stage.queue[position]
+                        stage.counters['coalesced'] += 1
+                        dropped.append(queued_item)
+                        break
+
+            stage.queue.append((item, key, time.monotonic()))
+            started = self._take_startable(stage)
+
+            while len(stage.queue) > stage.max_queued:
+                dropped.append(stage.queue.pop()[0] if stage.policy == DROP_NEWEST else stage.queue.popleft()[0])
+                stage.counters['dropped'] += 1
+
+            stage.max_queued_seen = max(stage.max_queued_seen, len(stage.queue))
+            accepted = all(dropped_item is not item for dropped_item in dropped)
+
+        for dropped_item in dropped:
+            if self.on_drop is not None:
+                self.on_drop(stage.name, dropped_item)
+
+        self._start(index, started)
+
+        return accepted
+
+    def _take_startable(self, stage : Stage) -> list:
+
+        # Items that can start now, marked as in flight (called with the lock held)
+
+        started = []
+        position = 0
+
+        while stage.in_flight < stage.max_in_flight and position < len(stage.queue):
+
+            item, key, queued_at = stage.queue[position]
+
+            if key is not None and key in stage.keys_in_flight:
+                position += 1
+                continue
+
+            del stage.queue[position]
+            stage.in_flight += 1
+            if key is not None:
+                stage.keys_in_flight.add(key)
+            stage.counters['started'] += 1
+            stage.wait_seconds += time.monotonic() - queued_at
+            started.append((item, key))
+
+        return started
+
+    def _start(self, index : int, started : list):
+
+        stage = self.stages[index]
+
+        for item, key in started:
+
+            start_time = time.monotonic()
+
+            try:
+                future = stage.run(item)
+            except Exception as e:
+                future = Future()
+                future.set_exception(e)
+
+            future.add_done_callback(
+                lambda future, item = item, key = key, start_time = start_time: self._finish(index, item, key, start_time, future))
+
+    def _finish(self, index : int, item : Any, key : Optional[Hashable], start_time : float, future : Future):
+
+        stage = self.stages[index]
+        error = None if future.cancelled() else future.exception()
+
+        with self._lock:
+
+            stage.in_flight -= 1
+            stage.keys_in_flight.discard(key)
+            stage.run_seconds += time.monotonic() - start_time
+            stage.counters['failed' if future.cancelled() or error is not None else 'completed'] += 1
+
+            started = self._take_startable(stage)
+
+        if error is not None:
+            if self.on_error is not None:
+                self.on_error(stage.name, item, error)
+        elif not future.cancelled():
+            result = future.result()
+            if result is not None and index + 1 < len(self.stages):
+                self._put(index + 1, result)
+
+        self._start(index, started)
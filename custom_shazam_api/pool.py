@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+"""
+    A worker pool shared by every listening source of an application, so
+    that signature generation (CPU bound, pure Python) and the recognition
+    request run in parallel across cores instead of on the caller's thread.
+    They can be submitted together (submit()), or as two steps, signatures
+    in the workers and requests on threads (submit_signature() then
+    submit_request()), e.g. as stages of a pipeline (see pipeline.py).
+"""
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+from functools import partial
+import multiprocessing
+import queue
+import os
+
+from .algorithm import generator_pool
+from .api import Shazam, isConfidentMatch
+from .profiler import DEFAULT_PROFILE_DIR
+from .signature_format import DecodedMessage
+
+
+class RecognitionResult:
+
+    def __init__(self, offset : float, response : dict, signature : bytes):
+
+        self.offset = offset # Seconds of audio consumed, as yielded by Shazam.recognizeSong()
+        self.response = response # None until the signature is sent
+        self.signature = signature # Binary signature that was sent, for caching and archiving
+
+    def to_tuple(self) -> Tuple[float, dict]:
+
+        return self.offset, self.response
+
+
+def recognize_first(song_data : bytes, multi_resolution : bool = False) -> Optional[RecognitionResult]:
+
+    """Recognize the first signature of an audio file, or return None if it is too short"""
+
+    result = first_signature(song_data, multi_resolution)
+
+    if result is None or result.response is not None:
+        return result
+
+    return send_signature(result)
+
+
+def first_signature(song_data : bytes, multi_resolution : bool = False) -> Optional[RecognitionResult]:
+
+    """
+        Generate the first signature of an audio file (without a response
+        yet), or return None if it is too short. Racing several windows
+        needs their responses, so with `multi_resolution` the result is
+        already recognized.
+    """
+
+    if multi_resolution:
+        return recognize_multi_resolution(song_data)
+
+    shazam = Shazam(song_data)
+
+    with generator_pool.generator() as signature_generator: # Reused by the next recording of this worker
+
+        shazam.createSignatureGenerator(shazam.normalizateAudioData(song_data), signature_generator)
+
+        signature = signature_generator.get_next_signature()
+        offset = signature_generator.samples_processed / 16000
+
+    if not signature:
+        return None
+
+    return RecognitionResult(offset, None, signature.encode_to_binary())
+
+
+def send_signature(result : RecognitionResult) -> RecognitionResult:
+
+    """Send the signature of a result from first_signature(), filling in its response"""
+
+    result.response = Shazam(b'').sendRecognizeRequest(DecodedMessage.decode_from_binary(result.signature))
+
+    return result
+
+
+def recognize_multi_resolution(song_data : bytes) -> Optional[RecognitionResult]:
+
+    """Race several windows of an audio file, keeping the first confident match (or the last answer)"""
+
+    shazam = Shazam(song_data)
+    result = None
+
+    for offset, response in shazam.recognizeSongMultiResolution():
+        result = RecognitionResult(offset, response, shazam.lastSignature.encode_to_binary())
+        if isConfidentMatch(response):
+            break
+
+    return result
+
+
+def worker_context() -> multiprocessing.context.BaseContext:
+
+    """
+        How worker processes are started: by a fork server where there is
+        one, otherwise spawned, never forked from the caller. Pools are
+        started from multithreaded processes (Qt, the device watcher, the
+        cache writer...), and a child forked while one of those threads
+        holds a lock (generator_pool's, the allocator's, an IO buffer's)
+        would deadlock on it. Scripts using a pool need a __main__ guard.
+    """
+
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+    return multiprocessing.get_context(start_method)
+
+
+def init_worker(initializer : Optional[Callable] = None, profile_dir : str = DEFAULT_PROFILE_DIR,
+                pids : Optional['multiprocessing.Queue'] = None, owner_pid : Optional[int] = None):
+
+    """
+        Run first in each worker process: profiling on SIGUSR2 (see
+        profiler.py) as requested in `profile_dir` by the process owning the
+        pool, reporting this worker's pid to the pool through `pids`, then
+        the pool's initializer
+    """
+
+    from .profiler import install_signal_trigger, profile_as_worker
+
+    install_signal_trigger(partial(profile_as_worker, profile_dir, owner_pid))
+
+    if pids is not None:
+        pids.put(os.getpid())
+
+    if initializer is not None:
+        initializer()
+
+
+class RecognitionPool:
+
+    def __init__(self, max_workers : Optional[int] = None, use_processes : bool = True,
+                 initializer : Optional[Callable] = None, initargs : tuple = (), initkwargs : Optional[dict] = None,
+                 multi_resolution : bool = False, request_workers : int = 2, profile_dir : str = DEFAULT_PROFILE_DIR):
+
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.request_workers = request_workers # Threads sending the signatures of submit_request()
+        self.use_processes = use_processes
+        self.initializer = initializer # Run once in each worker, e.g. install_request_guard
+        self.initargs = initargs
+        self.initkwargs = initkwargs or {}
+        self.multi_resolution = multi_resolution # Race several window lengths/offsets per recording
+        self.profile_dir = profile_dir # Where workers look for profile requests (see capture_profile())
+        self._executor : Optional[Executor] = None
+        self._request_executor : Optional[Executor] = None
+        self._worker_pid_queue : Optional['multiprocessing.Queue'] = None # Filled by init_worker()
+        self._worker_pids : List[int] = []
+
+    def _get_executor(self) -> Executor:
+
+        # Created on first use, so that worker processes are only spawned
+        # once something is actually being recognized
+
+        if self._executor is None:
+            initializer = None
+            if self.initializer is not None:
+                initializer = partial(self.initializer, *self.initargs, **self.initkwargs)
+
+            if self.use_processes:
+                context = worker_context()
+                self._worker_pid_queue = context.Queue()
+                self._worker_pids = []
+                self._executor = ProcessPoolExecutor(max_workers = self.max_workers, mp_context = context,
+                                                     initializer = partial(init_worker, initializer, self.profile_dir,
+                                                                           self._worker_pid_queue, os.getpid()))
+            else:
+                # Threads share the process, so the initializer only needs to run once
+                if initializer is not None:
+                    initializer()
+                self._executor = ThreadPoolExecutor(max_workers = self.max_workers, thread_name_prefix = 'recognition')
+
+        return self._executor
+
+    def submit(self, song_data : bytes) -> Future:
+
+        """Recognize an audio file (any format libsndfile reads) in the pool"""
+
+        return self._get_executor().submit(recognize_first, song_data, self.multi_resolution)
+
+    def submit_signature(self, song_data : bytes) -> Future:
+
+        """Generate the first signature of an audio file in the pool (see first_signature())"""
+
+        return self._get_executor().submit(first_signature, song_data, self.multi_resolution)
+
+    def submit_request(self, result : RecognitionResult) -> Future:
+
+        """Send the signature of a submit_signature() result, on a thread of this process"""
+
+        if self._request_executor is None:
+            self._request_executor = ThreadPoolExecutor(max_workers = self.request_workers, thread_name_prefix = 'recognition-request')
+
+        return self._request_executor.submit(send_signature, result)
+
+    def worker_pids(self) -> List[int]:
+
+        """Process ids of the running workers (none with threads, or before anything was submitted)"""
+
+        if not self.use_processes or self._executor is None:
+            return []
+
+        while True: # As reported by init_worker(): ProcessPoolExecutor has no public accessor
+            try:
+                self._worker_pids.append(self._worker_pid_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return list(self._worker_pids)
+
+    def shutdown(self, wait : bool = False):
+
+        if self._executor is not None:
+            self._executor.shutdown(wait = wait, cancel_futures = True)
+            self._executor = None
+
+        if self._worker_pid_queue is not None:
+            self._worker_pid_queue.close()
+            self._worker_pid_queue = None
+            self._worker_pids = []
+
+        if self._request_executor is not None:
+            self._request_executor.shutdown(wait = wait, cancel_futures = True)
+            self._request_executor = None
@@ -0,0 +1,350 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+"""
+    On-demand sampling profiler for a running process and its recognition
+    workers. While a capture runs, a thread reads the Python stack of every
+    other thread (sys._current_frames()) every few milliseconds and counts
+    identical stacks. Nothing is hooked or traced, and when no capture
+    runs there is no thread and no cost: only a signal handler is set.
+
+    capture_profile() samples this process and, through SIGUSR2 (POSIX),
+    the given worker processes, whose signal handler (installed by
+    install_signal_trigger()) samples them for the same time and leaves
+    its stacks in a file for the parent to merge. Parent and workers only
+    exchange files in a directory of the user's (by default
+    ~/.shazam_profiles, created private), never in the shared temporary
+    directory, where another user could plant them. The result is written as:
+
+        <prefix>.collapsed.txt      "process;thread;outer;...;inner count" lines,
+                                    for flamegraph.pl, speedscope, inferno...
+        <prefix>.speedscope.json    one sampled profile per thread, for https://www.speedscope.app
+        <prefix>.top.txt            functions by self time, threads waiting on
+                                    locks, queues and sockets left out
+
+    A running process is profiled with `kill -USR2 <pid>` (the app, the
+    recognition service), the hidden "Profile" action of the app
+    (Ctrl+Shift+P), or POST /profile?seconds=N on the service.
+"""
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import threading
+import signal
+import json
+import time
+import sys
+import os
+
+DEFAULT_SECONDS = 10.
+DEFAULT_INTERVAL = 0.005 # Seconds between two samples
+WORKER_WAIT_SECONDS = 5. # How long the parent waits for late worker profiles
+
+DEFAULT_PROFILE_DIR = os.path.join(os.path.expanduser('~'), '.shazam_profiles')
+
+PROFILE_SIGNAL = getattr(signal, 'SIGUSR2', None) # None on Windows: only the calling process is profiled
+
+# Leaf frames of a thread that is blocked, not running: left out of the top functions
+IDLE_FRAMES = {
+    ('threading.py', 'wait'), ('threading.py', '_wait_for_tstate_lock'), ('threading.py', 'join'),
+    ('queue.py', 'get'), ('selectors.py', 'select'), ('connection.py', '_recv'), ('connection.py', '_poll'),
+    ('connection.py', 'wait'), ('socket.py', 'readinto'), ('socket.py', 'accept'), ('ssl.py', 'read'),
+    ('subprocess.py', '_try_wait'), ('base_events.py', '_run_once'), ('synchronize.py', '__enter__'),
+    ('thread.py', '_worker'), # ThreadPoolExecutor, in its (C) work queue's get()
+}
+
+Frame = Tuple[str, str, int] # (function, file, first line)
+
+
+class Profile:
+
+    """Counts of identical stacks, each keyed by (process label, thread label, frames outermost first)"""
+
+    def __init__(self, interval : float = DEFAULT_INTERVAL):
+
+        self.interval = interval
+        self.duration = 0.
+        self.samples : Counter = Counter()
+
+    def merge(self, other : 'Profile'):
+
+        self.samples.update(other.samples)
+        self.duration = max(self.duration, other.duration)
+
+    @property
+    def sample_count(self) -> int:
+
+        return sum(self.samples.values())
+
+    def to_dict(self) -> dict:
+
+        return {'interval': self.interval, 'duration': self.duration,
+                'samples': [[process, thread, [list(frame) for frame in frames], count]
+                            for (process, thread, frames), count in self.samples.items()]}
+
+    @classmethod
+    def from_dict(cls, data : dict) -> 'Profile':
+
+        profile = cls(data['interval'])
+        profile.duration = data['duration']
+        for process, thread, frames, count in data['samples']:
+            profile.samples[process, thread, tuple(tuple(frame) for frame in frames)] += count
+
+        return profile
+
+    def collapsed(self) -> str:
+
+        lines = []
+        for (process, thread, frames), count in sorted(self.samples.items()):
+            names = [process, thread] + ['%s (%s:%d)' % (name, os.path.basename(path), line) for name, path, line in frames]
+            lines.append('%s %d' % (';'.join(name.replace(';', ':') for name in names), count))
+
+        return '\n'.join(lines) + '\n'
+
+    def speedscope(self, name : str = 'profile') -> dict:
+
+        frames : List[dict] = []
+        frame_indexes : Dict[Frame, int] = {}
+        profiles : Dict[Tuple[str, str], dict] = {}
+
+        for (process, thread, stack), count in sorted(self.samples.items()):
+
+            indexes = []
+            for frame in stack:
+                if frame not in frame_indexes:
+                    frame_indexes[frame] = len(frames)
+                    frames.append({'name': frame[0], 'file': frame[1], 'line': frame[2]})
+                indexes.append(frame_indexes[frame])
+
+            thread_profile = profiles.setdefault((process, thread), {
+                'type': 'sampled', 'name': '%s %s' % (process, thread), 'unit': 'seconds',
+                'startValue': 0, 'endValue': 0, 'samples': [], 'weights': []})
+            thread_profile['samples'].append(indexes)
+            thread_profile['weights'].append(count * self.interval)
+            thread_profile['endValue'] += count * self.interval
+
+        return {'$schema': 'https://www.speedscope.app/file-format-schema.json', 'name': name,
+                'exporter': 'custom_shazam_api.profiler', 'shared': {'frames': frames},
+                'profiles': list(profiles.values())}
+
+    def top_functions(self, count : int = 30, include_idle : bool = False) -> List[Tuple[Frame, int, int]]:
+
+        """(frame, self samples, total samples) of the functions with the most self samples"""
+
+        self_samples : Counter = Counter()
+        total_samples : Counter = Counter()
+
+        for (process, thread, frames), samples in self.samples.items():
+            if not frames or (not include_idle and is_idle(frames[-1])):
+                continue
+            self_samples[frames[-1]] += samples
+            for frame in set(frames):
+                total_samples[frame] += samples
+
+        return [(frame, samples, total_samples[frame]) for frame, samples in self_samples.most_common(count)]
+
+    def format_top(self, count : int = 30) -> str:
+
+        total = self.sample_count
+        top = self.top_functions(count)
+        active = sum(samples for (process, thread, frames), samples in self.samples.items()
+                     if frames and not is_idle(frames[-1]))
+
+        lines = ['%d samples over %.1f s, every %.1f ms, of %d threads in %d processes; %d samples (%.0f%%) running, '
+                 'the others waiting' % (total, self.duration, self.interval * 1000,
+                                         len({key[:2] for key in self.samples}), len({key[0] for key in self.samples}),
+                                         active, 100. * active / total if total else 0.),
+                 '', 'Share of the running samples:', '', '  self %   total %   samples  function']
+
+        for (name, path, line), self_count, total_count in top:
+            lines.append('%7.1f%% %8.1f%% %9d  %s (%s:%d)' % (100. * self_count / active, 100. * total_count / active,
+                                                             self_count, name, path, line))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, prefix : str, name : Optional[str] = None) -> Dict[str, str]:
+
+        """Write the collapsed stacks, speedscope file and top functions, returning their paths"""
+
+        paths = {'collapsed': prefix + '.collapsed.txt', 'speedscope': prefix + '.speedscope.json', 'top': prefix + '.top.txt'}
+
+        with open(paths['collapsed'], 'w') as collapsed_file:
+            collapsed_file.write(self.collapsed())
+        with open(paths['speedscope'], 'w') as speedscope_file:
+            json.dump(self.speedscope(name or os.path.basename(prefix)), speedscope_file)
+        with open(paths['top'], 'w') as top_file:
+            top_file.write(self.format_top())
+
+        return paths
+
+
+def is_idle(frame : Frame) -> bool:
+
+    return (os.path.basename(frame[1]), frame[0].rpartition('.')[2]) in IDLE_FRAMES
+
+
+def thread_labels() -> Dict[int, str]:
+
+    return {thread.ident: thread.name for thread in threading.enumerate()}
+
+
+def sample_stacks(seconds : float, interval : float = DEFAULT_INTERVAL, process_label : Optional[str] = None,
+                  stop : Optional[threading.Event] = None) -> Profile:
+
+    """Sample the stacks of every other thread of this process, for `seconds` or until `stop` is set"""
+
+    process_label = process_label or 'process %d' % os.getpid()
+    profile = Profile(interval)
+    own_thread = threading.get_ident()
+    stop = stop or threading.Event()
+    code_frames : Dict[object, Frame] = {} # Code objects of the profile, named once
+    labels = thread_labels()
+
+    start = time.perf_counter()
+    next_sample = start
+
+    while True:
+
+        for thread_id, frame in sys._current_frames().items():
+
+            if thread_id == own_thread:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                named = code_frames.get(code)
+                if named is None:
+                    named = code_frames[code] = (getattr(code, 'co_qualname', code.co_name), code.co_filename, code.co_firstlineno)
+                stack.append(named)
+                frame = frame.f_back
+            stack.reverse()
+
+            if thread_id not in labels: # Started during the capture
+                labels = thread_labels()
+            profile.samples[process_label, labels.get(thread_id, 'thread %d' % thread_id), tuple(stack)] += 1
+
+        next_sample += interval
+        now = time.perf_counter()
+        if now - start >= seconds or stop.wait(max(0., next_sample - now)):
+            break
+
+    profile.duration = time.perf_counter() - start
+
+    return profile
+
+
+def request_path(request_dir : str, parent_pid : int) -> str:
+
+    """Where a parent leaves the capture settings for its workers to read when signaled"""
+
+    return os.path.join(request_dir, '.shazam-profile-request-%d.json' % parent_pid)
+
+
+def worker_profile_path(output_dir : str, parent_pid : int, pid : int) -> str:
+
+    return os.path.join(output_dir, '.shazam-profile-%d-worker-%d.json' % (parent_pid, pid))
+
+
+def profile_as_worker(request_dir : str = DEFAULT_PROFILE_DIR, parent_pid : Optional[int] = None):
+
+    """
+        Signal handler of worker processes: sample this process in the
+        background, as the process owning the pool (`parent_pid`, by
+        default the parent process) asked
+    """
+
+    parent_pid = parent_pid or os.getppid() # Not the pool's owner when started by a fork server
+
+    try:
+        with open(request_path(request_dir, parent_pid)) as request_file:
+            request = json.load(request_file)
+    except (OSError, ValueError):
+        request = {'seconds': DEFAULT_SECONDS, 'interval': DEFAULT_INTERVAL, 'output_dir': request_dir}
+
+    def run():
+        profile = sample_stacks(request['seconds'], request['interval'], 'worker %d' % os.getpid())
+        path = worker_profile_path(request['output_dir'], parent_pid, os.getpid())
+        with open(path + '.tmp', 'w') as profile_file:
+            json.dump(profile.to_dict(), profile_file)
+        os.replace(path + '.tmp', path) # Only seen by the parent once complete
+
+    threading.Thread(target = run, name = 'profiler', daemon = True).start()
+
+
+def install_signal_trigger(start : Callable[[], None] = profile_as_worker) -> bool:
+
+    """
+        Call `start` (from the main thread) when the process receives
+        SIGUSR2; by default, profile it as a worker. Returns False where
+        there is no such signal.
+    """
+
+    if PROFILE_SIGNAL is None:
+        return False
+
+    signal.signal(PROFILE_SIGNAL, lambda signum, frame: start())
+
+    return True
+
+
+def capture_profile(seconds : float = DEFAULT_SECONDS, prefix : Optional[str] = None,
+                    interval : float = DEFAULT_INTERVAL, worker_pids : Iterable[int] = (),
+                    process_label : str = 'main', request_dir : str = DEFAULT_PROFILE_DIR) -> Tuple[Profile, Dict[str, str]]:
+
+    """
+        Sample this process and its worker processes for `seconds`, merge
+        their stacks and write the result under `prefix` (by default in
+        DEFAULT_PROFILE_DIR). Workers read the request from `request_dir`,
+        the directory given to their profile_as_worker(). Blocks, so run it
+        on a thread of its own.
+    """
+
+    prefix = prefix or os.path.join(DEFAULT_PROFILE_DIR, 'shazam-profile-%s' % time.strftime('%Y%m%d-%H%M%S'))
+    output_dir = os.path.dirname(os.path.abspath(prefix))
+    os.makedirs(output_dir, mode = 0o700, exist_ok = True)
+
+    signaled = []
+
+    if PROFILE_SIGNAL is not None and worker_pids:
+
+        os.makedirs(request_dir, mode = 0o700, exist_ok = True)
+        path = request_path(request_dir, os.getpid())
+        with open(path + '.tmp', 'w') as request_file:
+            json.dump({'seconds': seconds, 'interval': interval, 'output_dir': output_dir}, request_file)
+        os.replace(path + '.tmp', path) # Never read half written
+
+        for pid in worker_pids:
+            try:
+                os.kill(pid, PROFILE_SIGNAL)
+                signaled.append(pid)
+            except OSError: # Exited since it was listed
+                pass
+
+    profile = sample_stacks(seconds, interval, process_label)
+
+    # Workers only answer between two bytecodes, so some start (and end) late
+
+    deadline = time.monotonic() + WORKER_WAIT_SECONDS
+    pending = {pid: worker_profile_path(output_dir, os.getpid(), pid) for pid in signaled}
+
+    while pending:
+        for pid, path in list(pending.items()):
+            if os.path.exists(path):
+                with open(path) as profile_file:
+                    profile.merge(Profile.from_dict(json.load(profile_file)))
+                os.remove(path)
+                del pending[pid]
+        if not pending or time.monotonic() > deadline:
+            break
+        time.sleep(0.05)
+
+    if pending:
+        print('Warning: no profile from worker(s) %s' % ', '.join(str(pid) for pid in pending))
+
+    if signaled:
+        try:
+            os.remove(request_path(request_dir, os.getpid()))
+        except OSError:
+            pass
+
+    return profile, profile.write(prefix)
+
@@ -0,0 +1,339 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+"""
+    Client-side protection of the Shazam endpoint: a token-bucket rate
+    limiter, a circuit breaker with half-open probing and jittered retries
+    on 429/5xx, with counters of what was throttled, retried or rejected.
+
+    State can live in memory (shared by the threads of one process) or in a
+    small JSON file guarded by an OS file lock, in which case every process
+    using the same file (e.g. RecognitionPool workers) shares one bucket,
+    one breaker and one set of metrics.
+"""
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, TYPE_CHECKING
+import threading
+import random
+import json
+import time
+
+if TYPE_CHECKING:
+    import requests
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+    import msvcrt
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+
+    """Raised instead of sending a request while the circuit breaker is open"""
+
+
+class RateLimitTimeout(Exception):
+
+    """Raised when no token could be acquired within the allowed wait"""
+
+
+class SharedState:
+
+    """A JSON dict shared between threads, and between processes when backed by a file"""
+
+    def __init__(self, path : Optional[str] = None):
+
+        self.path = path
+        self._lock = threading.RLock()
+        self._memory : Dict = {}
+
+    @contextmanager
+    def update(self):
+
+        """Yield the state dict for reading and modification, atomically"""
+
+        with self._lock:
+
+            if self.path is None:
+                yield self._memory
+                return
+
+            with open(self.path, 'a+') as state_file:
+
+                if fcntl is not None:
+                    fcntl.flock(state_file.fileno(), fcntl.LOCK_EX)
+                else:
+                    state_file.seek(0)
+                    msvcrt.locking(state_file.fileno(), msvcrt.LK_LOCK, 1)
+
+                try:
+                    state_file.seek(0)
+                    content = state_file.read()
+
+                    try:
+                        state = json.loads(content) if content else {}
+                    except ValueError:
+                        state = {}
+
+                    # Changes are written back even when the caller raises
+                    # (e.g. CircuitOpenError after updating the breaker)
+
+                    try:
+                        yield state
+                    finally:
+                        state_file.seek(0)
+                        state_file.truncate()
+                        state_file.write(json.dumps(state))
+                        state_file.flush()
+
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(state_file.fileno(), fcntl.LOCK_UN)
+                    else:
+                        state_file.seek(0)
+                        msvcrt.locking(state_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class TokenBucket:
+
+    def __init__(self, rate : float, capacity : float, state : Optional[SharedState] = None):
+
+        self.rate = rate # Tokens added per second
+        self.capacity = capacity # Maximum burst
+        self.state = state or SharedState()
+
+    def try_acquire(self) -> float:
+
+        """Take a token if one is available; return 0, or the seconds to wait for the next one"""
+
+        with self.state.update() as state:
+
+            now = time.time()
+            bucket = state.setdefault('bucket', {'tokens': self.capacity, 'updated': now})
+
+            tokens = min(self.capacity, bucket['tokens'] + (now - bucket['updated']) * self.rate)
+            bucket['updated'] = now
+
+            if tokens >= 1:
+                bucket['tokens'] = tokens - 1
+                return 0.
+
+            bucket['tokens'] = tokens
+            return (1 - tokens) / self.rate
+
+    def acquire(self, timeout : Optional[float] = None) -> float:
+
+        """Block until a token is available; return the time spent waiting"""
+
+        waited = 0.
+
+        while True:
+
+            wait = self.try_acquire()
+            if not wait:
+                return waited
+
+            if timeout is not None and waited + wait > timeout:
+                raise RateLimitTimeout('No request token available within %.1f s' % timeout)
+
+            time.sleep(wait)
+            waited += wait
+
+
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold : int = 5, recovery_timeout : float = 30.,
+                 half_open_max_calls : int = 1, state : Optional[SharedState] = None):
+
+        self.failure_threshold = failure_threshold # Consecutive failures that open the circuit
+        self.recovery_timeout = recovery_timeout # Seconds to stay open before probing again
+        self.half_open_max_calls = half_open_max_calls # Concurrent probes allowed while half-open
+        self.state = state or SharedState()
+
+    def _get(self, state : dict) -> dict:
+
+        return state.setdefault('breaker', {'state': CLOSED, 'failures': 0, 'changed': 0., 'probes': 0})
+
+    @property
+    def current_state(self) -> str:
+
+        with self.state.update() as state:
+            return self._get(state)['state']
+
+    def before_call(self):
+
+        """Raise CircuitOpenError unless a call may go through now"""
+
+        with self.state.update() as state:
+
+            breaker = self._get(state)
+            now = time.time()
+
+            if breaker['state'] == OPEN:
+                if now - breaker['changed'] < self.recovery_timeout:
+                    raise CircuitOpenError('Shazam circuit open, retrying in %.0f s' %
+                                           (self.recovery_timeout - (now - breaker['changed'])))
+                breaker.update(state = HALF_OPEN, changed = now, probes = 0)
+
+            if breaker['state'] == HALF_OPEN:
+                # A probe whose process died would otherwise keep the circuit half-open forever
+                if now - breaker['changed'] > self.recovery_timeout:
+                    breaker.update(changed = now, probes = 0)
+                if breaker['probes'] >= self.half_open_max_calls:
+                    raise CircuitOpenError('Shazam circuit half-open, waiting for the probe request')
+                breaker['probes'] += 1
+
+    def release_probe(self):
+
+        """Give back a half-open probe slot that ended up not being used"""
+
+        with self.state.update() as state:
+            breaker = self._get(state)
+            breaker['probes'] = max(0, breaker['probes'] - 1)
+
+    def record_success(self):
+
+        with self.state.update() as state:
+            self._get(state).update(state = CLOSED, failures = 0, changed = time.time(), probes = 0)
+
+    def record_failure(self):
+
+        with self.state.update() as state:
+
+            breaker = self._get(state)
+            breaker['failures'] += 1
+
+            if breaker['state'] == HALF_OPEN or breaker['failures'] >= self.failure_threshold:
+                breaker.update(state = OPEN, changed = time.time(), probes = 0)
+
+
+class RequestGuard:
+
+    """Rate limiting, circuit breaking and retries around a function sending an HTTP request"""
+
+    METRIC_NAMES = ('requests', 'successes', 'throttled', 'throttle_wait_seconds', 'rejected',
+                    'retries', 'failures', 'upstream_429', 'upstream_5xx')
+
+    def __init__(self, rate : float = 1., burst : float = 5., failure_threshold : int = 5,
+                 recovery_timeout : float = 30., max_retries : int = 2, retry_base_delay : float = 1.,
+                 retry_max_delay : float = 10., acquire_timeout : Optional[float] = 30.,
+                 state_path : Optional[str] = None):
+
+        self.state = SharedState(state_path)
+        self.bucket = TokenBucket(rate, burst, self.state)
+        self.breaker = CircuitBreaker(failure_threshold, recovery_timeout, state = self.state)
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.acquire_timeout = acquire_timeout
+
+    def _count(self, **increments):
+
+        with self.state.update() as state:
+            metrics = state.setdefault('metrics', {})
+            for name, value in increments.items():
+                metrics[name] = metrics.get(name, 0) + value
+
+    def metrics(self) -> dict:
+
+        """Counters since the state was created, plus the current breaker state"""
+
+        with self.state.update() as state:
+            metrics = dict.fromkeys(self.METRIC_NAMES, 0)
+            metrics.update(state.get('metrics', {}))
+            metrics['circuit'] = self.breaker._get(state)['state']
+            return metrics
+
+    def call(self, send : Callable[[], 'requests.Response']) -> 'requests.Response':
+
+        """Send a request through the guard, returning a successful response or raising"""
+
+        import requests
+
+        attempt = 0
+
+        while True:
+
+            # Retries belong to the call that was let through (and keep its half-open probe):
+            # they only stop if other calls have opened the circuit meanwhile
+
+            try:
+                if attempt == 0:
+                    self.breaker.before_call()
+                elif self.breaker.current_state == OPEN:
+                    raise CircuitOpenError('Shazam circuit opened by other requests while retrying')
+            except CircuitOpenError:
+                self._count(rejected = 1)
+                raise
+
+            try:
+                waited = self.bucket.acquire(self.acquire_timeout)
+            except RateLimitTimeout:
+                self._count(rejected = 1)
+                self.breaker.release_probe() # Nothing was sent
+                raise
+
+            if waited:
+                self._count(throttled = 1, throttle_wait_seconds = waited)
+
+            self._count(requests = 1)
+            retry_after = None
+
+            try:
+                response = send()
+            except (requests.ConnectionError, requests.Timeout):
+                response = None
+                if attempt >= self.max_retries:
+                    self._count(failures = 1)
+                    self.breaker.record_failure()
+                    raise
+
+            if response is not None:
+
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    self.breaker.record_success()
+                    response.raise_for_status()
+                    self._count(successes = 1)
+                    return response
+
+                if response.status_code == 429:
+                    self._count(upstream_429 = 1)
+                    retry_after = response.headers.get('Retry-After')
+                else:
+                    self._count(upstream_5xx = 1)
+
+                if attempt >= self.max_retries:
+                    self._count(failures = 1)
+                    self.breaker.record_failure()
+                    response.raise_for_status()
+
+            self._count(retries = 1) # A failure for the breaker only once the retries are exhausted
+
+            # Full jitter, unless the server said when to come back
+
+            delay = random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * (2 ** attempt)))
+            if retry_after is not None:
+                try:
+                    delay = max(delay, min(self.retry_max_delay, float(retry_after)))
+                except ValueError:
+                    pass
+
+            time.sleep(delay)
+            attempt += 1
+
+
+def install_request_guard(**guard_options) -> RequestGuard:
+
+    """Route every Shazam request of this process through a new RequestGuard"""
+
+    from .api import Shazam
+
+    Shazam.guard = RequestGuard(**guard_options)
+
+    return Shazam.guard
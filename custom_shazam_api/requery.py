@@ -0,0 +1,242 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+"""
+    Persistent retry queue for windows that Shazam did not identify.
+
+    Signatures of failed windows are kept on disk (surviving restarts),
+    deduplicated by a hash of their peaks, and retried in small batches with
+    exponential backoff by a dedicated, rate-limited worker pool. Retries
+    pause while live recognitions are in flight, so the queue never competes
+    with what is playing right now. Requests held back by the request guard
+    (circuit open, rate limit) are rescheduled without counting as attempts.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from base64 import b64decode, b64encode
+from typing import Callable, Dict, List, Optional
+from hashlib import sha1
+import threading
+import random
+import json
+import time
+import os
+
+from .ratelimit import CircuitOpenError, RateLimitTimeout
+from .signature_format import DecodedMessage
+from .api import isConfidentMatch
+
+
+def fingerprint_hash(signature : bytes) -> str:
+
+    """Hash of the peaks of a binary signature, ignoring its 48-byte header"""
+
+    return sha1(signature[48:]).hexdigest()
+
+
+class RequeryEntry:
+
+    def __init__(self, fingerprint : str, signature : bytes, created : float, source : str = '',
+                 context : Optional[dict] = None, attempts : int = 0, next_attempt : float = 0.):
+
+        self.fingerprint = fingerprint
+        self.signature = signature
+        self.created = created
+        self.source = source
+        self.context = context # Opaque data handed back on a late match (e.g. the original timestamp)
+        self.attempts = attempts
+        self.next_attempt = next_attempt
+
+    def to_json(self) -> dict:
+
+        return {
+            'fingerprint': self.fingerprint,
+            'signature': b64encode(self.signature).decode('ascii'),
+            'created': self.created,
+            'source': self.source,
+            'context': self.context,
+            'attempts': self.attempts,
+            'next_attempt': self.next_attempt,
+        }
+
+    @classmethod
+    def from_json(cls, data : dict):
+
+        return cls(data['fingerprint'], b64decode(data['signature']), data['created'], data.get('source', ''),
+                   data.get('context'), data.get('attempts', 0), data.get('next_attempt', 0.))
+
+
+class RequeryQueue:
+
+    def __init__(self, path : str, on_match : Callable[[RequeryEntry, dict], None],
+                 recognize : Optional[Callable[[DecodedMessage], dict]] = None,
+                 live_busy : Optional[Callable[[], bool]] = None,
+                 batch_size : int = 4, max_workers : int = 2, max_requests_per_minute : float = 6.,
+                 base_delay : float = 60., max_delay : float = 6 * 3600., max_attempts : int = 8,
+                 max_entries : int = 1000, poll_interval : float = 5.):
+
+        self.path = path
+        self.on_match = on_match # Called from a worker thread with (entry, response)
+        self.recognize = recognize
+        self.live_busy = live_busy # Retries are held back while this returns True
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.min_request_interval = 60. / max_requests_per_minute
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.max_entries = max_entries
+        self.poll_interval = poll_interval
+
+        self._lock = threading.Lock()
+        self._entries : Dict[str, RequeryEntry] = {}
+        self._in_flight = set()
+        self._next_request_time = 0.
+        self._stop_event = threading.Event()
+        self._thread : Optional[threading.Thread] = None
+        self._executor : Optional[ThreadPoolExecutor] = None
+
+        self._load()
+
+    def __len__(self) -> int:
+
+        return len(self._entries)
+
+    def add(self, signature : bytes, source : str = '', context : Optional[dict] = None) -> bool:
+
+        """Queue a signature for later retries, unless the same fingerprint is already queued"""
+
+        fingerprint = fingerprint_hash(signature)
+        now = time.time()
+
+        with self._lock:
+            if fingerprint in self._entries:
+                return False
+
+            self._entries[fingerprint] = RequeryEntry(fingerprint, signature, now, source, context,
+                                                      next_attempt = now + self._backoff(0))
+
+            # Drop the oldest entries beyond the size bound
+            while len(self._entries) > self.max_entries:
+                del self._entries[min(self._entries.values(), key = lambda entry: entry.created).fingerprint]
+
+        self._save()
+
+        return True
+
+    def start(self):
+
+        if self._thread is not None:
+            return
+
+        if self.recognize is None:
+            from .api import Shazam
+            self.recognize = Shazam(b'').sendRecognizeRequest
+
+        self._stop_event.clear()
+        self._executor = ThreadPoolExecutor(max_workers = self.max_workers, thread_name_prefix = 'requery')
+        self._thread = threading.Thread(target = self._run, name = 'requery-scheduler', daemon = True)
+        self._thread.start()
+
+    def stop(self):
+
+        self._stop_event.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if self._executor is not None:
+            self._executor.shutdown(wait = False, cancel_futures = True)
+            self._executor = None
+
+    def due_entries(self, now : Optional[float] = None) -> List[RequeryEntry]:
+
+        now = time.time() if now is None else now
+
+        with self._lock:
+            due = [entry for entry in self._entries.values()
+                   if entry.next_attempt <= now and entry.fingerprint not in self._in_flight]
+
+        return sorted(due, key = lambda entry: entry.next_attempt)[:self.batch_size]
+
+    def _run(self):
+
+        while not self._stop_event.wait(self.poll_interval):
+
+            if self.live_busy is not None and self.live_busy():
+                continue
+
+            for entry in self.due_entries():
+
+                # Rate limit: space requests out evenly across the batch
+
+                delay = self._next_request_time - time.time()
+                if delay > 0 and self._stop_event.wait(delay):
+                    return
+
+                self._next_request_time = time.time() + self.min_request_interval
+
+                with self._lock:
+                    self._in_flight.add(entry.fingerprint)
+
+                self._executor.submit(self._retry, entry)
+
+    def _retry(self, entry : RequeryEntry):
+
+        held_back = False
+
+        try:
+            response = self.recognize(DecodedMessage.decode_from_binary(entry.signature))
+        except (CircuitOpenError, RateLimitTimeout) as e: # Never sent: Shazam did not get to answer
+            print('Re-query of signature %s held back: %s' % (entry.fingerprint[:8], str(e) or type(e).__name__))
+            response = None
+            held_back = True
+        except Exception as e:
+            print('Error re-querying signature %s: %s' % (entry.fingerprint[:8], e))
+            response = None
+
+        matched = isinstance(response, dict) and isConfidentMatch(response)
+
+        with self._lock:
+            self._in_flight.discard(entry.fingerprint)
+
+            if held_back:
+                entry.next_attempt = time.time() + self._backoff(entry.attempts)
+            elif matched or entry.attempts + 1 >= self.max_attempts:
+                self._entries.pop(entry.fingerprint, None)
+            else:
+                entry.attempts += 1
+                entry.next_attempt = time.time() + self._backoff(entry.attempts)
+
+        self._save()
+
+        if matched:
+            self.on_match(entry, response)
+
+    def _backoff(self, attempts : int) -> float:
+
+        # Exponential backoff with jitter, so that entries queued together spread out
+
+        return min(self.max_delay, self.base_delay * (2 ** attempts)) * random.uniform(0.75, 1.25)
+
+    def _load(self):
+
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path) as queue_file:
+                for data in json.load(queue_file):
+                    entry = RequeryEntry.from_json(data)
+                    self._entries[entry.fingerprint] = entry
+        except (ValueError, KeyError) as e:
+            print('Ignoring corrupt re-query queue %s: %s' % (self.path, e))
+
+    def _save(self):
+
+        with self._lock:
+            data = [entry.to_json() for entry in self._entries.values()]
+
+            with open(self.path + '.tmp', 'w') as queue_file:
+                json.dump(data, queue_file)
+
+            os.replace(self.path + '.tmp', self.path)
@@ -0,0 +1,417 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+"""
+    Recognition over HTTP, for other programs than the desktop app. Built
+    on asyncio streams like mock_server.py:
+
+        POST /recognize     audio in, Shazam's answer out. The body is
+                            either an audio file (anything libsndfile or
+                            ffmpeg reads), raw s16le PCM (Content-Type
+                            audio/pcm, or ?rate=...&channels=...; 16 KHz
+                            mono by default), or JSON with a precomputed
+                            signature: {"signature_uri": "data:audio/vnd.shazam.sig;base64,..."}
+                            (or Shazam's own {"signature": {"uri": ...}})
+        GET  /health        200 while requests can go through, 503 while
+                            the circuit breaker is open
+        GET  /metrics       counters, latency percentiles, queue depths
+        POST /profile       samples the stacks of the service and its
+                            workers for ?seconds=N (10 by default), see
+                            profiler.py, and answers with the files
+                            written and the top functions
+
+    Signatures are generated in a RecognitionPool of worker processes and
+    sent from its request threads, through one pooled keep-alive session
+    (and the RequestGuard, if one is installed). Identical requests that
+    arrive while one is in flight wait for its answer instead of being
+    computed and sent again (single-flight), and when too many signatures
+    are waiting for a worker, new audio is turned away with a 503.
+
+        python -m custom_shazam_api.service --port 8080 --workers 4 --connections 8
+        python -m custom_shazam_api.loadtest --spawn-server --mode service --clients 32 --requests 500 song.wav
+"""
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from urllib.parse import urlsplit, parse_qs
+from functools import partial
+from io import BytesIO
+import argparse
+import asyncio
+import hashlib
+import wave
+import json
+import time
+import os
+
+import numpy as np
+
+from . import profiler
+from .api import Shazam, isConfidentMatch, pooled_session
+from .mock_server import serve_http
+from .pool import RecognitionPool, RecognitionResult
+from .ratelimit import OPEN, CircuitOpenError, RateLimitTimeout
+from .signature_format import DecodedMessage
+
+LATENCY_SAMPLES = 1000 # Recognitions kept for the latency percentiles of /metrics
+
+
+class ServiceError(Exception):
+
+    """A request that can't be served, answered with `status`"""
+
+    def __init__(self, status : int, message : str, headers : Optional[dict] = None):
+
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+class SingleFlight:
+
+    """Runs one coroutine per key at a time: callers with a key already in flight share its outcome"""
+
+    def __init__(self):
+
+        self._calls : Dict[str, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+
+        return len(self._calls)
+
+    async def do(self, key : str, work : Callable[[], Awaitable]) -> Tuple[object, bool]:
+
+        """(result of `work`, whether it was shared with an earlier caller)"""
+
+        task = self._calls.get(key)
+        shared = task is not None
+
+        if not shared:
+            task = asyncio.ensure_future(work())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._calls.pop(key, None))
+
+        # Shielded, so that a caller going away doesn't cancel the work of the others
+
+        return await asyncio.shield(task), shared
+
+
+def pcm_to_wav(pcm : bytes, samplerate : int, channels : int) -> bytes:
+
+    """Raw s16le PCM as a WAV file, what the signature workers read"""
+
+    if len(pcm) % (2 * channels):
+        raise ServiceError(400, 'PCM length is not a whole number of %d-channel s16le frames' % channels)
+
+    with BytesIO() as wav_data:
+        with wave.open(wav_data, 'wb') as wav_file:
+            wav_file.setnchannels(channels)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(samplerate)
+            wav_file.writeframes(pcm)
+        return wav_data.getvalue()
+
+
+def percentiles(values) -> dict:
+
+    if not values:
+        return {}
+
+    values = np.array(values) * 1000
+
+    return {'p50': float(np.percentile(values, 50)), 'p90': float(np.percentile(values, 90)),
+            'p99': float(np.percentile(values, 99)), 'max': float(values.max())}
+
+
+class RecognitionService:
+
+    def __init__(self, pool : Optional[RecognitionPool] = None, connections : int = 8,
+                 max_pending : Optional[int] = None, max_body_bytes : int = 50 * 1024 * 1024):
+
+        self.pool = pool or RecognitionPool(request_workers = connections)
+        self.pool.request_workers = connections # One request thread per upstream connection
+        self.connections = connections
+        self.max_pending = max_pending or 4 * self.pool.max_workers # Signatures waiting for a worker
+        self.max_body_bytes = max_body_bytes
+
+        self.single_flight = SingleFlight()
+        self.pending_signatures = 0
+        self.started = time.monotonic()
+
+        self.stats = {'requests': 0, 'recognitions': 0, 'shared': 0, 'signatures': 0, 'upstream_requests': 0,
+                      'matched': 0, 'unmatched': 0, 'too_short': 0, 'overloaded': 0, 'errors': 0}
+        self.status_counts : Dict[int, int] = {}
+        self.latencies = {stage: deque(maxlen = LATENCY_SAMPLES) for stage in ('total', 'signature', 'request')}
+
+        self.profile_dir = self.pool.profile_dir # Where POST /profile and SIGUSR2 write profiles
+        self.profiling = False
+
+        self._server : Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host : str = '127.0.0.1', port : int = 8080) -> Tuple[str, int]:
+
+        if Shazam.session is None:
+            Shazam.session = pooled_session(self.connections)
+
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def serve_forever(self):
+
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def stop(self):
+
+        self._server.close()
+        await self._server.wait_closed()
+        self.pool.shutdown()
+
+    async def _handle_connection(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter):
+
+        await serve_http(reader, writer, self.handle_request, self.max_body_bytes)
+
+    async def handle_request(self, method : str, target : str, headers : dict, body : bytes) -> Tuple[int, dict, dict]:
+
+        url = urlsplit(target)
+
+        if url.path == '/health':
+            status, payload, extra_headers = self.health()
+        elif url.path == '/metrics':
+            status, payload, extra_headers = 200, self.metrics(), {}
+        elif url.path == '/profile' and method == 'POST':
+            try:
+                status, payload, extra_headers = 200, await self.profile(parse_qs(url.query)), {}
+            except ServiceError as e:
+                status, payload, extra_headers = e.status, {'error': str(e)}, e.headers
+        elif url.path != '/recognize':
+            status, payload, extra_headers = 404, {'error': 'not found'}, {}
+        elif method != 'POST':
+            status, payload, extra_headers = 405, {'error': 'POST audio or a signature'}, {'Allow': 'POST'}
+        else:
+            try:
+                status, payload, extra_headers = 200, await self.recognize(headers, parse_qs(url.query), body), {}
+            except ServiceError as e:
+                status, payload, extra_headers = e.status, {'error': str(e)}, e.headers
+
+        self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+        return status, payload, extra_headers
+
+    async def recognize(self, headers : dict, query : dict, body : bytes) -> dict:
+
+        self.stats['requests'] += 1
+        start = time.perf_counter()
+
+        content_type, _, type_options = headers.get('content-type', '').partition(';')
+        content_type = content_type.strip().lower()
+
+        if content_type == 'application/json':
+            try:
+                request = json.loads(body)
+                uri = request['signature_uri'] if 'signature_uri' in request else request['signature']['uri']
+            except (ValueError, KeyError, TypeError):
+                uri = None
+            if not isinstance(uri, str):
+                raise ServiceError(400, 'expected {"signature_uri": "..."} or {"signature": {"uri": "..."}}')
+            key = hashlib.sha256(uri.encode('utf-8')).hexdigest()
+            work = lambda: self._recognize_signature(uri)
+
+        elif content_type == 'audio/pcm' or 'rate' in query or 'channels' in query:
+            options = dict(option.strip().split('=', 1) for option in type_options.split(';') if '=' in option)
+            options.update((name, values[-1]) for name, values in query.items())
+            try:
+                samplerate, channels = int(options.get('rate', 16000)), int(options.get('channels', 1))
+            except ValueError:
+                raise ServiceError(400, 'rate and channels must be integers')
+            if not (0 < samplerate <= 384000 and 0 < channels <= 32):
+                raise ServiceError(400, 'unsupported PCM format: %d Hz, %d channels' % (samplerate, channels))
+            key = hashlib.sha256(b'%d:%d:' % (samplerate, channels) + body).hexdigest()
+            work = lambda: self._recognize_audio(pcm_to_wav(body, samplerate, channels))
+
+        elif body:
+            key = hashlib.sha256(body).hexdigest()
+            work = lambda: self._recognize_audio(body)
+
+        else:
+            raise ServiceError(400, 'empty body')
+
+        result, shared = await self.single_flight.do(key, work)
+
+        self.stats['shared' if shared else 'recognitions'] += 1
+        elapsed = time.perf_counter() - start
+        self.latencies['total'].append(elapsed)
+
+        return dict(result, shared = shared, elapsed_ms = elapsed * 1000)
+
+    async def _recognize_audio(self, audio : bytes) -> dict:
+
+        if self.pending_signatures >= self.max_pending:
+            self.stats['overloaded'] += 1
+            raise ServiceError(503, 'too many recordings waiting for a signature worker', {'Retry-After': '1'})
+
+        self.pending_signatures += 1
+        start = time.perf_counter()
+
+        try:
+            result = await asyncio.wrap_future(self.pool.submit_signature(audio))
+        except Exception as e: # Unreadable audio, raised in the worker
+            self.stats['errors'] += 1
+            raise ServiceError(400, 'could not read the audio: %s' % e)
+        finally:
+            self.pending_signatures -= 1
+
+        self.stats['signatures'] += 1
+        signature_seconds = time.perf_counter() - start
+        self.latencies['signature'].append(signature_seconds)
+
+        if result is None:
+            self.stats['too_short'] += 1
+            raise ServiceError(422, 'the audio is too short for a signature')
+
+        return await self._send(result, signature_ms = signature_seconds * 1000)
+
+    async def _recognize_signature(self, uri : str) -> dict:
+
+        try:
+            signature = DecodedMessage.decode_from_uri(uri)
+        except Exception as e:
+            raise ServiceError(400, 'invalid signature: %s' % (str(e) or type(e).__name__))
+
+        return await self._send(RecognitionResult(signature.number_samples / signature.sample_rate_hz, None,
+                                                  signature.encode_to_binary()))
+
+    async def _send(self, result : RecognitionResult, **timings_ms) -> dict:
+
+        self.stats['upstream_requests'] += 1
+        start = time.perf_counter()
+
+        try:
+            result = await asyncio.wrap_future(self.pool.submit_request(result))
+        except (CircuitOpenError, RateLimitTimeout) as e:
+            self.stats['errors'] += 1
+            raise ServiceError(503, 'upstream unavailable: %s' % (str(e) or type(e).__name__), {'Retry-After': '5'})
+        except Exception as e:
+            self.stats['errors'] += 1
+            raise ServiceError(502, 'upstream request failed: %s' % e)
+
+        request_seconds = time.perf_counter() - start
+        self.latencies['request'].append(request_seconds)
+        timings_ms['request_ms'] = request_seconds * 1000
+
+        matched = isConfidentMatch(result.response)
+        self.stats['matched' if matched else 'unmatched'] += 1
+
+        return {'matched': matched, 'offset': result.offset, 'response': result.response, 'timings': timings_ms}
+
+    async def profile(self, query : dict) -> dict:
+
+        try:
+            seconds = float(query.get('seconds', [profiler.DEFAULT_SECONDS])[-1])
+        except ValueError:
+            raise ServiceError(400, 'seconds must be a number')
+        if not 0 < seconds <= 300:
+            raise ServiceError(400, 'profile for more than 0 and at most 300 seconds')
+        if self.profiling:
+            raise ServiceError(409, 'a profile is already being captured')
+
+        self.profiling = True
+
+        try:
+            prefix = os.path.join(self.profile_dir, 'service-profile-%s' % time.strftime('%Y%m%d-%H%M%S'))
+            profile, paths = await asyncio.get_running_loop().run_in_executor(
+                None, partial(profiler.capture_profile, seconds, prefix, worker_pids = self.pool.worker_pids(),
+                              process_label = 'service', request_dir = self.pool.profile_dir))
+        finally:
+            self.profiling = False
+
+        return {'files': paths, 'samples': profile.sample_count, 'top': [
+            {'function': name, 'file': path, 'line': line, 'self_samples': self_count, 'total_samples': total_count}
+            for (name, path, line), self_count, total_count in profile.top_functions(20)]}
+
+    def health(self) -> Tuple[int, dict, dict]:
+
+        circuit = Shazam.guard.breaker.current_state if Shazam.guard is not None else None
+        healthy = circuit != OPEN
+
+        return 200 if healthy else 503, {
+            'status': 'ok' if healthy else 'upstream circuit open',
+            'uptime_s': time.monotonic() - self.started,
+            'circuit': circuit,
+        }, {}
+
+    def metrics(self) -> dict:
+
+        metrics = dict(self.stats)
+        metrics.update({
+            'uptime_s': time.monotonic() - self.started,
+            'in_flight': len(self.single_flight),
+            'pending_signatures': self.pending_signatures,
+            'workers': self.pool.max_workers,
+            'connections': self.connections,
+            'status': {str(status): count for status, count in sorted(self.status_counts.items())},
+            'latency_ms': {stage: percentiles(values) for stage, values in self.latencies.items()},
+        })
+
+        if Shazam.guard is not None:
+            metrics['guard'] = Shazam.guard.metrics()
+
+        return metrics
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'HTTP recognition service: audio or signatures in, Shazam matches out')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8080)
+    parser.add_argument('--workers', type = int, help = 'Signature worker processes (default: one per CPU)')
+    parser.add_argument('--connections', type = int, default = 8, help = 'Upstream keep-alive connections and request threads')
+    parser.add_argument('--max-pending', type = int, help = 'Recordings waiting for a worker before answering 503 (default: 4 per worker)')
+    parser.add_argument('--max-upload-mb', type = float, default = 50.)
+    parser.add_argument('--upstream-url', help = 'Shazam.api_url to forward to (with two %%s), e.g. a mock server')
+    parser.add_argument('--stub', nargs = '+', metavar = 'AUDIO', help = 'Forward to an in-process mock server cataloguing these files')
+    parser.add_argument('--rate', type = float, help = 'Guard upstream requests: requests per second (see ratelimit.py)')
+    parser.add_argument('--burst', type = float, default = 5.)
+    args = parser.parse_args()
+
+    if args.stub:
+        from .loadtest import start_mock_server_thread
+        from .matcher import LocalMatcher
+        from .mock_server import MockShazamServer, add_files_to_catalogue
+        Shazam.api_url = start_mock_server_thread(MockShazamServer(add_files_to_catalogue(LocalMatcher(), args.stub)))
+    elif args.upstream_url:
+        Shazam.api_url = args.upstream_url
+
+    if args.rate:
+        from .ratelimit import install_request_guard
+        install_request_guard(rate = args.rate, burst = args.burst)
+
+    service = RecognitionService(RecognitionPool(args.workers), args.connections, args.max_pending,
+                                 int(args.max_upload_mb * 1024 * 1024))
+
+    async def profile_on_signal():
+        try:
+            report = await service.profile({})
+            print('Profile written to %s' % ', '.join(report['files'].values()))
+        except ServiceError as e:
+            print('Warning: %s' % e)
+
+    async def run():
+        host, port = await service.start(args.host, args.port)
+        if profiler.PROFILE_SIGNAL is not None: # `kill -USR2 <pid>` profiles the service and its workers
+            asyncio.get_running_loop().add_signal_handler(profiler.PROFILE_SIGNAL,
+                                                          lambda: asyncio.ensure_future(profile_on_signal()))
+        print('Recognition service on http://%s:%d/recognize (%d workers, %d upstream connections to %s)' % (
+            host, port, service.pool.max_workers, service.connections, urlsplit(Shazam.api_url).netloc))
+        try:
+            await service.serve_forever()
+        finally:
+            service.pool.shutdown()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,9 @@ setup(
         "pydub",
         "requests",
     ],
+    extras_require={
+        "fast": ["numba>=0.59"],
+    },
     author="Your Name",
     author_email="your.email@example.com",
     description="A modified version of ShazamAPI that defaults to English locale",
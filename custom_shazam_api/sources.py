@@ -0,0 +1,292 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+"""
+    Audio sources to capture from: the sound devices, through sounddevice,
+    or a file player that presents audio files as a virtual input device,
+    for reproducible end-to-end runs and benchmarks without a microphone.
+
+    A source lists its devices (dicts shaped like sounddevice's) and opens
+    callback streams on them, with the contract of sd.InputStream: the
+    callback receives (indata, frames, time_info, status) with float32
+    `indata` of shape (frames, channels), raises StopCapture to end the
+    stream, and `finished_callback` is called once the stream has ended.
+    Streams are context managers, closed when leaving the `with` block.
+
+    The file player plays its files one after the other, looping, either
+    paced in real time (from a clock started on the first stream, so time
+    goes by between recordings like on a radio) or as fast as possible
+    (each stream resuming where the last one stopped).
+
+    Signatures are computed from 16 KHz int16 mono audio: devices are
+    probed for a capture format, negotiate_capture_format() prefers that
+    one, and otherwise the lowest supported rate, which
+    to_signature_format() brings down to 16 KHz once the window has been
+    recorded (by averaging for integer ratios, otherwise linearly).
+"""
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional, Sequence
+import threading
+import time
+import os
+
+import numpy as np
+
+from .devices import enumerate_devices
+from .gate import to_mono_float
+
+FILE_PLAYER_NAME = 'File player'
+
+SIGNATURE_SAMPLE_RATE = 16000
+FALLBACK_SAMPLE_RATES = (22050, 24000, 32000, 44100, 48000, 88200, 96000) # Tried in order after 16 KHz
+
+
+class StopCapture(Exception):
+
+    """Raised by a stream callback to end the stream (like sounddevice.CallbackStop)"""
+
+
+class CaptureFormat:
+
+    def __init__(self, samplerate : int, dtype : str):
+
+        self.samplerate = samplerate
+        self.dtype = dtype # 'int16' or 'float32'
+
+    @property
+    def native(self) -> bool:
+
+        """Whether recordings are already in the signature format (no resampling or conversion)"""
+
+        return self.samplerate == SIGNATURE_SAMPLE_RATE and self.dtype == 'int16'
+
+    def __repr__(self) -> str:
+
+        return '%d Hz %s' % (self.samplerate, self.dtype)
+
+
+class AudioSource(ABC):
+
+    name = 'audio source'
+
+    @abstractmethod
+    def enumerate_devices(self, reinitialize : bool = False) -> List[dict]:
+
+        pass
+
+    def supports_input(self, device : int, samplerate : int, channels : int, dtype : str) -> bool:
+
+        return True
+
+    @abstractmethod
+    def open_stream(self, samplerate : int, channels : int, device : int, callback : Callable,
+                    finished_callback : Optional[Callable[[], None]] = None, dtype : str = 'float32'):
+
+        pass
+
+
+class SoundDeviceSource(AudioSource):
+
+    name = 'sound devices'
+
+    def enumerate_devices(self, reinitialize : bool = False) -> List[dict]:
+
+        return enumerate_devices(reinitialize)
+
+    def supports_input(self, device : int, samplerate : int, channels : int, dtype : str) -> bool:
+
+        import sounddevice as sd
+
+        try:
+            sd.check_input_settings(device = device, samplerate = samplerate, channels = channels, dtype = dtype)
+        except Exception:
+            return False
+
+        return True
+
+    def open_stream(self, samplerate : int, channels : int, device : int, callback : Callable,
+                    finished_callback : Optional[Callable[[], None]] = None, dtype : str = 'float32'):
+
+        import sounddevice as sd
+
+        def stream_callback(indata, frames, time_info, status):
+            try:
+                callback(indata, frames, time_info, status)
+            except StopCapture:
+                raise sd.CallbackStop()
+
+        return sd.InputStream(samplerate = samplerate, channels = channels, dtype = dtype, device = device,
+                              callback = stream_callback, finished_callback = finished_callback)
+
+
+class FilePlayerSource(AudioSource):
+
+    def __init__(self, paths : Sequence[str], realtime : bool = True, blocksize : int = 1024, channels : int = 2):
+
+        if not paths:
+            raise ValueError('The file player needs at least one file')
+
+        self.paths = list(paths)
+        self.realtime = realtime # Paced like a live input, otherwise as fast as possible
+        self.blocksize = blocksize
+        self.channels = channels
+
+        self._playlists : Dict[int, np.ndarray] = {} # Decoded files, by sample rate
+        self._lock = threading.Lock()
+        self._clock_start : Optional[float] = None # Real time mode: when playback started
+        self._position_seconds = 0. # Fast mode: where the last stream stopped
+
+    @property
+    def name(self) -> str:
+
+        return 'file player (%s, %s)' % (', '.join(os.path.basename(path) for path in self.paths),
+                                         'real time' if self.realtime else 'fast')
+
+    def enumerate_devices(self, reinitialize : bool = False) -> List[dict]:
+
+        return [{'name': FILE_PLAYER_NAME, 'index': 0, 'hostapi': 0, 'max_input_channels': self.channels,
+                 'max_output_channels': 0, 'default_samplerate': 44100.}]
+
+    def playlist(self, samplerate : int) -> np.ndarray:
+
+        """Every file, as mono float32 at the given sample rate, end to end"""
+
+        with self._lock:
+
+            if samplerate not in self._playlists:
+
+                import soundfile as sf
+
+                tracks = []
+                for path in self.paths:
+                    audio, file_samplerate = sf.read(path, dtype = 'float32', always_2d = True)
+                    audio = audio.mean(axis = 1)
+                    if file_samplerate != samplerate:
+                        length = int(len(audio) * samplerate / file_samplerate)
+                        audio = np.interp(np.arange(length) * file_samplerate / samplerate,
+                                          np.arange(len(audio)), audio).astype(np.float32)
+                    tracks.append(audio)
+
+                self._playlists[samplerate] = np.concatenate(tracks)
+
+            return self._playlists[samplerate]
+
+    def open_stream(self, samplerate : int, channels : int, device : int, callback : Callable,
+                    finished_callback : Optional[Callable[[], None]] = None, dtype : str = 'float32'):
+
+        if device != 0:
+            raise ValueError('The file player has a single device, not %r' % device)
+        if channels > self.channels:
+            raise ValueError('The file player has %d channels, not %d' % (self.channels, channels))
+
+        return FilePlayerStream(self, samplerate, channels, callback, finished_callback, dtype)
+
+    def _start_position(self) -> float:
+
+        with self._lock:
+            if not self.realtime:
+                return self._position_seconds
+            if self._clock_start is None:
+                self._clock_start = time.monotonic()
+            return time.monotonic() - self._clock_start
+
+    def _stopped_at(self, position_seconds : float):
+
+        with self._lock:
+            if not self.realtime:
+                self._position_seconds = position_seconds
+
+
+class FilePlayerStream:
+
+    """Stream of the file player, feeding its callback from a thread"""
+
+    def __init__(self, player : FilePlayerSource, samplerate : int, channels : int, callback : Callable,
+                 finished_callback : Optional[Callable[[], None]], dtype : str = 'float32'):
+
+        self.player = player
+        self.samplerate = samplerate
+        self.channels = channels
+        self.dtype = dtype
+        self.callback = callback
+        self.finished_callback = finished_callback
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target = self._run, name = 'file-player-stream', daemon = True)
+
+    def __enter__(self):
+
+        self._playlist = self.player.playlist(self.samplerate)
+        self._thread.start()
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+
+        playlist = self._playlist
+        frames = self.player.blocksize
+        position = int(self.player._start_position() * self.samplerate)
+        next_block_time = time.monotonic()
+
+        try:
+            while not self._stop.is_set():
+
+                if self.player.realtime: # A block is only delivered once it has been "heard"
+                    next_block_time += frames / self.samplerate
+                    if self._stop.wait(max(0., next_block_time - time.monotonic())):
+                        break
+
+                block = playlist[(position + np.arange(frames)) % len(playlist)]
+                if self.dtype == 'int16':
+                    block = (block * 32767).astype(np.int16)
+                position += frames # Delivered even if the callback stops the stream: the next one starts after it
+                self.callback(np.repeat(block[:, None], self.channels, axis = 1), frames, None, '')
+
+        except StopCapture:
+            pass
+        except Exception as e:
+            print('Warning: file player stream callback failed: %s' % e)
+        finally:
+            self.player._stopped_at(position / self.samplerate)
+            if self.finished_callback is not None:
+                self.finished_callback()
+
+
+def negotiate_capture_format(source : AudioSource, device : int, channels : int,
+                             default_samplerate : Optional[float] = None) -> CaptureFormat:
+
+    """
+        Best format to capture from a device: 16 KHz int16 when supported,
+        otherwise the lowest supported rate (int16 preferred), otherwise the
+        device's default rate in float32, left for PortAudio to refuse.
+    """
+
+    for samplerate in (SIGNATURE_SAMPLE_RATE,) + FALLBACK_SAMPLE_RATES:
+        for dtype in ('int16', 'float32'):
+            if source.supports_input(device, samplerate, channels, dtype):
+                return CaptureFormat(samplerate, dtype)
+
+    return CaptureFormat(int(default_samplerate or 44100), 'float32')
+
+
+def to_signature_format(samples : np.ndarray, samplerate : int) -> np.ndarray:
+
+    """Mono samples (float or int16) as 16 KHz int16, what signatures are computed from"""
+
+    if samplerate == SIGNATURE_SAMPLE_RATE and samples.dtype == np.int16:
+        return samples
+
+    samples = to_mono_float(samples)
+
+    if samplerate % SIGNATURE_SAMPLE_RATE == 0:
+        factor = samplerate // SIGNATURE_SAMPLE_RATE # Averaging filters out most of what would alias
+        samples = samples[:len(samples) // factor * factor].reshape(-1, factor).mean(axis = 1)
+    else:
+        from .api import resampleLinear
+        samples = resampleLinear(samples, int(len(samples) / samplerate * SIGNATURE_SAMPLE_RATE))
+
+    return (np.clip(samples, -1, 1) * 32767).astype(np.int16)
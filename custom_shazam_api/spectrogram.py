@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+#-*- encoding: Utf-8 -*-
+"""
+    Session-level spectrogram shared by signature extractors working on
+    overlapping windows of the same audio (sliding recognition, multi-offset
+    queries...).
+
+    Power spectrum frames, spread frames and detected peaks are computed
+    once per 128-sample hop, keyed by absolute sample index, and kept in
+    growable NumPy arrays. A signature for any window is then a slice of
+    the peak table, with no FFT recomputed.
+
+    The maths are those of SignatureGenerator (same window, FFT, frequency
+    and time spreading, peak tests and magnitude interpolation), applied as
+    one continuous pass: a window starting at sample 0 gives exactly the
+    signature of a fresh SignatureGenerator, while later windows see the
+    audio before them instead of a zeroed ring buffer (as in streaming).
+
+    With dtype = np.float32, PCM, window, FFT (single precision on NumPy 2,
+    cast down after it on older NumPy) and frame arrays take half the
+    memory; see accuracy.py for how the signatures compare.
+"""
+from typing import Optional
+
+import numpy as np
+
+from .algorithm import HANNING_MATRIX
+from .signature_format import DecodedMessage, FrequencyPeak, FrequencyBand
+
+HOP = 128
+FFT_SIZE = 2048
+BINS = 1025
+PEAK_DELAY = 45 # A frame's peaks are known once the frame 45 hops later has been spread
+SPREAD_PADDING = 64 # Zeroed spread frames before frame 0 (frames -6..-1 get time-spread into)
+
+# Frames (relative to the candidate) of the spread spectrum a peak is compared to
+
+NEIGHBOR_FRAME = -3
+NEIGHBOR_BIN_OFFSETS = (-10, -7, -4, -3, 1, 2, 5, 8)
+OTHER_FRAME_OFFSETS = (-7, 1, -45, -38, -31, -24, -17, -10, 4, 11, 18, 25, 32, 39)
+
+PEAK_DTYPE = np.dtype([
+    ('frame', np.int64),
+    ('band', np.int8),
+    ('magnitude', np.int32),
+    ('corrected_bin', np.int32),
+])
+
+BAND_LIMITS_HZ = (250, 520, 1450, 3500)
+BANDS = (FrequencyBand._250_520, FrequencyBand._520_1450, FrequencyBand._1450_3500, FrequencyBand._3500_5500)
+
+
+def frequency_spread(power : np.ndarray) -> np.ndarray:
+
+    """Frequency-domain spreading of (frames, 1025) power spectra"""
+
+    spread = power.copy()
+    spread[:, :1023] = np.maximum(np.maximum(power[:, :1023], power[:, 1:1024]), power[:, 2:1025])
+
+    return spread
+
+
+def detect_peaks(power : np.ndarray, spread : np.ndarray, frames : np.ndarray, spread_row_offset : int,
+                 power_row_offset : int) -> np.ndarray:
+
+    """
+        Vectorized do_peak_recognition() for the candidate frames `frames`
+        (absolute indexes), given the power and spread arrays and the
+        absolute frame index of their first rows (negated as row offsets).
+    """
+
+    if not len(frames):
+        return np.empty(0, dtype = PEAK_DTYPE)
+
+    candidate = power[frames + power_row_offset, 10:1015]
+    neighbors = spread[frames + NEIGHBOR_FRAME + spread_row_offset]
+
+    is_peak = (candidate >= 1 / 64) & (candidate >= neighbors[:, 9:1014])
+
+    max_neighbor = np.zeros_like(candidate)
+    for bin_offset in NEIGHBOR_BIN_OFFSETS:
+        np.maximum(max_neighbor, neighbors[:, 10 + bin_offset:1015 + bin_offset], out = max_neighbor)
+
+    is_peak &= candidate > max_neighbor
+
+    max_other = max_neighbor
+    for frame_offset in OTHER_FRAME_OFFSETS:
+        np.maximum(max_other, spread[frames + frame_offset + spread_row_offset, 9:1014], out = max_other)
+
+    is_peak &= candidate > max_other
+
+    rows, columns = np.nonzero(is_peak) # Row-major, so sorted by frame then bin like the original loop
+    bins = columns + 10
+    power_rows = frames[rows] + power_row_offset
+
+    peak_magnitude = np.log(np.maximum(1 / 64, power[power_rows, bins])) * 1477.3 + 6144
+    peak_magnitude_before = np.log(np.maximum(1 / 64, power[power_rows, bins - 1])) * 1477.3 + 6144
+    peak_magnitude_after = np.log(np.maximum(1 / 64, power[power_rows, bins + 1])) * 1477.3 + 6144
+
+    peak_variation_1 = peak_magnitude * 2 - peak_magnitude_before - peak_magnitude_after
+    peak_variation_2 = (peak_magnitude_after - peak_magnitude_before) * 32 / peak_variation_1
+
+    corrected_peak_frequency_bin = bins * 64 + peak_variation_2
+    frequency_hz = corrected_peak_frequency_bin * (16000 / 2 / 1024 / 64)
+
+    keep = (frequency_hz >= 250) & (frequency_hz <= 5500)
+
+    peaks = np.empty(np.count_nonzero(keep), dtype = PEAK_DTYPE)
+    peaks['frame'] = frames[rows][keep]
+    peaks['band'] = np.searchsorted(BAND_LIMITS_HZ, frequency_hz[keep], side = 'right') - 1
+    peaks['magnitude'] = np.trunc(peak_magnitude[keep])
+    peaks['corrected_bin'] = np.trunc(corrected_peak_frequency_bin[keep])
+
+    return peaks
+
+
+def peaks_to_signature(peaks : np.ndarray, first_frame : int, number_samples : int) -> DecodedMessage:
+
+    signature = DecodedMessage()
+    signature.sample_rate_hz = 16000
+    signature.number_samples = number_samples
+    signature.frequency_band_to_sound_peaks = {}
+
+    for band_index, band in enumerate(BANDS):
+
+        band_peaks = peaks[peaks['band'] == band_index]
+
+        if len(band_peaks):
+            signature.frequency_band_to_sound_peaks[band] = [
+                FrequencyPeak(int(frame) - first_frame, int(magnitude), int(corrected_bin), 16000)
+                for frame, magnitude, corrected_bin in zip(
+                    band_peaks['frame'].tolist(), band_peaks['magnitude'].tolist(), band_peaks['corrected_bin'].tolist()
+                )
+            ]
+
+    return signature
+
+
+class SpectrogramSession:
+
+    def __init__(self, dtype = np.float64):
+
+        self.dtype = dtype
+
+        self._window = HANNING_MATRIX.astype(dtype)
+        self._pcm = np.zeros(FFT_SIZE - HOP, dtype = dtype) # Zeroed history, like the initial ring buffer
+        self._pcm_start = -(FFT_SIZE - HOP) # Absolute sample index of self._pcm[0]
+        self.samples_fed = 0
+
+        self.first_frame = 0 # Absolute index of the oldest frame still held
+        self.frames_computed = 0
+        self._power = np.zeros((0, BINS), dtype = dtype)
+        self._spread = np.zeros((SPREAD_PADDING, BINS), dtype = dtype)
+
+        self.peaks_computed_until = 0 # Frames below this have had their peaks detected
+        self._peaks = np.empty(0, dtype = PEAK_DTYPE)
+
+    """
+        Append signed 16-bits 16 KHz mono samples, and compute every frame
+        (and every peak) that became available.
+    """
+
+    def feed(self, s16le_mono_samples):
+
+        samples = np.asarray(s16le_mono_samples, dtype = self.dtype)
+
+        self._pcm = np.concatenate((self._pcm, samples))
+        self.samples_fed += len(samples)
+
+        new_frames = self.samples_fed // HOP - self.frames_computed
+        if new_frames <= 0:
+            return
+
+        self._compute_frames(new_frames)
+        self._compute_peaks()
+
+    def _compute_frames(self, new_frames : int):
+
+        # Frame k is the FFT of the 2048 samples ending at sample (k + 1) * 128
+
+        first_sample = self.frames_computed * HOP - (FFT_SIZE - HOP) - self._pcm_start
+        excerpts = np.lib.stride_tricks.sliding_window_view(
+            self._pcm[first_sample:first_sample + (new_frames - 1) * HOP + FFT_SIZE], FFT_SIZE
+        )[::HOP]
+
+        fft_results = np.fft.rfft(self._window * excerpts, axis = 1)
+        power = (fft_results.real ** 2 + fft_results.imag ** 2).astype(self.dtype, copy = False) / self.dtype(1 << 17)
+        power = np.maximum(power, self.dtype(0.0000000001))
+
+        spread = frequency_spread(power)
+
+        # Time-domain spreading is a recurrence over frames: each new frame
+        # raises frames -1, -3 and -6 in a chain, as in do_peak_spreading()
+
+        start_row = len(self._spread)
+        self._spread = np.concatenate((self._spread, spread))
+
+        for row in range(start_row, len(self._spread)):
+            max_value = np.maximum(self._spread[row - 1], self._spread[row], out = self._spread[row - 1])
+            max_value = np.maximum(self._spread[row - 3], max_value, out = self._spread[row - 3])
+            np.maximum(self._spread[row - 6], max_value, out = self._spread[row - 6])
+
+        self._power = np.concatenate((self._power, power))
+        self.frames_computed += new_frames
+
+    def _compute_peaks(self):
+
+        last_frame = self.frames_computed - 1 - PEAK_DELAY
+
+        if last_frame < self.peaks_computed_until:
+            return
+
+        frames = np.arange(self.peaks_computed_until, last_frame + 1)
+        spread_row_offset = SPREAD_PADDING - self.first_frame
+
+        self._peaks = np.concatenate((
+            self._peaks,
+            detect_peaks(self._power, self._spread, frames, spread_row_offset, -self.first_frame)
+        ))
+
+        self.peaks_computed_until = last_frame + 1
+
+    def trim(self, before_sample : int):
+
+        """Drop audio, frames and peaks that windows starting at `before_sample` or later don't need"""
+
+        self._peaks = self._peaks[self._peaks['frame'] >= before_sample // HOP]
+
+        # Peak detection looks up to 45 spread frames back
+
+        keep_from_frame = min(before_sample // HOP, self.peaks_computed_until) - PEAK_DELAY - 8
+
+        if keep_from_frame <= self.first_frame: # Too early to drop frames, but not peaks
+            return
+
+        drop = keep_from_frame - self.first_frame
+
+        self._power = self._power[drop:]
+        self._spread = self._spread[drop:]
+        self.first_frame = keep_from_frame
+
+        keep_from_sample = self.first_frame * HOP - FFT_SIZE
+        if keep_from_sample > self._pcm_start:
+            self._pcm = self._pcm[keep_from_sample - self._pcm_start:]
+            self._pcm_start = keep_from_sample
+
+    @property
+    def computed_peaks(self) -> np.ndarray:
+
+        """Every peak detected so far (and not trimmed), ordered by frame"""
+
+        return self._peaks
+
+    def peaks(self, start_sample : int, end_sample : int) -> np.ndarray:
+
+        """Peaks of the window [start_sample, end_sample), as found by a generator fed that window"""
+
+        first_frame = start_sample // HOP
+        last_frame = first_frame + (end_sample - first_frame * HOP) // HOP - 1 - PEAK_DELAY
+
+        if last_frame >= self.peaks_computed_until:
+            raise ValueError('Window ends after the audio fed to the session')
+
+        frames = self._peaks['frame']
+
+        return self._peaks[np.searchsorted(frames, first_frame):np.searchsorted(frames, last_frame, side = 'right')]
+
+    def signature(self, start_sample : int = 0, end_sample : Optional[int] = None) -> DecodedMessage:
+
+        """Signature of a window (start aligned down to a 128-sample hop), without recomputing any FFT"""
+
+        if end_sample is None:
+            end_sample = self.samples_fed
+
+        start_sample -= start_sample % HOP
+        number_samples = (end_sample - start_sample) // HOP * HOP
+
+        return peaks_to_signature(self.peaks(start_sample, start_sample + number_samples), start_sample // HOP, number_samples)
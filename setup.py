@@ -11,6 +11,9 @@ setup(
         "numpy>=1.26.3",
         "soundfile>=0.12.1",
     ],
+    extras_require={
+        "fast": ["numba>=0.59"],
+    },
     entry_points={
         "console_scripts": [
             "shazam-forever=shazam_forever:main",
@@ -1,33 +1,56 @@
 import sys
-import asyncio
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QPushButton, QVBoxLayout, 
                           QWidget, QLabel, QTextEdit, QMessageBox, QComboBox, QHBoxLayout, QProgressBar,
-                          QListWidget, QListWidgetItem, QCheckBox)
+                          QListWidget, QListWidgetItem, QCheckBox, QListView, QFileDialog)
 from PyQt6.QtGui import QIcon, QAction, QPixmap, QPainter, QColor, QFont, QPainterPath
-from PyQt6.QtCore import QTimer, Qt, QSize, QThread, pyqtSignal, QUrl
-from PyQt6.QtNetwork import QNetworkAccessManager, QNetworkRequest
-from custom_shazam_api import Shazam
-import sounddevice as sd
+from PyQt6.QtCore import (QTimer, Qt, QSize, QThread, pyqtSignal, QUrl, QAbstractListModel, QModelIndex,
+                          QSocketNotifier)
+from custom_shazam_api.gate import ChangeGate, LevelMeter
+from custom_shazam_api.pool import RecognitionPool
+from custom_shazam_api.cache import RecordingCache
+from custom_shazam_api.archive import SignatureArchiveWriter
+from custom_shazam_api.requery import RequeryQueue
+from custom_shazam_api.ratelimit import CircuitOpenError, RateLimitTimeout, install_request_guard
+from custom_shazam_api.devices import DeviceRegistry, device_key
+from custom_shazam_api.sources import (FilePlayerSource, SoundDeviceSource, StopCapture, SIGNATURE_SAMPLE_RATE,
+                                       negotiate_capture_format, to_signature_format)
+from custom_shazam_api.pipeline import Pipeline, Stage, COALESCE, DROP_NEWEST, map_future, completed_future
+from custom_shazam_api import profiler
+from concurrent.futures import Future
+from collections import deque
 import numpy as np
-import soundfile as sf
 import tempfile
 import os
-import shutil
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
-import requests
 from io import BytesIO
-import webbrowser
 import re
 import time
-from pydub.utils import which
+import signal
+import socket
+import shutil
+import threading
+import multiprocessing
+import argparse
+
+# sounddevice (which initializes PortAudio), soundfile, requests, webbrowser
+# and QtNetwork are imported where first used, to keep startup fast
+
+# Audio devices are enumerated once, then kept current by the registry's
+# watcher instead of being queried on every recording cycle
+device_registry = DeviceRegistry()
 
-def check_microphone_permissions():
+def query_devices(refresh=False):
+    """Cached audio devices, enumerated again (re-initializing PortAudio) only when asked to refresh"""
+    if refresh:
+        device_registry.refresh(reinitialize=True)
+    return device_registry.devices()
+
+def check_microphone_permissions(refresh=False):
     """Check if we have permission to access the microphone"""
     try:
         # Try to get device info - this will fail if we don't have permission
-        devices = sd.query_devices()
-        print(f"Available audio devices: {devices}")
+        query_devices(refresh)
         return True
     except Exception as e:
         print(f"Error checking microphone permissions: {str(e)}")
@@ -44,64 +67,125 @@ def get_bundled_ffmpeg_path():
         ffprobe_path = os.path.join(bundle_dir, 'ffmpeg_binaries', 'ffprobe')
     else:
         # Running in normal Python environment
-        ffmpeg_path = which('ffmpeg')
-        ffprobe_path = which('ffprobe')
+        ffmpeg_path = shutil.which('ffmpeg')
+        ffprobe_path = shutil.which('ffprobe')
     
     return ffmpeg_path, ffprobe_path
 
-# Set up ffmpeg paths
-ffmpeg_path, ffprobe_path = get_bundled_ffmpeg_path()
-os.environ['PATH'] = os.path.dirname(ffmpeg_path) + os.pathsep + os.environ['PATH']
+def setup_ffmpeg_path():
+    """Put ffmpeg on PATH for the decoders that shell out to it (called from main, not at import)"""
+    ffmpeg_path, ffprobe_path = get_bundled_ffmpeg_path()
+    if ffmpeg_path:
+        os.environ['PATH'] = os.path.dirname(ffmpeg_path) + os.pathsep + os.environ['PATH']
+    else:
+        print("ffmpeg not found, only formats supported by libsndfile can be decoded")
+
+class ListeningSource:
+    """One monitored input: a device, optionally narrowed down to a single channel"""
+    def __init__(self, device, device_id, channel=None, max_history_size=10):
+        self.device = device  # sounddevice index
+        self.device_id = device_id  # (name, host API, ordinal among identical devices), see devices.device_ids()
+        self.device_name = device_id[0]
+        self.channel = channel  # Zero-based channel, or None to downmix every captured channel
+        self.gate = ChangeGate()
+        
+        # Per-source history, used to avoid re-adding the song that is still playing in this room
+        self.song_history = []
+        self.max_history_size = max_history_size
+        self.last_song = None
+        self.last_song_time = None
+        
+    @property
+    def device_label(self):
+        # Identical devices (several "USB Audio Device" units) are numbered from the second one on
+        name, hostapi, ordinal = self.device_id
+        return name if ordinal == 0 else f"{name} #{ordinal + 1}"
+    
+    @property
+    def source_id(self):
+        # By device id, not index: PortAudio renumbers devices when others come and go
+        return f"{self.device_label}@{self.device_id[1]}:{'mix' if self.channel is None else self.channel}"
+    
+    @property
+    def label(self):
+        if self.channel is None:
+            return self.device_label
+        return f"{self.device_label} - Channel {self.channel + 1}"
+    
+    def add_to_history(self, song_entry):
+        position = 0
+        while position < len(self.song_history) and self.song_history[position]['timestamp'] > song_entry['timestamp']:
+            position += 1
+        self.song_history.insert(position, song_entry)
+        if len(self.song_history) > self.max_history_size:
+            self.song_history.pop()
 
 class AudioRecorderThread(QThread):
-    finished = pyqtSignal(object)  # Signal to emit when recording is done
+    finished = pyqtSignal(object)  # Signal to emit when recording is done, with (source_id, temp_file_path, stage times)
     error = pyqtSignal(str)  # Signal to emit when an error occurs
-    volume = pyqtSignal(float)  # Signal to emit current audio volume
+    volume = pyqtSignal(str, float)  # Signal to emit current audio volume of a source
+    skipped = pyqtSignal(str, str)  # Signal to emit when the change gate skips a source's recording
     
-    def __init__(self, device, sample_rate, channels, record_seconds):
+    def __init__(self, device, sample_rate, channels, record_seconds, sources=(), audio_source=None, dtype='float32'):
         super().__init__()
+        self.audio_source = audio_source or SoundDeviceSource()  # Sound devices, or e.g. a file player
+        self.times = {'capture': time.monotonic()}  # When each pipeline stage finished, for latency breakdowns
         self.device = device
         self.sample_rate = sample_rate
+        self.dtype = dtype  # Capture sample format, 'int16' or 'float32'
         self.channels = channels
         self.record_seconds = record_seconds
+        self.sources = list(sources)  # ListeningSource objects fed from this device's single stream
         self.is_recording = False
         self.max_retries = 3
         self.retry_delay = 1  # seconds
+        self.completion = Future()  # Done when the thread ends, freeing the device in the capture stage
         
     def run(self):
+        try:
+            self.record()
+        finally:
+            self.completion.set_result(None)
+        
+    def record(self):
         retry_count = 0
         while retry_count < self.max_retries:
             try:
-                if not check_microphone_permissions():
-                    self.error.emit("Microphone permission denied. Please grant microphone access in System Preferences.")
-                    return
-                
                 print(f"Starting recording with device: {self.device}, sample rate: {self.sample_rate}, channels: {self.channels}")
                 self.is_recording = True
                 
-                # Record audio
-                recording = sd.rec(
-                    int(self.record_seconds * self.sample_rate),
-                    samplerate=self.sample_rate,
-                    channels=self.channels,
-                    dtype=np.float32,
-                    device=self.device
-                )
-                
-                # Simple volume monitoring - just emit a fixed value
-                # This avoids the callback stream error
-                self.volume.emit(0.5)  # Medium volume indicator
-                
-                sd.wait()  # Wait until recording is finished
+                # Record audio through a callback stream so levels can be metered as they arrive
+                recording = self.record_with_meter()
                 self.is_recording = False
+                for source in self.sources:
+                    self.volume.emit(source.source_id, 0.0)  # Nothing is being captured until the next window
+                
+                if recording is None:
+                    print("Recording stopped before completion")
+                    return
                 
                 print(f"Recording completed, shape: {recording.shape}")
+                self.times['recorded'] = time.monotonic()
                 
-                # Save the recording to a temporary file
-                with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as temp_file:
-                    sf.write(temp_file.name, recording, self.sample_rate)
-                    print(f"Saved recording to: {temp_file.name}")
-                    self.finished.emit(temp_file.name)
+                for source in self.sources:
+                    source_recording = self.source_samples(recording, source)
+                    meter = self.meters[source.source_id]
+                    
+                    # Skip silent, too quiet or unchanged windows before paying for a signature
+                    decision = source.gate.check_levels(source_recording, self.sample_rate,
+                                                        meter.rms_dbfs, meter.peak_dbfs)
+                    print(f"Change gate ({source.label}): {decision.describe()}")
+                    if not decision.should_recognize:
+                        self.skipped.emit(source.source_id, decision.describe())
+                        continue
+                    
+                    # Save the recording to a temporary file, as the 16kHz int16 signatures are computed from
+                    import soundfile as sf
+                    source_recording = to_signature_format(source_recording, self.sample_rate)
+                    with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as temp_file:
+                        sf.write(temp_file.name, source_recording, SIGNATURE_SAMPLE_RATE)
+                        print(f"Saved recording to: {temp_file.name}")
+                        self.finished.emit((source.source_id, temp_file.name, dict(self.times)))
                 return  # Success, exit the retry loop
                     
             except Exception as e:
@@ -126,32 +210,271 @@ class AudioRecorderThread(QThread):
                 self.is_recording = False
                 return
             
+    def record_with_meter(self):
+        """Record one window, metering block RMS/peak in the capture callback"""
+        total_frames = int(self.record_seconds * self.sample_rate)
+        recording = np.zeros((total_frames, self.channels), dtype=self.dtype)
+        position = 0
+        done = threading.Event()
+        
+        # One meter per source; level updates are decimated to ~20 Hz before
+        # crossing over to the UI thread
+        self.meters = {
+            source.source_id: LevelMeter(
+                self.sample_rate,
+                on_level=lambda rms, peak, source_id=source.source_id: self.volume.emit(source_id, rms)
+            )
+            for source in self.sources
+        }
+        metered_sources = [(self.meters[source.source_id], source.channel) for source in self.sources]
+        
+        def callback(indata, frames, time_info, status):
+            nonlocal position
+            if status:
+                print(f"Recording stream status: {status}")
+            count = min(frames, total_frames - position)
+            recording[position:position + count] = indata[:count]
+            for meter, channel in metered_sources:
+                meter.process(indata[:count] if channel is None else indata[:count, channel])
+            position += count
+            if position >= total_frames or not self.is_recording:
+                raise StopCapture()
+        
+        # The device watcher doesn't re-initialize PortAudio while the stream is open
+        with device_registry.stream_open(), \
+             self.audio_source.open_stream(self.sample_rate, self.channels, self.device, callback,
+                                           finished_callback=done.set, dtype=self.dtype):
+            if not done.wait(self.record_seconds + 5):
+                raise Exception("Recording timeout: no audio received from the device")
+        
+        if position < total_frames:
+            return None
+        return recording
+    
+    def source_samples(self, recording, source):
+        """Extract a source's mono samples from the device's multichannel recording"""
+        if source.channel is not None:
+            return recording[:, source.channel]
+        if recording.shape[1] == 1:
+            return recording[:, 0]
+        return recording.mean(axis=1, dtype=np.float32).astype(recording.dtype)
+            
     def stop(self):
         self.is_recording = False
 
+def format_history_entry(song):
+    """Display text of a history entry, formatted once when it enters the history model"""
+    timestamp = song.get('timestamp') or ''
+    # Timestamps are YYYYMMDD_HHMMSS: slice them rather than parsing each one
+    if len(timestamp) == 15 and timestamp[8] == '_' and (timestamp[:8] + timestamp[9:]).isdigit():
+        time_str = f"{timestamp[:4]}-{timestamp[4:6]}-{timestamp[6:8]} {timestamp[9:11]}:{timestamp[11:13]}:{timestamp[13:]}"
+    else:
+        time_str = "Unknown time"
+    display_text = f"{song['title']} by {song['artist']} ({time_str})"
+    if song.get('source'):
+        display_text = f"[{song['source']}] {display_text}"
+    return display_text
+
+class HistoryModel(QAbstractListModel):
+    """Songs identified, newest first, shown in batches as the view scrolls down
+    
+    Adding a song inserts a single row. Older days are read through `load_older`
+    (returning the songs of the previous day with a history, or None when there
+    are no more) once every loaded song has been shown.
+    """
+    def __init__(self, load_older=None, batch_size=100):
+        super().__init__()
+        self.load_older = load_older
+        self.batch_size = batch_size
+        self.songs = []  # Every loaded song, newest first
+        self.display_texts = []  # Pre-formatted display text of each song
+        self.visible_rows = 0  # Rows exposed to the view so far
+        self.older_available = load_older is not None
+        
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.visible_rows
+    
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or index.row() >= self.visible_rows:
+            return None
+        if role == Qt.ItemDataRole.DisplayRole:
+            return self.display_texts[index.row()]
+        if role == Qt.ItemDataRole.UserRole:
+            return self.songs[index.row()]  # The full song data
+        return None
+    
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and (self.visible_rows < len(self.songs) or self.older_available)
+    
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return
+        if self.visible_rows == len(self.songs) and self.older_available:
+            older_songs = self.load_older()
+            if older_songs is None:
+                self.older_available = False
+            else:
+                self.songs.extend(older_songs)
+                self.display_texts.extend(format_history_entry(song) for song in older_songs)
+        count = min(self.batch_size, len(self.songs) - self.visible_rows)
+        if count > 0:
+            self.beginInsertRows(QModelIndex(), self.visible_rows, self.visible_rows + count - 1)
+            self.visible_rows += count
+            self.endInsertRows()
+    
+    def set_songs(self, songs):
+        """Replace the history, e.g. with a day's history file (older days are loaded again lazily)"""
+        self.beginResetModel()
+        self.songs = list(songs)
+        self.display_texts = [format_history_entry(song) for song in self.songs]
+        self.visible_rows = min(self.batch_size, len(self.songs))
+        self.older_available = self.load_older is not None
+        self.endResetModel()
+    
+    def add_song(self, song):
+        """Insert a song at its place by timestamp: one row, usually at the top"""
+        position = 0
+        while position < len(self.songs) and self.songs[position]['timestamp'] > song['timestamp']:
+            position += 1
+        if position > self.visible_rows:  # Among rows not fetched yet: no view update needed
+            self.songs.insert(position, song)
+            self.display_texts.insert(position, format_history_entry(song))
+            return
+        self.beginInsertRows(QModelIndex(), position, position)
+        self.songs.insert(position, song)
+        self.display_texts.insert(position, format_history_entry(song))
+        self.visible_rows += 1
+        self.endInsertRows()
+    
+    def remove_song(self, song):
+        """Remove a song (the same entry, not an equal one), e.g. trimmed from today's history"""
+        for position in range(len(self.songs) - 1, -1, -1):
+            if self.songs[position] is song:
+                break
+        else:
+            return
+        if position >= self.visible_rows:
+            del self.songs[position]
+            del self.display_texts[position]
+            return
+        self.beginRemoveRows(QModelIndex(), position, position)
+        del self.songs[position]
+        del self.display_texts[position]
+        self.visible_rows -= 1
+        self.endRemoveRows()
+
 class ShazamApp(QMainWindow):
+    recognition_done = pyqtSignal(object, object)  # (job, future to complete once handled) from the pipeline's UI stage
+    pipeline_dropped = pyqtSignal(str, object)  # (stage, job) dropped by a full queue of the recognition pipeline
+    late_match = pyqtSignal(object, object)  # (entry, response) from the re-query queue
+    devices_changed = pyqtSignal(object, object)  # (added, removed) devices from the device watcher
+    profile_written = pyqtSignal(object)  # (profile, written files) or the error of a profile capture
+    
     def __init__(self):
         super().__init__()
         print("Initializing ShazamApp...")
         self.setWindowTitle("Shazam Music Recognition")
         self.setGeometry(100, 100, 500, 600)  # Increased size to accommodate history
         
-        # Setup audio recording parameters
-        self.SAMPLE_RATE = 44100
+        # Setup audio recording parameters; the sample rate and format are negotiated per
+        # device, 16kHz int16 (what signatures are computed from) when it is supported
+        self.capture_formats = {}  # Negotiated format by (device, channels), probed once
         self.CHANNELS = 1
         self.RECORD_SECONDS = 5  # Increased from 3 to 5 seconds
         self.input_device = None
         self.input_devices = []
-        self.recorder_thread = None
+        self.recorder_threads = {}  # One capture stream per device, keyed by device index
+        
+        # Setup the device watcher, started once devices are first listed; changes
+        # are handled on the UI thread (queued, also when a manual refresh finds them)
+        self.device_registry = device_registry
+        self.device_registry.interval = 60.0  # Seconds between two re-reads of the device list
+        self.device_registry.add_listener(self.devices_changed.emit)
+        self.devices_changed.connect(self.handle_devices_changed, Qt.ConnectionType.QueuedConnection)
+        QApplication.instance().aboutToQuit.connect(self.device_registry.stop)
         
-        # Setup cache directory
+        # Setup the audio source: the sound devices, or a file player for reproducible runs
+        self.audio_source = SoundDeviceSource()
+        
+        # Setup listening sources: the selected device plus any extra devices/channels
+        # added by the user, each with its own change gate and history
+        self.default_source = None
+        self.extra_sources = []
+        self.known_sources = {}
+        self.source_levels = {}
+        
+        # Setup client-side rate limiting and circuit breaking of Shazam requests,
+        # shared through a state file by this process and every worker process
+        self.request_guard_options = {
+            'rate': 1.0,  # Requests per second
+            'burst': 5,
+            'state_path': os.path.join(os.path.expanduser("~"), ".shazam_request_guard.json")
+        }
+        self.request_guard = install_request_guard(**self.request_guard_options)
+        
+        # Setup the worker pool shared by all sources for signatures and requests
+        self.recognition_pool = RecognitionPool(initializer=install_request_guard,
+                                                initkwargs=self.request_guard_options)
+        
+        # Setup the recognition pipeline: capture -> signature -> request -> UI, joined by
+        # short queues, so that a slow network or UI drops or merges stale recordings of
+        # a source instead of piling them up (a device still recording skips the cycle)
+        per_source = lambda job: job['source_id']
+        self.recognition_pipeline = Pipeline([
+            Stage('capture', self.start_capture, max_queued=0, max_in_flight=16, policy=DROP_NEWEST,
+                  key=lambda job: job['device']),
+            Stage('signature', self.start_signature, max_queued=4, max_in_flight=self.recognition_pool.max_workers,
+                  policy=COALESCE, key=per_source),
+            Stage('request', self.start_request, max_queued=4, max_in_flight=self.recognition_pool.request_workers,
+                  policy=COALESCE, key=per_source),
+            Stage('ui', self.start_ui_update, max_queued=8, max_in_flight=1, policy=COALESCE, key=per_source),
+        ], on_drop=self.pipeline_dropped.emit, on_error=self.handle_pipeline_error)
+        self.recognition_done.connect(self.handle_recognition_result)
+        self.pipeline_dropped.connect(self.handle_pipeline_drop)
+        QApplication.instance().aboutToQuit.connect(self.recognition_pipeline.close)
+        QApplication.instance().aboutToQuit.connect(self.recognition_pool.shutdown)
+        
+        # Setup latency tracking: stage times of the latest recognitions, and the time
+        # from starting to listen to the first match shown
+        self.recognition_timings = deque(maxlen=100)
+        self.listening_started = None
+        self.first_match_seconds = None
+        
+        # Setup cache directory, bounded by size and age, written in the background
         self.cache_dir = os.path.join(os.path.expanduser("~"), ".shazam_cache")
-        os.makedirs(self.cache_dir, exist_ok=True)
-        self.max_cache_size = 3  # Keep last 3 recordings
+        self.cache_max_bytes = 256 * 1024 * 1024
+        self.cache_max_age_days = 14
+        self.cache_format = 'flac'  # 'wav', 'flac', 'opus' or 'signature'
+        self.recording_cache = RecordingCache(self.cache_dir, self.cache_max_bytes,
+                                              self.cache_max_age_days * 24 * 3600, self.cache_format)
+        QApplication.instance().aboutToQuit.connect(self.recording_cache.close)
         
-        # Setup song history
+        # Setup signature archive, one append-only file per month
+        self.archive_dir = os.path.join(os.path.expanduser("~"), ".shazam_archive")
+        os.makedirs(self.archive_dir, exist_ok=True)
+        self.archive_month = None
+        self.signature_archive = None
+        QApplication.instance().aboutToQuit.connect(self.close_signature_archive)
+        
+        # Setup persistent re-query queue for unidentified samples, held back while
+        # live recognitions are in flight
+        self.requery_queue = RequeryQueue(
+            os.path.join(self.archive_dir, "requery_queue.json"),
+            on_match=self.late_match.emit,
+            live_busy=lambda: self.recognition_pipeline.busy('signature', 'request')
+        )
+        self.late_match.connect(self.handle_late_match)
+        self.requery_queue.start()
+        QApplication.instance().aboutToQuit.connect(self.requery_queue.stop)
+        
+        # Setup song history: today's plays are kept and listed in full, earlier days
+        # are read from their history files when the list is scrolled down to them
         self.song_history = []
-        self.max_history_size = 10
+        self.max_history_size = 10  # Per source, to recognize the song that is still playing
+        self.max_daily_history = 5000
+        self.history_days = 7  # Days of history files the list can scroll back through
+        self.older_history_day = None  # Last day loaded into the history list
+        self.history_model = HistoryModel(load_older=self.load_older_history)
         
         # Setup daily history file
         self.daily_history_dir = os.path.join(os.path.expanduser("~"), ".shazam_history")
@@ -161,6 +484,19 @@ class ShazamApp(QMainWindow):
         
         # Setup logging
         self.logging_enabled = True  # Enable logging by default for debugging
+        self.max_log_lines = 2000
+        
+        # Setup the on-demand profiler: the hidden Ctrl+Shift+P action, or SIGUSR2 (`kill -USR2 <pid>`,
+        # e.g. when running headless), samples the stacks of the app and its worker processes
+        # for a few seconds; until then nothing runs but a signal handler
+        self.profile_seconds = 10
+        self.profile_dir = self.recognition_pool.profile_dir  # ~/.shazam_profiles, where the workers look for requests
+        self.profile_thread = None
+        self.profile_written.connect(self.handle_profile_written)
+        self.signal_notifier = None
+        profiler.IDLE_FRAMES.add(('shazam_forever.py', 'main'))  # The GUI thread, waiting in the Qt event loop
+        if profiler.install_signal_trigger(self.start_profile):
+            self.watch_signals()
         
         # Setup UI first
         self.setup_ui()
@@ -168,23 +504,14 @@ class ShazamApp(QMainWindow):
         # Load today's history if it exists
         self.load_daily_history()
         
-        # Check microphone permissions at startup
-        if not check_microphone_permissions():
-            QMessageBox.warning(self, "Microphone Access Required",
-                              "Shazam Forever needs access to your microphone to identify songs.\n\n"
-                              "Please grant microphone access in System Preferences > Security & Privacy > Privacy > Microphone")
-        
-        # Track last identified song to prevent duplicates
-        self.last_song = None
-        self.last_song_time = None
-        
-        # Setup network manager for downloading images
-        self.network_manager = QNetworkAccessManager()
+        # Network manager for downloads through Qt, created on first use
+        self._network_manager = None
         
         self.is_listening = False
         
-        # Initialize audio devices after UI setup
-        self.refresh_devices()
+        # Enumerate audio devices (and check microphone permissions) once the
+        # window is up, so PortAudio initialization doesn't delay it
+        QTimer.singleShot(0, self.refresh_devices)
         
         print("ShazamApp initialized successfully")
         
@@ -214,10 +541,17 @@ class ShazamApp(QMainWindow):
         # Create device selection area
         device_layout = QHBoxLayout()
         
+        # Add audio source selection: sound devices, or audio files played as a virtual device
+        self.source_combo = QComboBox()
+        self.source_combo.addItems(["Microphones", "File player", "File player (fast)"])
+        self.source_combo.setToolTip("Capture from sound devices, or from audio files played in real time or as fast as possible")
+        self.source_combo.activated.connect(self.audio_source_selected)
+        device_layout.addWidget(self.source_combo)
+        
         # Add refresh button
         refresh_button = QPushButton("🔄")
         refresh_button.setFixedSize(30, 30)
-        refresh_button.clicked.connect(self.refresh_devices)
+        refresh_button.clicked.connect(lambda: self.refresh_devices(refresh=True))
         refresh_button.setToolTip("Refresh device list")
         device_layout.addWidget(refresh_button)
         
@@ -228,6 +562,30 @@ class ShazamApp(QMainWindow):
         
         layout.addLayout(device_layout)
         
+        # Create extra source selection area (other devices or single channels)
+        source_layout = QHBoxLayout()
+        
+        self.channel_combo = QComboBox()
+        self.channel_combo.setToolTip("Channel of the selected device to listen to")
+        source_layout.addWidget(self.channel_combo)
+        
+        add_source_button = QPushButton("Add Source")
+        add_source_button.clicked.connect(self.add_source)
+        add_source_button.setToolTip("Also listen to the selected device/channel")
+        source_layout.addWidget(add_source_button)
+        
+        remove_source_button = QPushButton("Remove Source")
+        remove_source_button.clicked.connect(self.remove_source)
+        source_layout.addWidget(remove_source_button)
+        
+        layout.addLayout(source_layout)
+        
+        # Create list of extra sources
+        self.sources_list = QListWidget()
+        self.sources_list.setMaximumHeight(60)
+        self.sources_list.setVisible(False)  # Only shown once extra sources are added
+        layout.addWidget(self.sources_list)
+        
         # Create song info area
         self.song_info_label = QLabel("No song identified yet")
         self.song_info_label.setStyleSheet("font-size: 12px;")
@@ -247,10 +605,12 @@ class ShazamApp(QMainWindow):
         history_label.setStyleSheet("font-size: 12px; font-weight: bold;")
         layout.addWidget(history_label)
         
-        # Create history list
-        self.history_list = QListWidget()
+        # Create history list, a view of the history model (rows are only created when shown)
+        self.history_list = QListView()
+        self.history_list.setModel(self.history_model)
+        self.history_list.setUniformItemSizes(True)
         self.history_list.setMaximumHeight(150)
-        self.history_list.itemClicked.connect(self.show_history_item)
+        self.history_list.clicked.connect(self.show_history_item)
         layout.addWidget(self.history_list)
         
         # Create view history button
@@ -264,12 +624,21 @@ class ShazamApp(QMainWindow):
         self.log_toggle.setChecked(False)  # Logs disabled by default
         self.log_toggle.stateChanged.connect(self.toggle_logging)
         log_toggle_layout.addWidget(self.log_toggle)
+        
+        # Create multi-window matching toggle
+        self.multi_resolution_toggle = QCheckBox("Multi-window Matching")
+        self.multi_resolution_toggle.setToolTip("Race several window lengths and offsets of each sample "
+                                                "to identify hard-to-match audio faster")
+        self.multi_resolution_toggle.setChecked(False)
+        self.multi_resolution_toggle.stateChanged.connect(self.toggle_multi_resolution)
+        log_toggle_layout.addWidget(self.multi_resolution_toggle)
         layout.addLayout(log_toggle_layout)
         
         # Create log area
         self.log_area = QTextEdit()
         self.log_area.setReadOnly(True)
         self.log_area.setMinimumHeight(100)
+        self.log_area.document().setMaximumBlockCount(self.max_log_lines)  # Oldest lines go, so the log stays bounded
         self.log_area.setVisible(False)  # Hidden by default
         layout.addWidget(self.log_area)
         
@@ -279,6 +648,12 @@ class ShazamApp(QMainWindow):
         self.toggle_button.clicked.connect(self.toggle_listening)
         layout.addWidget(self.toggle_button)
         
+        # Add the profiling action, hidden: only reachable through its shortcut
+        profile_action = QAction("Profile", self)
+        profile_action.setShortcut("Ctrl+Shift+P")
+        profile_action.triggered.connect(self.start_profile)
+        self.addAction(profile_action)
+        
         # Create quit button
         quit_button = QPushButton("Quit")
         quit_button.setStyleSheet("font-size: 14px; padding: 10px;")
@@ -287,17 +662,32 @@ class ShazamApp(QMainWindow):
         
         print("UI setup complete. Window should be visible.")
         
-    def refresh_devices(self):
+    @property
+    def network_manager(self):
+        if self._network_manager is None:
+            from PyQt6.QtNetwork import QNetworkAccessManager
+            self._network_manager = QNetworkAccessManager()
+        return self._network_manager
+    
+    def refresh_devices(self, refresh=False, keep_selection=False):
+        self.capture_formats = {}  # Probed again, devices may have changed
         try:
-            if not check_microphone_permissions():
+            if not check_microphone_permissions(refresh):
                 QMessageBox.warning(self, "Microphone Access Required",
                                   "Shazam Forever needs access to your microphone to identify songs.\n\n"
                                   "Please grant microphone access in System Preferences > Security & Privacy > Privacy > Microphone")
                 return
             
-            # Get all devices
-            devices = sd.query_devices()
-            print(f"Found audio devices: {devices}")
+            # Watch for hot-plugged devices from now on
+            self.device_registry.start()
+            
+            # Get all devices (enumerated by the permission check above)
+            devices = query_devices()
+            
+            selected_index = self.device_combo.currentIndex()
+            selected_name = None
+            if keep_selection and 0 <= selected_index < len(self.input_devices):
+                selected_name = self.input_devices[selected_index]['name']
             
             # Clear the combo box
             self.device_combo.clear()
@@ -312,9 +702,12 @@ class ShazamApp(QMainWindow):
                     print(f"Added input device: {device_name} (default: {device.get('isdefault', False)})")
             
             if self.input_devices:
-                # Try to find the default input device
-                default_index = -1
+                # Keep the previously selected device, otherwise try to find the default input device
+                default_index = next((i for i, device in enumerate(self.input_devices)
+                                      if device['name'] == selected_name), -1)
                 for i, device in enumerate(self.input_devices):
+                    if default_index >= 0:
+                        break
                     # Check both isdefault and name for built-in microphone
                     if device.get('isdefault', False) or "MacBook Pro Microphone" in device['name']:
                         default_index = i
@@ -348,23 +741,146 @@ class ShazamApp(QMainWindow):
                 QMessageBox.critical(self, "Device Error", 
                                    f"Failed to refresh audio devices: {error_msg}")
     
+    def handle_devices_changed(self, added, removed):
+        """Follow devices added, removed or renumbered since the device watcher's last scan"""
+        self.capture_formats = {}  # Indexes may now be other devices
+        for device in added:
+            self.log_message(f"Audio device connected: {device['name']}")
+        for device in removed:
+            self.log_message(f"Audio device disconnected: {device['name']}")
+        
+        self.follow_moved_devices()
+        
+        # Stops listening with a warning if a source's device is gone
+        if self.is_listening and not self.check_microphone_availability():
+            return
+        
+        # Listing the devices again stops listening (through device_changed), resume afterwards
+        was_listening = self.is_listening
+        self.refresh_devices(keep_selection=True)
+        if was_listening and self.input_device is not None:
+            self.start_listening()
+    
+    def follow_moved_devices(self):
+        """Point sources at the new index of their device when PortAudio renumbered devices"""
+        for source in self.known_sources.values():
+            device = self.device_registry.find_id(source.device_id)
+            if device is not None and device['index'] != source.device:
+                print(f"Device {source.device_label} moved from index {source.device} to {device['index']}")
+                source.device = device['index']  # Its source_id (by device id) doesn't change
+    
     def device_changed(self):
         if self.is_listening:
             self.stop_listening()
         
+        self.channel_combo.clear()
+        
         if self.device_combo.count() > 0 and self.input_devices:
             selected_index = self.device_combo.currentIndex()
             if 0 <= selected_index < len(self.input_devices):
                 device = self.input_devices[selected_index]
                 self.input_device = device['index']
+                self.default_source = self.get_source(device)
+                self.default_source.gate.reset()
+                self.channel_combo.addItem("All channels")
+                for channel in range(device['max_input_channels']):
+                    self.channel_combo.addItem(f"Channel {channel + 1}")
                 self.log_message(f"Selected audio device: {device['name']}")
                 self.toggle_button.setEnabled(True)
             else:
                 self.input_device = None
+                self.default_source = None
                 self.toggle_button.setEnabled(False)
         else:
             self.input_device = None
+            self.default_source = None
             self.toggle_button.setEnabled(False)
+    
+    def audio_source_selected(self, index):
+        """Switch between the sound devices and a file player of audio files picked by the user"""
+        if index == 0:
+            if not isinstance(self.audio_source, SoundDeviceSource):
+                self.set_audio_source(SoundDeviceSource())
+            return
+        paths, _ = QFileDialog.getOpenFileNames(self, "Audio Files to Play", os.path.expanduser("~"),
+                                                "Audio files (*.wav *.flac *.ogg *.aiff *.aif);;All files (*)")
+        if not paths:
+            self.source_combo.setCurrentIndex(0 if isinstance(self.audio_source, SoundDeviceSource)
+                                              else 1 if self.audio_source.realtime else 2)
+            return
+        self.set_audio_source(FilePlayerSource(paths, realtime=(index == 1)))
+    
+    def set_audio_source(self, audio_source):
+        """Capture from another audio source, listing its devices instead of the current ones"""
+        if self.is_listening:
+            self.stop_listening()
+        self.audio_source = audio_source
+        self.device_registry.set_enumerate_function(audio_source.enumerate_devices)
+        self.source_combo.setCurrentIndex(0 if isinstance(audio_source, SoundDeviceSource)
+                                          else 1 if audio_source.realtime else 2)
+        
+        # Extra sources were devices of the previous audio source
+        self.extra_sources = []
+        self.sources_list.clear()
+        self.sources_list.setVisible(False)
+        
+        self.log_message(f"Capturing from {audio_source.name}")
+        self.refresh_devices(refresh=True)
+    
+    def get_source(self, device, channel=None):
+        """Return the listening source for a device (dict) and channel, keeping its history across selections"""
+        device_id = self.device_registry.device_id(device['index']) or device_key(device) + (0,)
+        source = ListeningSource(device['index'], device_id, channel, self.max_history_size)
+        known_source = self.known_sources.get(source.source_id)
+        if known_source is not None:
+            known_source.device = device['index']  # The device may have been renumbered since
+            return known_source
+        self.known_sources[source.source_id] = source
+        return source
+    
+    def source_label(self, source_id):
+        """Label of a source, or its id if it is unknown (e.g. from a re-query queued in an earlier session)"""
+        source = self.known_sources.get(source_id)
+        return source.label if source is not None else source_id
+    
+    def listening_sources(self):
+        """All sources to record from on each cycle: the selected device plus extra sources"""
+        sources = [self.default_source] if self.default_source else []
+        for source in self.extra_sources:
+            if source not in sources:
+                sources.append(source)
+        return sources
+    
+    def add_source(self):
+        """Listen to the selected device/channel in addition to the current sources"""
+        selected_index = self.device_combo.currentIndex()
+        if not 0 <= selected_index < len(self.input_devices):
+            return
+        device = self.input_devices[selected_index]
+        channel_index = self.channel_combo.currentIndex()
+        channel = channel_index - 1 if channel_index > 0 else None
+        source = self.get_source(device, channel)
+        if source in self.listening_sources():
+            self.log_message(f"Already listening to {source.label}")
+            return
+        self.extra_sources.append(source)
+        item = QListWidgetItem(source.label)
+        item.setData(Qt.ItemDataRole.UserRole, source.source_id)
+        self.sources_list.addItem(item)
+        self.sources_list.setVisible(True)
+        self.log_message(f"Added source: {source.label}")
+    
+    def remove_source(self):
+        """Stop listening to the extra source selected in the sources list"""
+        item = self.sources_list.currentItem()
+        if item is None:
+            return
+        source_id = item.data(Qt.ItemDataRole.UserRole)
+        self.extra_sources = [source for source in self.extra_sources if source.source_id != source_id]
+        self.source_levels.pop(source_id, None)
+        self.sources_list.takeItem(self.sources_list.row(item))
+        self.sources_list.setVisible(self.sources_list.count() > 0)
+        self.log_message(f"Removed source: {item.text()}")
         
     def toggle_logging(self, state):
         """Toggle logging on/off"""
@@ -375,12 +891,63 @@ class ShazamApp(QMainWindow):
         else:
             self.log_message("Logging disabled")
             
+    def toggle_multi_resolution(self, state):
+        """Toggle racing several signature windows per sample"""
+        self.recognition_pool.multi_resolution = state == Qt.CheckState.Checked.value
+        self.log_message(f"Multi-window matching {'enabled' if self.recognition_pool.multi_resolution else 'disabled'}")
+            
     def log_message(self, message):
         """Log a message if logging is enabled"""
         if self.logging_enabled:
             self.log_area.append(message)
         print(message)  # Always print to console
         
+    def watch_signals(self):
+        """Wake the event loop up on signals, so that Python handles them right away"""
+        # Python signal handlers only run between two bytecodes, which may be seconds
+        # apart while Qt waits for events; the wakeup socket is one of those events
+        self.signal_socket, signal_wakeup = socket.socketpair()
+        self.signal_socket.setblocking(False)
+        signal_wakeup.setblocking(False)
+        self.signal_wakeup = signal_wakeup
+        try:
+            signal.set_wakeup_fd(signal_wakeup.fileno())
+        except ValueError:  # Not the main thread
+            return
+        self.signal_notifier = QSocketNotifier(self.signal_socket.fileno(), QSocketNotifier.Type.Read, self)
+        self.signal_notifier.activated.connect(lambda: self.signal_socket.recv(64))
+        
+    def start_profile(self):
+        """Sample the stacks of the app and its workers for a few seconds, in the background"""
+        if self.profile_thread is not None and self.profile_thread.is_alive():
+            self.log_message("A profile is already being captured")
+            return
+        os.makedirs(self.profile_dir, mode=0o700, exist_ok=True)
+        prefix = os.path.join(self.profile_dir, f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}")
+        worker_pids = self.recognition_pool.worker_pids()
+        
+        def capture():
+            try:
+                self.profile_written.emit(profiler.capture_profile(self.profile_seconds, prefix, worker_pids=worker_pids,
+                                                                   process_label='app',
+                                                                   request_dir=self.recognition_pool.profile_dir))
+            except Exception as e:
+                self.profile_written.emit(e)
+        
+        self.profile_thread = threading.Thread(target=capture, name='profiler', daemon=True)
+        self.profile_thread.start()
+        self.log_message(f"Profiling the app and {len(worker_pids)} worker processes for {self.profile_seconds} s...")
+        
+    def handle_profile_written(self, result):
+        """Log where a profile was written, and its top functions"""
+        if isinstance(result, Exception):
+            self.log_message(f"Profiling failed: {result}")
+            return
+        profile, paths = result
+        self.log_message(f"Profile written to {paths['speedscope']} (open in https://www.speedscope.app), "
+                         f"{paths['collapsed']} and {paths['top']}")
+        self.log_message('\n'.join(profile.format_top(10).splitlines()[:14]))
+        
     def toggle_listening(self):
         if not self.is_listening:
             if self.input_device is None:
@@ -396,6 +963,8 @@ class ShazamApp(QMainWindow):
         self.is_listening = True
         self.toggle_button.setText("Stop Listening")
         self.status_label.setText("Status: Listening")
+        self.listening_started = time.monotonic()
+        self.first_match_seconds = None
         
         # Start recording immediately
         self.record_and_identify()
@@ -413,24 +982,23 @@ class ShazamApp(QMainWindow):
         self.status_label.setText("Status: Not Listening")
         if hasattr(self, 'timer'):
             self.timer.stop()
-        if self.recorder_thread and self.recorder_thread.isRunning():
-            self.recorder_thread.stop()  # Use the stop method instead of terminate
-            self.recorder_thread.wait()
+        for recorder_thread in self.recorder_threads.values():
+            if recorder_thread.isRunning():
+                recorder_thread.stop()  # Use the stop method instead of terminate
+                recorder_thread.wait()
+        self.recorder_threads = {}
+        self.source_levels = {}
         self.volume_bar.setValue(0)
         self.log_message("Stopped listening for music.")
             
     def check_microphone_availability(self):
-        """Check if the selected microphone is still available"""
+        """Check if the microphones of all listening sources are still available"""
         try:
-            # Get all devices
-            devices = sd.query_devices()
-            
-            # Check if our device is still in the list
-            device_found = False
-            for device in devices:
-                if device['index'] == self.input_device:
-                    device_found = True
-                    break
+            # Re-read the device list first rather than rely on the watcher, which is slow
+            # or may not run (PortAudio is also re-initialized here after a failed recording)
+            self.device_registry.refresh()
+            device_found = all(self.device_registry.is_available(source.device, source.device_name)
+                               for source in self.listening_sources())
             
             if not device_found:
                 self.log_message("Selected microphone is no longer available")
@@ -455,163 +1023,375 @@ class ShazamApp(QMainWindow):
             return
             
         self.log_message("Recording audio sample...")
-        print(f"Starting recording with device: {self.input_device}")
+        print(f"Recognition pipeline: {self.recognition_pipeline.describe()}")
+        
+        # Sources sharing a device (e.g. channels of one interface) share its capture stream
+        sources_by_device = {}
+        for source in self.listening_sources():
+            sources_by_device.setdefault(source.device, []).append(source)
+        
+        for device, sources in sources_by_device.items():
+            if not self.recognition_pipeline.put({'device': device, 'sources': sources}, 'capture'):
+                self.log_message(f"Device {device} is still recording, skipping this cycle")
+        
+    def start_capture(self, job):
+        """Capture stage: record one window from a device (called on the UI thread, by record_and_identify)"""
+        device, sources = job['device'], job['sources']
+        channels = max([self.CHANNELS] + [source.channel + 1 for source in sources if source.channel is not None])
+        print(f"Starting recording with device: {device} for {len(sources)} source(s)")
         
         # Create and start the recorder thread
-        self.recorder_thread = AudioRecorderThread(
-            self.input_device,
-            self.SAMPLE_RATE,
-            self.CHANNELS,
-            self.RECORD_SECONDS
+        capture_format = self.capture_format(device, channels)
+        recorder_thread = AudioRecorderThread(
+            device,
+            capture_format.samplerate,
+            channels,
+            self.RECORD_SECONDS,
+            sources,
+            self.audio_source,
+            capture_format.dtype
         )
-        self.recorder_thread.finished.connect(self.process_recording)
-        self.recorder_thread.error.connect(self.handle_recording_error)
-        self.recorder_thread.volume.connect(self.update_volume)
-        self.recorder_thread.start()
+        recorder_thread.finished.connect(self.process_recording)
+        recorder_thread.error.connect(self.handle_recording_error)
+        recorder_thread.skipped.connect(self.handle_skipped_recording)
+        recorder_thread.volume.connect(self.update_volume)
+        self.recorder_threads[device] = recorder_thread
+        recorder_thread.start()
+        return recorder_thread.completion  # Each recording enters the signature stage through process_recording
+    
+    def capture_format(self, device, channels):
+        """Sample rate and format to capture from a device, probed on first use"""
+        key = (device, channels)
+        if key not in self.capture_formats:
+            device_info = next((info for info in query_devices() if info['index'] == device), {})
+            # The device watcher doesn't re-initialize PortAudio while we probe
+            with self.device_registry.stream_open():
+                capture_format = negotiate_capture_format(self.audio_source, device, channels,
+                                                          device_info.get('default_samplerate'))
+            self.log_message(f"Capturing from {device_info.get('name', device)} at {capture_format}"
+                             f"{'' if capture_format.native else f', resampled to {SIGNATURE_SAMPLE_RATE} Hz int16'}")
+            self.capture_formats[key] = capture_format
+        return self.capture_formats[key]
+    
+    def start_signature(self, job):
+        """Signature stage: generate the signature of a recording in the worker pool"""
+        return map_future(self.recognition_pool.submit_signature(job['audio']),
+                          lambda result: dict(job, audio=None, result=result,
+                                              times=dict(job['times'], signature=time.monotonic())))
+    
+    def start_request(self, job):
+        """Request stage: send the signature to Shazam (multi-window results already have their response)"""
+        if job['result'] is None or job['result'].response is not None:
+            return completed_future(dict(job, times=dict(job['times'], request=job['times']['signature'])))
+        return map_future(self.recognition_pool.submit_request(job['result']),
+                          lambda result: dict(job, times=dict(job['times'], request=time.monotonic())))
+    
+    def start_ui_update(self, job):
+        """UI stage: hand the job over to the UI thread, which completes the future once it is shown"""
+        handled = Future()
+        self.recognition_done.emit(job, handled)
+        return handled
+    
+    def handle_pipeline_error(self, stage, job, error):
+        """Show the failure of a signature or request through the UI stage, like results"""
+        if stage in ('signature', 'request'):
+            self.recognition_pipeline.put(dict(job, audio=None, result=None, error=error), 'ui')
+        else:
+            print(f"Recognition pipeline {stage} error: {error}")
+    
+    def handle_pipeline_drop(self, stage, job):
+        """Report work dropped or superseded because the recognition pipeline is backed up"""
+        if stage != 'capture':  # Skipped captures are reported by record_and_identify
+            self.log_message(f"Dropped a pending {stage} of {self.source_label(job['source_id'])}: "
+                             f"recognition is falling behind ({self.recognition_pipeline.describe()})")
         
-    def process_recording(self, temp_file_path):
+    def process_recording(self, recording):
+        source_id, temp_file_path, times = recording
         try:
             # Read the file as bytes for Shazam
             with open(temp_file_path, 'rb') as audio_file:
                 audio_bytes = audio_file.read()
             
-            # Cache the recording
+            # Cache the recording (encoded and written by the cache's background thread);
+            # signature-only caches wait for the signature computed by the worker pool
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            cache_file = os.path.join(self.cache_dir, f"recording_{timestamp}.wav")
-            shutil.copy2(temp_file_path, cache_file)
+            if self.cache_format != 'signature':
+                self.recording_cache.put(self.cache_key(source_id, timestamp), audio_bytes)
             
-            # Clean up old cache files
-            cache_files = sorted([f for f in os.listdir(self.cache_dir) if f.startswith("recording_")])
-            while len(cache_files) > self.max_cache_size:
-                os.remove(os.path.join(self.cache_dir, cache_files.pop(0)))
-            
-            # Analyze the audio
-            self.log_message("Analyzing audio with Shazam API...")
+            # Analyze the audio through the signature and request stages of the pipeline
+            self.log_message(f"Analyzing audio from {self.source_label(source_id)} with Shazam API...")
             self.status_label.setText("Status: Analyzing with Shazam...")
             
-            # Create Shazam instance and analyze
-            shazam = Shazam(audio_bytes)
-            recognize_generator = shazam.recognizeSong()
-            
+            self.recognition_pipeline.put({'source_id': source_id, 'timestamp': timestamp, 'audio': audio_bytes,
+                                           'times': times}, 'signature')
+                
+        except Exception as e:
+            self.log_message(f"Error during analysis: {str(e)}")
+            self.status_label.setText("Status: Analysis Error")
+        finally:
+            # Clean up the temporary file
             try:
-                result = next(recognize_generator)
+                os.unlink(temp_file_path)
+            except:
+                pass
+    
+    def cache_key(self, source_id, timestamp):
+        """Name of a recording in the cache, unique across sources recording at the same time"""
+        safe_source_id = re.sub(r'[^\w-]+', '-', source_id)  # Device names may hold any character
+        return f"recording_{timestamp}_{safe_source_id}"
+    
+    def handle_recognition_result(self, job, handled):
+        """Show a result coming out of the recognition pipeline, always freeing its UI stage"""
+        try:
+            matched = self.show_recognition_result(job)
+        finally:
+            handled.set_result(None)  # Whatever happened above: the UI stage only runs one result at a time
+        self.record_timing(job, matched)
+    
+    def show_recognition_result(self, job):
+        """Update the UI and history with a recognition result, returning whether it matched a song"""
+        matched = False
+        try:
+            source_id, timestamp = job['source_id'], job['timestamp']
+            source = self.known_sources.get(source_id)
+            if source is None:
+                raise KeyError(f"result of an unknown source {source_id}")
+            if job.get('error') is not None:
+                raise job['error']
+            result = job['result']
+            
+            # Log the raw Shazam API response if logging is enabled
+            if self.logging_enabled and result:
+                self.log_message(f"Shazam API Response ({source.label}):")
+                self.log_message(json.dumps(result.to_tuple(), indent=2))
+            
+            if result:
+                if self.cache_format == 'signature':
+                    self.recording_cache.put(self.cache_key(source_id, timestamp), b'', result.signature)
+                self.archive_signature(source, result)
+            
+            # Check if we have a valid result with track information
+            if result and 'track' in result.response:
+                matched = True
+                title, artist, genre, album, cover_art_url, background_url, spotify_uri = \
+                    self.parse_track(result.response['track'])
                 
-                # Log the raw Shazam API response if logging is enabled
-                if self.logging_enabled and result:
-                    self.log_message("Shazam API Response:")
-                    self.log_message(json.dumps(result, indent=2))
+                # Create a nice blurb
+                blurb = f"<b>{title}</b> by <b>{artist}</b><br>"
+                blurb += f"Genre: {genre}<br>"
+                blurb += f"Album: {album}"
+                if source is not self.default_source:
+                    blurb += f"<br>Heard on: {source.label}"
                 
-                # Check if we have a valid result with track information
-                if result and isinstance(result, tuple) and len(result) > 1:
-                    response_data = result[1]
-                    if 'track' in response_data:
-                        track = response_data['track']
-                        title = track.get('title', 'Unknown Title')
-                        artist = track.get('subtitle', 'Unknown Artist')
-                        
-                        # Get additional metadata
-                        # Try to get genre in English, fall back to primary if not available
-                        genre = track.get('genres', {}).get('primary', 'Unknown Genre')
-                        
-                        # Check if we have a localized version of the genre
-                        if 'genres' in track and 'localized' in track['genres']:
-                            # Try to get English genre first
-                            if 'en' in track['genres']['localized']:
-                                genre = track['genres']['localized']['en']
-                            # Fall back to primary if no English version
-                            elif track['genres'].get('primary'):
-                                genre = track['genres']['primary']
-                        
-                        album = track.get('sections', [{}])[0].get('metapages', [{}])[1].get('caption', 'Unknown Album')
-                        
-                        # Get image URLs
-                        cover_art_url = track.get('images', {}).get('coverart', '')
-                        background_url = track.get('images', {}).get('background', '')
-                        
-                        # Get Spotify URI if available
-                        spotify_uri = None
-                        if 'hub' in track and 'providers' in track['hub']:
-                            for provider in track['hub']['providers']:
-                                if provider.get('type') == 'SPOTIFY':
-                                    for action in provider.get('actions', []):
-                                        if action.get('name') == 'hub:spotify:searchdeeplink':
-                                            spotify_uri = action.get('uri', '')
-                                            break
-                        
-                        # Create a nice blurb
-                        blurb = f"<b>{title}</b> by <b>{artist}</b><br>"
-                        blurb += f"Genre: {genre}<br>"
-                        blurb += f"Album: {album}"
-                        
-                        # Update UI with song info
-                        self.song_info_label.setText(blurb)
-                        self.status_label.setText(f"Found: {title} by {artist}")
-                        
-                        # Download and display album art
-                        if cover_art_url:
-                            self.download_and_display_image(cover_art_url)
-                        else:
-                            # Set a default image or clear the label
-                            self.album_art_label.setText("No album art available")
-                        
-                        # Check if this is a new song or a repeat
-                        current_time = datetime.now()
-                        is_new_song = True
-                        
-                        # Always log the song with timestamp
-                        self.log_message(f"Found song: {title} by {artist} at {current_time.strftime('%H:%M:%S')}")
-                        
-                        # Check if this song is already in the history
-                        if self.last_song and self.last_song.get('title') == title and self.last_song.get('artist') == artist:
-                            # Same song as before, don't add to history
-                            is_new_song = False
-                        else:
-                            # New song, update last song info
-                            self.last_song = {'title': title, 'artist': artist}
-                            self.last_song_time = current_time
-                        
-                        # Add to history if it's a new song
-                        if is_new_song:
-                            self.add_to_history(title, artist, genre, album, cover_art_url, timestamp, spotify_uri)
-                        
-                        # Save metadata to cache
-                        metadata_file = os.path.join(self.cache_dir, f"recording_{timestamp}_metadata.json")
-                        with open(metadata_file, 'w') as f:
-                            json.dump({
-                                'title': title,
-                                'artist': artist,
-                                'genre': genre,
-                                'album': album,
-                                'cover_art_url': cover_art_url,
-                                'background_url': background_url,
-                                'spotify_uri': spotify_uri,
-                                'timestamp': timestamp
-                            }, f)
-                    else:
-                        # No song identified, but don't log it
-                        self.status_label.setText("Status: No song identified")
-                        self.song_info_label.setText("No song identified in this sample")
-                        self.album_art_label.setText("No album art available")
+                # Update UI with song info
+                self.song_info_label.setText(blurb)
+                self.status_label.setText(f"Found: {title} by {artist}")
+                
+                # Download and display album art
+                if cover_art_url:
+                    self.download_and_display_image(cover_art_url)
                 else:
-                    # No song identified, but don't log it
-                    self.status_label.setText("Status: No song identified")
-                    self.song_info_label.setText("No song identified in this sample")
+                    # Set a default image or clear the label
                     self.album_art_label.setText("No album art available")
-            except StopIteration:
+                
+                # Check if this is a new song or a repeat
+                current_time = datetime.now()
+                is_new_song = True
+                
+                # Always log the song with timestamp
+                self.log_message(f"Found song on {source.label}: {title} by {artist} at {current_time.strftime('%H:%M:%S')}")
+                
+                # Check if this song is already playing on this source
+                if source.last_song and source.last_song.get('title') == title and source.last_song.get('artist') == artist:
+                    # Same song as before, don't add to history
+                    is_new_song = False
+                else:
+                    # New song, update last song info
+                    source.last_song = {'title': title, 'artist': artist}
+                    source.last_song_time = current_time
+                
+                # Add to history if it's a new song
+                if is_new_song:
+                    source_label = None if source is self.default_source else source.label
+                    self.add_to_history(title, artist, genre, album, cover_art_url, timestamp, spotify_uri, source_label)
+                
+                # Save metadata to cache
+                self.recording_cache.set_metadata(self.cache_key(source_id, timestamp), {
+                    'title': title,
+                    'artist': artist,
+                    'genre': genre,
+                    'album': album,
+                    'cover_art_url': cover_art_url,
+                    'background_url': background_url,
+                    'spotify_uri': spotify_uri,
+                    'timestamp': timestamp,
+                    'source': source.label
+                })
+            else:
                 # No song identified, but don't log it
                 self.status_label.setText("Status: No song identified")
                 self.song_info_label.setText("No song identified in this sample")
                 self.album_art_label.setText("No album art available")
                 
+                # Keep the signature around so it can be retried later
+                if result:
+                    self.requery_queue.add(result.signature, source.label,
+                                           {'source_id': source_id, 'timestamp': timestamp})
+                
+        except (CircuitOpenError, RateLimitTimeout) as e:
+            # Shazam is degraded or we are over our request budget: skip this sample quietly
+            self.log_message(f"Recognition skipped: {str(e)} (request metrics: {self.request_guard.metrics()})")
+            self.status_label.setText("Status: Shazam unavailable, backing off...")
         except Exception as e:
             self.log_message(f"Error during analysis: {str(e)}")
             self.status_label.setText("Status: Analysis Error")
-        finally:
-            # Clean up the temporary file
-            try:
-                os.unlink(temp_file_path)
-            except:
-                pass
+        return matched
+    
+    def record_timing(self, job, matched):
+        """Keep the stage times of a recognition shown, printing its latency breakdown"""
+        times = dict(job['times'], shown=time.monotonic())
+        self.recognition_timings.append({'source_id': job['source_id'], 'matched': matched, 'times': times})
+        
+        breakdown = []
+        previous = times['capture']
+        for stage, name in (('recorded', 'record'), ('signature', 'signature'), ('request', 'request'), ('shown', 'UI')):
+            if stage in times:  # Failed jobs skip the stages after the failure
+                breakdown.append(f"{name} {(times[stage] - previous) * 1000:.0f} ms")
+                previous = times[stage]
+        print(f"Latency ({self.source_label(job['source_id'])}): {', '.join(breakdown)}, "
+              f"total {(times['shown'] - times['capture']) * 1000:.0f} ms")
+        
+        if matched and self.first_match_seconds is None and self.listening_started is not None:
+            self.first_match_seconds = times['shown'] - self.listening_started
+            self.log_message(f"First match {self.first_match_seconds:.2f} s after starting to listen")
+    
+    def parse_track(self, track):
+        """Extract (title, artist, genre, album, cover art, background, Spotify URI) from a Shazam track"""
+        title = track.get('title', 'Unknown Title')
+        artist = track.get('subtitle', 'Unknown Artist')
+        
+        # Get additional metadata
+        # Try to get genre in English, fall back to primary if not available
+        genre = track.get('genres', {}).get('primary', 'Unknown Genre')
+        
+        # Check if we have a localized version of the genre
+        if 'genres' in track and 'localized' in track['genres']:
+            # Try to get English genre first
+            if 'en' in track['genres']['localized']:
+                genre = track['genres']['localized']['en']
+            # Fall back to primary if no English version
+            elif track['genres'].get('primary'):
+                genre = track['genres']['primary']
+        
+        album = track.get('sections', [{}])[0].get('metapages', [{}])[1].get('caption', 'Unknown Album')
+        
+        # Get image URLs
+        cover_art_url = track.get('images', {}).get('coverart', '')
+        background_url = track.get('images', {}).get('background', '')
+        
+        # Get Spotify URI if available
+        spotify_uri = None
+        if 'hub' in track and 'providers' in track['hub']:
+            for provider in track['hub']['providers']:
+                if provider.get('type') == 'SPOTIFY':
+                    for action in provider.get('actions', []):
+                        if action.get('name') == 'hub:spotify:searchdeeplink':
+                            spotify_uri = action.get('uri', '')
+                            break
+        
+        return title, artist, genre, album, cover_art_url, background_url, spotify_uri
+    
+    def handle_late_match(self, entry, response):
+        """Backfill the history with a song identified by re-querying an old sample"""
+        try:
+            title, artist, genre, album, cover_art_url, background_url, spotify_uri = \
+                self.parse_track(response['track'])
+            context = entry.context or {}
+            timestamp = context.get('timestamp', datetime.now().strftime("%Y%m%d_%H%M%S"))
+            source = self.known_sources.get(context.get('source_id'))
+            
+            self.log_message(f"Late match on {entry.source}: {title} by {artist} (heard at {timestamp})")
+            source_label = None if source is None or source is self.default_source else source.label
+            
+            # The sample may be from an earlier day, whose history is in its own file
+            date = datetime.strptime(timestamp, "%Y%m%d_%H%M%S").strftime("%Y-%m-%d")
+            if date == self.current_date:
+                day_songs = self.song_history
+            else:
+                history_file = os.path.join(self.daily_history_dir, f"{date}.md")
+                day_songs = self.read_history_file(history_file) if os.path.exists(history_file) else []
+            
+            # Only backfill if the entries of that source around the sample aren't already this song
+            if self.is_neighbouring_song(day_songs, title, artist, timestamp, source_label):
+                return
+            if date == self.current_date:
+                self.add_to_history(title, artist, genre, album, cover_art_url, timestamp, spotify_uri, source_label)
+            else:
+                self.add_to_older_history(date, day_songs, {
+                    'title': title,
+                    'artist': artist,
+                    'genre': genre,
+                    'album': album,
+                    'cover_art_url': cover_art_url,
+                    'timestamp': timestamp,
+                    'spotify_uri': spotify_uri,
+                    'source': source_label
+                })
+        except Exception as e:
+            self.log_message(f"Error handling late match: {str(e)}")
+                
+    def is_neighbouring_song(self, songs, title, artist, timestamp, source_label):
+        """Whether the songs of a source just before and just after `timestamp` include this one"""
+        source_songs = [song for song in songs if song.get('source') == source_label]  # Newest first
+        position = 0
+        while position < len(source_songs) and source_songs[position]['timestamp'] > timestamp:
+            position += 1
+        return any(song['title'] == title and song['artist'] == artist
+                   for song in source_songs[max(0, position - 1):position + 1])
+    
+    def add_to_older_history(self, date, day_songs, song_entry):
+        """Backfill the history file of an earlier day, and the history list if that day is shown"""
+        position = 0
+        while position < len(day_songs) and day_songs[position]['timestamp'] > song_entry['timestamp']:
+            position += 1
+        day_songs.insert(position, song_entry)
+        self.write_history_file(os.path.join(self.daily_history_dir, f"{date}.md"), date, day_songs)
+        
+        if self.older_history_day is not None and date >= self.older_history_day:
+            self.history_model.add_song(song_entry)
+        self.log_message(f"Added {song_entry['title']} by {song_entry['artist']} to the history of {date}")
+    
+    def archive_signature(self, source, result):
+        """Append the signature of a recognized window to this month's archive"""
+        try:
+            month = datetime.now().strftime("%Y-%m")
+            if month != self.archive_month:
+                self.close_signature_archive()
+                self.signature_archive = SignatureArchiveWriter(os.path.join(self.archive_dir, f"{month}.sigarc"))
+                self.archive_month = month
+            
+            # Only a compact result is kept, unidentified windows are stored without one
+            track = result.response.get('track')
+            song = None
+            if track:
+                song = {'key': track.get('key'), 'title': track.get('title'), 'artist': track.get('subtitle')}
+            
+            self.signature_archive.append(result.signature, time.time(), source.label, song)
+            self.signature_archive.flush()
+        except Exception as e:
+            self.log_message(f"Error archiving signature: {str(e)}")
+    
+    def close_signature_archive(self):
+        """Write the archive's index footer"""
+        if self.signature_archive is not None:
+            self.signature_archive.close()
+            self.signature_archive = None
+            self.archive_month = None
+    
+    def handle_skipped_recording(self, source_id, reason):
+        """Report a recording that the change gate did not send to Shazam"""
+        self.log_message(f"Skipped recognition on {self.source_label(source_id)}: {reason}")
+        self.status_label.setText(f"Status: Listening (skipped: {reason.split(' ')[0]})")
                 
     def download_and_display_image(self, url):
         """Download and display an image from a URL using requests library"""
@@ -621,6 +1401,7 @@ class ShazamApp(QMainWindow):
             
         try:
             # Use requests library for more reliable downloads
+            import requests
             response = requests.get(url, timeout=5)
             if response.status_code == 200:
                 # Load the image data
@@ -674,6 +1455,9 @@ class ShazamApp(QMainWindow):
         """Handle recording errors, with special handling for network-related issues"""
         self.log_message(f"Error during recording: {error_message}")
         
+        # The device may have been unplugged: look for it again, once no stream is open
+        self.device_registry.request_reinitialize()
+        
         # Check if it's a network-related error
         if any(err in error_message.lower() for err in ['network', 'connection', 'timeout', 'hardware not running']):
             # For network errors, just update the status and continue
@@ -687,16 +1471,21 @@ class ShazamApp(QMainWindow):
         QMessageBox.warning(self, "Recording Error", 
                           f"An error occurred while recording: {error_message}")
 
-    def update_volume(self, volume):
-        # Convert volume to a 0-100 scale for the progress bar
+    def update_volume(self, source_id, volume):
+        # Show the loudest source when listening to several at once
+        self.source_levels[source_id] = volume
+        volume = max(self.source_levels.values())
+        
+        # Convert the linear RMS level to a 0-100 scale for the progress bar,
+        # mapping -60 dBFS..0 dBFS onto the bar
         # Handle NaN values
-        if np.isnan(volume):
+        if np.isnan(volume) or volume <= 0:
             volume_percent = 0
         else:
-            volume_percent = min(100, int(volume * 1000))
+            volume_percent = max(0, min(100, int((20 * np.log10(volume) + 60) * 100 / 60)))
         self.volume_bar.setValue(volume_percent)
 
-    def add_to_history(self, title, artist, genre, album, cover_art_url, timestamp, spotify_uri=None):
+    def add_to_history(self, title, artist, genre, album, cover_art_url, timestamp, spotify_uri=None, source=None):
         """Add a song to the history list"""
         # Create a song entry
         song_entry = {
@@ -706,45 +1495,50 @@ class ShazamApp(QMainWindow):
             'album': album,
             'cover_art_url': cover_art_url,
             'timestamp': timestamp,
-            'spotify_uri': spotify_uri
+            'spotify_uri': spotify_uri,
+            'source': source  # Label of the extra source it was heard on, None for the selected device
         }
         
-        # Add to history list (newest first)
-        self.song_history.insert(0, song_entry)
+        # Add to the history of the source it was heard on
+        for listening_source in self.known_sources.values():
+            if listening_source.label == source or (source is None and listening_source is self.default_source):
+                listening_source.add_to_history(song_entry)
         
-        # Limit history size
-        if len(self.song_history) > self.max_history_size:
-            self.song_history.pop()
+        # Add to history list (newest first); late matches are backfilled at their original time
+        position = 0
+        while position < len(self.song_history) and self.song_history[position]['timestamp'] > timestamp:
+            position += 1
+        self.song_history.insert(position, song_entry)
+        
+        # Insert the song in the history list
+        self.history_model.add_song(song_entry)
         
-        # Update the history list widget
-        self.update_history_list()
+        # Limit history size, in the list too so a long-running session stays bounded
+        if len(self.song_history) > self.max_daily_history:
+            self.history_model.remove_song(self.song_history.pop())
         
         # Save to daily history file
         self.save_daily_history()
         
-    def update_history_list(self):
-        """Update the history list widget with current history"""
-        self.history_list.clear()
-        
-        for song in self.song_history:
-            # Format the timestamp
-            try:
-                dt = datetime.strptime(song['timestamp'], "%Y%m%d_%H%M%S")
-                # Include date in the timestamp display
-                time_str = dt.strftime("%Y-%m-%d %H:%M:%S")
-            except:
-                time_str = "Unknown time"
-                
-            # Create the display text with timestamp
-            display_text = f"{song['title']} by {song['artist']} ({time_str})"
-            
-            item = QListWidgetItem(display_text)
-            item.setData(Qt.ItemDataRole.UserRole, song)  # Store the full song data
-            self.history_list.addItem(item)
+    def load_older_history(self):
+        """Songs of the most recent day before the ones listed that has a history file, or None"""
+        day = datetime.strptime(self.older_history_day or self.current_date, "%Y-%m-%d")
+        oldest_day = datetime.strptime(self.current_date, "%Y-%m-%d") - timedelta(days=self.history_days - 1)
+        while True:
+            day -= timedelta(days=1)
+            if day < oldest_day:
+                return None
+            self.older_history_day = day.strftime("%Y-%m-%d")
+            history_file = os.path.join(self.daily_history_dir, f"{self.older_history_day}.md")
+            if os.path.exists(history_file):
+                try:
+                    return self.read_history_file(history_file)
+                except Exception as e:
+                    self.log_message(f"Error loading history of {self.older_history_day}: {str(e)}")
             
-    def show_history_item(self, item):
+    def show_history_item(self, index):
         """Display the selected history item and open Spotify if available"""
-        song = item.data(Qt.ItemDataRole.UserRole)
+        song = index.data(Qt.ItemDataRole.UserRole)
         
         # Update the song info
         blurb = f"<b>{song['title']}</b> by <b>{song['artist']}</b><br>"
@@ -771,6 +1565,7 @@ class ShazamApp(QMainWindow):
             if uri:
                 # The URI is already in the format spotify:track:123456
                 # This will open the native Spotify application
+                import webbrowser
                 webbrowser.open(uri)
                 self.log_message(f"Opening Spotify: {uri}")
             else:
@@ -786,55 +1581,66 @@ class ShazamApp(QMainWindow):
         self.current_date = datetime.now().strftime("%Y-%m-%d")
         self.daily_history_file = os.path.join(self.daily_history_dir, f"{self.current_date}.md")
         
+        self.older_history_day = None
+        
         if os.path.exists(self.daily_history_file):
             try:
-                with open(self.daily_history_file, 'r') as f:
-                    content = f.read()
-                
-                # Parse the markdown content
-                songs = []
-                for line in content.split('\n'):
-                    if line.startswith('- '):
-                        # Extract song info from the line
-                        # Format: - [Song Title by Artist](uri) at [YYYY-MM-DD HH:MM] or [Unknown time]
-                        match = re.match(r'- \[(.*?) by (.*?)\]\((.*?)\) at \[(.*?)\]', line)
-                        if match:
-                            title, artist, uri, time_str = match.groups()
-                            
-                            # Handle timestamp
-                            if time_str == "Unknown time":
-                                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                            else:
-                                try:
-                                    dt = datetime.strptime(time_str, "%Y-%m-%d %H:%M")
-                                    timestamp = dt.strftime("%Y%m%d_%H%M%S")
-                                except ValueError:
-                                    # If parsing fails, use current time
-                                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                            
-                            # Create a song entry
-                            song_entry = {
-                                'title': title,
-                                'artist': artist,
-                                'genre': 'Unknown Genre',  # We don't store genre in the markdown
-                                'album': 'Unknown Album',  # We don't store album in the markdown
-                                'cover_art_url': '',  # We don't store cover art URL in the markdown
-                                'timestamp': timestamp,
-                                'spotify_uri': uri if 'spotify:' in uri else None  # Only store actual Spotify URIs
-                            }
-                            songs.append(song_entry)
+                songs = self.read_history_file(self.daily_history_file)
                 
                 # Add to history
                 self.song_history = songs
-                self.update_history_list()  # Update the UI immediately
+                self.history_model.set_songs(songs)  # Update the UI immediately
                 self.log_message(f"Loaded {len(songs)} songs from today's history")
             except Exception as e:
                 self.log_message(f"Error loading daily history: {str(e)}")
                 self.song_history = []
+                self.history_model.set_songs([])
         else:
             self.log_message("No history file for today")
             self.song_history = []
-            self.update_history_list()  # Update the UI even if no history
+            self.history_model.set_songs([])  # Update the UI even if no history
+    
+    def read_history_file(self, history_file):
+        """Parse the songs of a daily history markdown file, newest first"""
+        with open(history_file, 'r') as f:
+            content = f.read()
+        
+        # Parse the markdown content
+        songs = []
+        for line in content.split('\n'):
+            if line.startswith('- '):
+                # Extract song info from the line
+                # Format: - [Song Title by Artist](uri) at [YYYY-MM-DD HH:MM] or [Unknown time],
+                # optionally followed by " on [Source]" for extra sources
+                match = re.match(r'- \[(.*?) by (.*?)\]\((.*?)\) at \[(.*?)\](?: on \[(.*?)\])?', line)
+                if match:
+                    title, artist, uri, time_str, source = match.groups()
+                            
+                    # Handle timestamp
+                    if time_str == "Unknown time":
+                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                    else:
+                        try:
+                            dt = datetime.strptime(time_str, "%Y-%m-%d %H:%M")
+                            timestamp = dt.strftime("%Y%m%d_%H%M%S")
+                        except ValueError:
+                            # If parsing fails, use current time
+                            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                            
+                    # Create a song entry
+                    song_entry = {
+                        'title': title,
+                        'artist': artist,
+                        'genre': 'Unknown Genre',  # We don't store genre in the markdown
+                        'album': 'Unknown Album',  # We don't store album in the markdown
+                        'cover_art_url': '',  # We don't store cover art URL in the markdown
+                        'timestamp': timestamp,
+                        'spotify_uri': uri if 'spotify:' in uri else None,  # Only store actual Spotify URIs
+                        'source': source
+                    }
+                    songs.append(song_entry)
+        
+        return songs
             
     def save_daily_history(self):
         """Save today's song history to the markdown file"""
@@ -849,38 +1655,44 @@ class ShazamApp(QMainWindow):
                 # Load any existing history for the new day
                 self.load_daily_history()
             
-            # Create the markdown content
-            content = f"# Scrobbles for {self.current_date}\n\n"
-            
-            # Add each song to the markdown
-            for song in self.song_history:
-                # Format the timestamp
-                try:
-                    dt = datetime.strptime(song['timestamp'], "%Y%m%d_%H%M%S")
-                    # Include date in the timestamp display
-                    time_str = dt.strftime("%Y-%m-%d %H:%M")
-                except:
-                    time_str = "Unknown time"
-                
-                # Get the Spotify URI or use a default search link
-                uri = song.get('spotify_uri', '')
-                if not uri:
-                    # Create a Spotify search URL if no direct URI is available
-                    search_query = f"{song['title']} {song['artist']}".replace(' ', '+')
-                    uri = f"https://open.spotify.com/search/{search_query}"
-                
-                # Add the song to the markdown with a clickable link
-                content += f"- [{song['title']} by {song['artist']}]({uri}) at [{time_str}]\n"
-            
-            # Write to the file
-            with open(self.daily_history_file, 'w') as f:
-                f.write(content)
-            
+            self.write_history_file(self.daily_history_file, self.current_date, self.song_history)
             self.log_message(f"Saved {len(self.song_history)} songs to today's history")
         except Exception as e:
             self.log_message(f"Error saving daily history: {str(e)}")
             QMessageBox.warning(self, "History Error", 
                               f"Failed to save history: {str(e)}")
+    
+    def write_history_file(self, history_file, date, songs):
+        """Write the songs of a day (newest first) to its markdown history file"""
+        # Create the markdown content
+        content = f"# Scrobbles for {date}\n\n"
+        
+        # Add each song to the markdown
+        for song in songs:
+            # Format the timestamp
+            try:
+                dt = datetime.strptime(song['timestamp'], "%Y%m%d_%H%M%S")
+                # Include date in the timestamp display
+                time_str = dt.strftime("%Y-%m-%d %H:%M")
+            except:
+                time_str = "Unknown time"
+            
+            # Get the Spotify URI or use a default search link
+            uri = song.get('spotify_uri', '')
+            if not uri:
+                # Create a Spotify search URL if no direct URI is available
+                search_query = f"{song['title']} {song['artist']}".replace(' ', '+')
+                uri = f"https://open.spotify.com/search/{search_query}"
+            
+            # Add the song to the markdown with a clickable link
+            line = f"- [{song['title']} by {song['artist']}]({uri}) at [{time_str}]"
+            if song.get('source'):
+                line += f" on [{song['source']}]"
+            content += line + "\n"
+        
+        # Write to the file
+        with open(history_file, 'w') as f:
+            f.write(content)
 
     def view_daily_history(self):
         """Open today's history file in the default text editor"""
@@ -903,9 +1715,20 @@ class ShazamApp(QMainWindow):
                               f"Failed to open history file: {str(e)}")
 
 def main():
-    app = QApplication(sys.argv)
+    multiprocessing.freeze_support()  # Recognition workers are separate processes, also in the app bundle
+    parser = argparse.ArgumentParser(description="Continuously identify the music playing around you")
+    parser.add_argument('--play', nargs='+', metavar='FILE', help="Capture from these audio files instead of a microphone")
+    parser.add_argument('--fast', action='store_true', help="Play the files as fast as possible instead of in real time")
+    parser.add_argument('--listen', action='store_true', help="Start listening right away")
+    args, qt_args = parser.parse_known_args()
+    setup_ffmpeg_path()
+    app = QApplication(sys.argv[:1] + qt_args)
     window = ShazamApp()
+    if args.play:
+        window.set_audio_source(FilePlayerSource(args.play, realtime=not args.fast))
     window.show()
+    if args.listen:
+        QTimer.singleShot(0, window.toggle_listening)  # Queued after the deferred device enumeration
     sys.exit(app.exec())
 
 if __name__ == '__main__':
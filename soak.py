@@ -0,0 +1,370 @@
+"""Soak test: Shazam Forever runs headless for thousands of accelerated cycles on fake audio devices and a local mock Shazam server, failing if memory, file descriptors, threads or caches keep growing"""
+import argparse
+import functools
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+MB = 1024 * 1024
+
+
+class CallbackStop(Exception):
+    pass
+
+
+class FakeDevices:
+    """Input devices playing the fixture files on a loop, on a clock running `speed` times faster than real time"""
+
+    def __init__(self, fixtures, count=1, speed=100.0, samplerate=44100, blocksize=1024):
+        from custom_shazam_api.sources import FilePlayerSource
+        self.files = FilePlayerSource(fixtures)  # Only used to decode the fixtures at each sample rate
+        self.names = [f"Soak Microphone {index + 1}" for index in range(count)]
+        self.speed = speed
+        self.samplerate = samplerate
+        self.blocksize = blocksize
+        self.start = time.monotonic()
+        self.streams_opened = 0
+        self.native_rate = None
+
+    def query_devices(self):
+        return [{'name': name, 'index': index, 'hostapi': 0, 'max_input_channels': 2, 'max_output_channels': 0,
+                 'default_samplerate': float(self.samplerate)} for index, name in enumerate(self.names)]
+
+    def position(self, device, samplerate):
+        """Playlist position a device is at now, each device playing from a different point"""
+        simulated_seconds = (time.monotonic() - self.start) * self.speed
+        offset = len(self.files.playlist(samplerate)) * device // len(self.names)
+        return int(simulated_seconds * samplerate) + offset
+
+    def read(self, position, frames, channels, samplerate, dtype='float32'):
+        playlist = self.files.playlist(samplerate)
+        block = playlist[(position + np.arange(frames)) % len(playlist)]
+        if dtype == 'int16':
+            block = (block * 32767).astype(np.int16)
+        return np.repeat(block[:, None], channels, axis=1)
+
+    def check_input_settings(self, device=None, samplerate=None, channels=None, dtype=None, **kwargs):
+        """A device capturing at any rate, or only at --native-rate"""
+        if self.native_rate is not None and samplerate != self.native_rate:
+            raise ValueError(f"Invalid sample rate {samplerate}")
+
+    def module(self):
+        """A stand-in for the sounddevice module"""
+        module = types.ModuleType('sounddevice')
+        module.query_devices = self.query_devices
+        module.check_input_settings = self.check_input_settings
+        module.InputStream = functools.partial(FakeInputStream, self)
+        module.CallbackStop = CallbackStop
+        module._initialize = module._terminate = lambda: None
+        return module
+
+
+class FakeInputStream:
+    """Callback stream of a fake device: blocks of contiguous audio, from where the device's clock is when opened"""
+
+    def __init__(self, devices, samplerate=None, channels=1, dtype='float32', device=None, callback=None,
+                 finished_callback=None, **kwargs):
+        self.devices = devices
+        self.samplerate = samplerate or devices.samplerate
+        self.channels = channels
+        self.dtype = dtype
+        self.device = device or 0
+        self.callback = callback
+        self.finished_callback = finished_callback
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='fake-input-stream', daemon=True)
+
+    def __enter__(self):
+        self.devices.streams_opened += 1
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        position = self.devices.position(self.device, self.samplerate)
+        frames = self.devices.blocksize
+        try:
+            while not self.stopped.is_set():
+                block = self.devices.read(position, frames, self.channels, self.samplerate, self.dtype)
+                self.callback(block, frames, None, '')
+                position += frames
+                time.sleep(frames / self.samplerate / self.devices.speed)
+        except CallbackStop:
+            pass
+        finally:
+            if self.finished_callback is not None:
+                self.finished_callback()
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass  # Evicted while walking
+    return total
+
+
+def process_rss_mb(pid='self'):
+    """Resident set size from /proc, or the peak RSS where /proc is missing (own process only)"""
+    try:
+        with open(f"/proc/{pid}/status") as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if pid != 'self':
+        return 0.0
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / MB if sys.platform == 'darwin' else peak / 1024
+
+
+def open_fds():
+    for fd_dir in ('/proc/self/fd', '/dev/fd'):
+        if os.path.isdir(fd_dir):
+            return len(os.listdir(fd_dir))
+    return 0
+
+
+class ResourceSampler:
+    """Samples of the app's resources, taken every few cycles"""
+
+    def __init__(self, window, trace=True):
+        self.window = window
+        self.trace = trace
+        self.samples = []
+        self.baseline_snapshot = None
+
+    def sample(self, cycle):
+        import multiprocessing
+        window = self.window
+        workers = multiprocessing.active_children()
+        sample = {
+            'cycle': cycle,
+            'time': time.monotonic(),
+            'rss_mb': process_rss_mb(),
+            'worker_rss_mb': sum(process_rss_mb(worker.pid) for worker in workers),
+            'workers': len(workers),
+            'fds': open_fds(),
+            'threads': threading.active_count(),
+            'os_threads': len(os.listdir('/proc/self/task')) if os.path.isdir('/proc/self/task') else 0,
+            'traced_mb': tracemalloc.get_traced_memory()[0] / MB if self.trace else 0.0,
+            'cache_mb': directory_size(window.cache_dir) / MB,
+            'archive_mb': directory_size(window.archive_dir) / MB,
+            'history_mb': directory_size(window.daily_history_dir) / MB,
+            'history_rows': len(window.history_model.songs),
+            'log_lines': window.log_area.document().blockCount(),
+            'temp_files': len(os.listdir(tempfile.gettempdir())),
+        }
+        self.samples.append(sample)
+        return sample
+
+    def mark_baseline(self):
+        if self.trace:
+            self.baseline_snapshot = tracemalloc.take_snapshot()
+
+    def top_allocations(self, count):
+        """Allocation sites that grew the most since the baseline"""
+        if self.baseline_snapshot is None:
+            return []
+        stats = tracemalloc.take_snapshot().compare_to(self.baseline_snapshot, 'lineno')
+        return [(str(stat.traceback), stat.size_diff, stat.count_diff) for stat in stats[:count]]
+
+
+def growth(samples, metric, window=3):
+    """Growth of a metric over the run: median of the last samples minus median of the first ones"""
+    if len(samples) < 2:
+        return 0.0
+    window = max(1, min(window, len(samples) // 2))
+    return (statistics.median(sample[metric] for sample in samples[-window:])
+            - statistics.median(sample[metric] for sample in samples[:window]))
+
+
+def evaluate(samples, args, cache_max_mb):
+    """Threshold checks as (name, value, limit, passed)"""
+    checks = [
+        ('rss_mb growth', growth(samples, 'rss_mb'), args.max_rss_growth_mb),
+        ('worker_rss_mb growth', growth(samples, 'worker_rss_mb'), args.max_worker_rss_growth_mb),
+        ('fds growth', growth(samples, 'fds'), args.max_fd_growth),
+        ('threads growth', growth(samples, 'threads'), args.max_thread_growth),
+        ('os_threads growth', growth(samples, 'os_threads'), args.max_thread_growth),
+        ('traced_mb growth', growth(samples, 'traced_mb'), args.max_tracemalloc_growth_mb),
+        ('temp_files growth', growth(samples, 'temp_files'), args.max_temp_file_growth),
+        # The cache is trimmed in the background, so it may briefly go over its limit
+        ('cache_mb max', max(sample['cache_mb'] for sample in samples), cache_max_mb * 1.25),
+        ('history_rows max', max(sample['history_rows'] for sample in samples), args.max_daily_history),
+    ]
+    return [(name, value, limit, value <= limit) for name, value, limit in checks]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Soak test Shazam Forever with fake audio devices and a mock Shazam server')
+    parser.add_argument('fixtures', nargs='+', help='Audio files the fake devices play, also catalogued by the mock server')
+    parser.add_argument('--cycles', type=int, default=2000, help='Recording cycles (captures started) to run')
+    parser.add_argument('--cycle-ms', type=int, default=100, help='Real time between two cycles (30 s in the app)')
+    parser.add_argument('--speed', type=float, default=100.0, help='How much faster than real time the fake devices play')
+    parser.add_argument('--devices', type=int, default=2, help='Fake input devices, all listened to')
+    parser.add_argument('--native-rate', type=int, help='Only sample rate the fake devices support (default: any)')
+    parser.add_argument('--sample-every', type=int, default=50, help='Cycles between two resource samples')
+    parser.add_argument('--warmup-cycles', type=int, help='Cycles before the baseline sample (default: 10%% of the cycles)')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='Latency of the mock server')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of mock server requests failing with a 5xx')
+    parser.add_argument('--cache-max-mb', type=float, default=8.0, help='Recording cache limit, lowered so eviction runs')
+    parser.add_argument('--max-daily-history', type=int, default=200, help="Today's history limit, lowered so trimming runs")
+    parser.add_argument('--max-rss-growth-mb', type=float, default=50.0)
+    parser.add_argument('--max-worker-rss-growth-mb', type=float, default=50.0)
+    parser.add_argument('--max-fd-growth', type=float, default=5)
+    parser.add_argument('--max-thread-growth', type=float, default=3)
+    parser.add_argument('--max-tracemalloc-growth-mb', type=float, default=10.0)
+    parser.add_argument('--max-temp-file-growth', type=float, default=2)
+    parser.add_argument('--tracemalloc-frames', type=int, default=1, help='Traceback depth of tracemalloc (0 to disable it)')
+    parser.add_argument('--top', type=int, default=10, help='Allocation sites to list')
+    parser.add_argument('--json', help='Write the samples and checks to this file')
+    parser.add_argument('--quiet', action='store_true', help="Hide the app's own output")
+    args = parser.parse_args()
+    warmup_cycles = args.warmup_cycles if args.warmup_cycles is not None else args.cycles // 10
+
+    # History, cache, archive and temporary recordings go to a scratch HOME
+    home = tempfile.mkdtemp(prefix='shazam-soak-')
+    os.environ['HOME'] = home
+    tempfile.tempdir = os.path.join(home, 'tmp')
+    os.makedirs(tempfile.tempdir)
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    sys.path.insert(0, REPO_DIR)
+
+    # The app imports sounddevice lazily, so the fake one only has to be registered first
+    devices = FakeDevices(args.fixtures, args.devices, args.speed)
+    devices.native_rate = args.native_rate
+    sys.modules['sounddevice'] = devices.module()
+
+    from custom_shazam_api import Shazam
+    from custom_shazam_api.loadtest import start_mock_server_thread
+    from custom_shazam_api.matcher import LocalMatcher
+    from custom_shazam_api.mock_server import MockShazamServer, add_files_to_catalogue
+    from custom_shazam_api.ratelimit import install_request_guard
+    server = MockShazamServer(add_files_to_catalogue(LocalMatcher(), args.fixtures),
+                              latency_ms=args.latency_ms, error_rate=args.error_rate)
+    Shazam.api_url = start_mock_server_thread(server)
+
+    from PyQt6.QtWidgets import QApplication, QMessageBox
+    from PyQt6.QtCore import QTimer
+    import shazam_forever
+
+    # Dialogs would block a headless run: record them instead
+    dialogs = []
+    for kind in ('warning', 'critical', 'information'):
+        setattr(QMessageBox, kind, staticmethod(
+            lambda parent, title, text, *rest, kind=kind, **kwargs: dialogs.append((kind, title, text))))
+
+    app = QApplication([])
+    window = shazam_forever.ShazamApp()
+    window.max_daily_history = args.max_daily_history
+    window.cache_max_bytes = window.recording_cache.max_bytes = int(args.cache_max_mb * MB)
+    # Cycles come much faster than the real request budget allows
+    window.request_guard_options.update(rate=1000.0, burst=1000)
+    window.request_guard = install_request_guard(**window.request_guard_options)
+
+    if args.tracemalloc_frames > 0:
+        tracemalloc.start(args.tracemalloc_frames)
+    sampler = ResourceSampler(window, trace=args.tracemalloc_frames > 0)
+    capture = window.recognition_pipeline.stage('capture')
+    cycle_timer = QTimer()
+    cycle_timer.timeout.connect(window.record_and_identify)
+    poll_timer = QTimer()
+    state = {'next_sample': warmup_cycles, 'stopping_since': None, 'started': None}
+    real_stdout = sys.stdout
+
+    def start():
+        # Queued after the window's own deferred device enumeration
+        for index, name in enumerate(devices.names[1:], 1):
+            window.extra_sources.append(window.get_source(index, name))
+        window.start_listening()
+        window.timer.stop()  # Cycles are driven by cycle_timer instead
+        cycle_timer.start(args.cycle_ms)
+        poll_timer.start(50)
+        state['started'] = time.monotonic()
+
+    def poll():
+        cycles = capture.counters['started']
+        if state['stopping_since'] is None:
+            if cycles >= state['next_sample']:
+                if not sampler.samples:
+                    sampler.mark_baseline()
+                sample = sampler.sample(cycles)
+                state['next_sample'] += args.sample_every
+                print(f"cycle {cycles:6}: rss {sample['rss_mb']:7.1f} MB, workers {sample['worker_rss_mb']:7.1f} MB, "
+                      f"fds {sample['fds']:4}, threads {sample['threads']:3}, traced {sample['traced_mb']:6.1f} MB, "
+                      f"cache {sample['cache_mb']:5.1f} MB, history {sample['history_rows']}", file=real_stdout)
+            if cycles >= args.cycles:
+                cycle_timer.stop()
+                window.stop_listening()
+                state['stopping_since'] = time.monotonic()
+        elif not window.recognition_pipeline.busy() or time.monotonic() - state['stopping_since'] > 30:
+            poll_timer.stop()
+            sampler.sample(cycles)
+            app.quit()
+
+    poll_timer.timeout.connect(poll)
+    QTimer.singleShot(0, start)
+
+    if args.quiet:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        app.exec()
+    finally:
+        sys.stdout = real_stdout
+    duration = time.monotonic() - state['started']
+
+    samples = sampler.samples
+    checks = evaluate(samples, args, args.cache_max_mb)
+    metrics = window.recognition_pipeline.metrics()
+    top = sampler.top_allocations(args.top)
+
+    print(f"\n{capture.counters['started']} cycles in {duration:.0f} s ({devices.streams_opened} streams), "
+          f"{metrics['ui']['completed']} results shown, server {server.stats}, {len(dialogs)} dialogs")
+    print(f"Pipeline: {window.recognition_pipeline.describe()}")
+    print(f"Samples after {warmup_cycles} warm-up cycles: {len(samples)}, archive {samples[-1]['archive_mb']:.1f} MB, "
+          f"history files {samples[-1]['history_mb']:.2f} MB, log lines {samples[-1]['log_lines']}")
+    for kind, title, text in dialogs[:5]:
+        print(f"  dialog ({kind}) {title}: {text}")
+    if top:
+        print(f"Top {len(top)} allocation sites since the baseline:")
+        for site, size_diff, count_diff in top:
+            print(f"  {size_diff / 1024:+10.1f} KiB {count_diff:+8} blocks  {site}")
+    print('Checks:')
+    failed = False
+    for name, value, limit, passed in checks:
+        failed = failed or not passed
+        print(f"  {'ok  ' if passed else 'FAIL'} {name:22} {value:10.2f} (limit {limit:g})")
+    if metrics['ui']['completed'] == 0:
+        failed = True
+        print('  FAIL no recognition result reached the UI')
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({'samples': samples, 'pipeline': metrics, 'server': server.stats, 'dialogs': dialogs,
+                       'top_allocations': top,
+                       'checks': [{'name': name, 'value': value, 'limit': limit, 'passed': passed}
+                                  for name, value, limit, passed in checks]}, json_file, indent=2)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""Accuracy of the float32 audio path against the float64 one"""
+from io import BytesIO
+
+import numpy as np
+import pytest
+
+from custom_shazam_api.accuracy import compare_signatures, float32_report
+from custom_shazam_api.spectrogram import SpectrogramSession
+
+sf = pytest.importorskip('soundfile')
+
+
+def song_wav(seconds, samplerate=44100):
+    """Stereo tones and noise, at a rate that has to be resampled"""
+    rng = np.random.default_rng(1)
+    time = np.arange(int(seconds * samplerate)) / samplerate
+    tones = sum(np.sin(2 * np.pi * frequency * time) * (time % 1.5 < 0.75) for frequency in (440, 660, 1250, 2500))
+    mono = tones * 0.15 + rng.standard_normal(len(time)) * 0.05
+    with BytesIO() as wav_data:
+        sf.write(wav_data, np.stack([mono, mono * 0.8], axis=1), samplerate, format='WAV', subtype='PCM_16')
+        return wav_data.getvalue()
+
+
+def test_a_signature_compared_with_itself():
+    samples = (np.random.default_rng(0).standard_normal(3 * 16000) * 3000).astype(np.int16)
+    session = SpectrogramSession()
+    session.feed(samples)
+    signature = session.signature()
+
+    comparison = compare_signatures(signature, signature)
+
+    assert comparison['identical_peaks'] == comparison['reference_peaks'] > 0
+    assert (comparison['recall'], comparison['precision'], comparison['max_bin_error']) == (1., 1., 0)
+
+
+def test_float32_path_finds_the_float64_peaks_and_matches():
+    report = float32_report(song_wav(10))
+
+    assert report['seconds'] == 10.
+    assert report['max_sample_difference'] <= 1  # Rounding of the resampled int16 samples
+    assert report['signature']['recall'] >= 0.99 and report['signature']['precision'] >= 0.99
+    assert report['signature']['max_bin_error'] <= 64  # Within one FFT bin
+    assert report['excerpts_matched'] == report['excerpts_matched_float64'] == len(report['excerpts'])
+    assert report['bytes_per_second']['float32']['frames'] * 2 == report['bytes_per_second']['float64']['frames']
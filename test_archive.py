@@ -0,0 +1,111 @@
+"""Signature archive: records found through the footer index, or by scanning when the writer crashed"""
+import numpy as np
+import pytest
+
+from custom_shazam_api.archive import (FILE_HEADER, FOOTER_TRAILER, SignatureArchiveReader, SignatureArchiveWriter,
+                                       read_footer, replay)
+from custom_shazam_api.spectrogram import SpectrogramSession
+
+
+def signature(seed):
+    samples = (np.random.default_rng(seed).standard_normal(3 * 16000) * 3000).astype(np.int16)
+    session = SpectrogramSession()
+    session.feed(samples)
+    return session.signature()
+
+
+RESULT = {'track': {'title': 'Song'}, 'matches': [{'id': '1'}]}
+
+
+def write_archive(path, count, close=True):
+    writer = SignatureArchiveWriter(path)
+    for position in range(count):
+        writer.append(signature(position), 1000. + position, 'Mic' if position % 2 else 'Line in',
+                      RESULT if position % 3 == 0 else None)
+    if close:
+        writer.close()
+    else:
+        writer.flush()
+    return writer
+
+
+def check_records(reader, count):
+    assert len(reader) == count
+    for position, record in enumerate(reader):
+        assert record.timestamp == 1000. + position
+        assert record.device == ('Mic' if position % 2 else 'Line in')
+        assert record.result == (RESULT if position % 3 == 0 else None)
+        assert bytes(record.signature_bytes) == signature(position).encode_to_binary()
+
+
+def test_records_are_read_back_through_the_footer(tmp_path):
+    path = str(tmp_path / 'archive.szs')
+    write_archive(path, 5)
+
+    with open(path, 'rb') as archive_file:
+        data = archive_file.read()
+    assert read_footer(data, len(data)) is not None
+
+    with SignatureArchiveReader(path) as reader:
+        check_records(reader, 5)
+        assert [record.timestamp for record in reader.between(1001., 1003.)] == [1001., 1002.]
+        assert [record.timestamp for record in reader.unidentified()] == [1001., 1002., 1004.]
+        assert reader[2].signature.encode_to_binary() == signature(2).encode_to_binary()
+
+
+def test_an_archive_without_footer_is_scanned(tmp_path):
+    path = str(tmp_path / 'archive.szs')
+    writer = write_archive(path, 4, close=False)  # The process died before close()
+    with open(path, 'ab') as archive_file:
+        archive_file.write(b'\x43\x52\x53\x5a\xff\xff')  # And in the middle of a record
+
+    with open(path, 'rb') as archive_file:
+        data = archive_file.read()
+    assert read_footer(data, len(data)) is None
+
+    with SignatureArchiveReader(path) as reader:
+        check_records(reader, 4)
+
+    writer._file.close()
+
+
+def test_appending_reopens_after_the_last_whole_record(tmp_path):
+    path = str(tmp_path / 'archive.szs')
+    write_archive(path, 2)
+    write_archive(path + '.crashed', 2, close=False)._file.close()
+    with open(path + '.crashed', 'ab') as archive_file:
+        archive_file.write(b'partial')
+
+    for archive_path in (path, path + '.crashed'):
+        with SignatureArchiveWriter(archive_path) as writer:
+            assert len(writer) == 2
+            assert writer.append(signature(2), 1002., 'Line in') == 2
+        with SignatureArchiveReader(archive_path) as reader:
+            check_records(reader, 3)
+
+    with open(path, 'rb') as archive_file:
+        data = archive_file.read()
+    assert FOOTER_TRAILER.unpack_from(data, len(data) - FOOTER_TRAILER.size)[1] == 3
+
+
+def test_something_else_is_no_archive(tmp_path):
+    path = tmp_path / 'other.bin'
+    path.write_bytes(b'\0' * FILE_HEADER.size)
+    with pytest.raises(ValueError):
+        SignatureArchiveReader(str(path))
+
+
+def test_replay_sends_every_signature_again(tmp_path):
+    path = str(tmp_path / 'archive.szs')
+    write_archive(path, 3)
+    sent = []
+
+    def recognize(decoded_signature):
+        sent.append(decoded_signature.encode_to_binary())
+        return {'matches': []}
+
+    with SignatureArchiveReader(path) as reader:
+        responses = [(record.timestamp, response) for record, response in replay(reader.unidentified(), recognize)]
+
+    assert responses == [(1001., {'matches': []}), (1002., {'matches': []})]
+    assert sent == [signature(1).encode_to_binary(), signature(2).encode_to_binary()]
@@ -0,0 +1,77 @@
+"""SignatureBudget: per-band and total peak caps, and the stop rule of the signature generator"""
+import numpy as np
+
+from custom_shazam_api.algorithm import SignatureBudget, SignatureGenerator, strongest_peaks
+from custom_shazam_api.signature_format import FrequencyBand, FrequencyPeak
+
+
+def samples(seconds, seed=0):
+    time = np.arange(int(seconds * 16000)) / 16000
+    tones = sum(np.sin(2 * np.pi * frequency * time) * (time % 0.7 < 0.35) for frequency in (400, 900, 2000, 4000))
+    noise = np.random.default_rng(seed).standard_normal(len(time))
+    return ((tones * 0.1 + noise * 0.1) * 32767).astype(np.int16)
+
+
+def signature(seconds=8., budget=None):
+    generator = SignatureGenerator()
+    generator.MAX_TIME_SECONDS = seconds
+    generator.MAX_PEAKS = 10 ** 6
+    generator.budget = budget
+    generator.feed_input(samples(seconds).tolist())
+    return generator.get_next_signature()
+
+
+def peak_keys(peaks):
+    return [(peak.fft_pass_number, peak.corrected_peak_frequency_bin, peak.peak_magnitude) for peak in peaks]
+
+
+def test_strongest_peaks_keep_their_order():
+    peaks = [FrequencyPeak(number, magnitude, 1000 + number, 16000) for number, magnitude in enumerate([5, 9, 1, 9, 7])]
+    assert [peak.fft_pass_number for peak in strongest_peaks(peaks, 3)] == [1, 3, 4]
+    assert [peak.fft_pass_number for peak in strongest_peaks(peaks, 2)] == [1, 3]  # The earliest first on ties
+    assert strongest_peaks(peaks, 0) == [] and len(strongest_peaks(peaks, 10)) == 5
+
+
+def test_band_caps():
+    full = signature()
+    pruned = SignatureBudget({FrequencyBand._520_1450: 10, FrequencyBand._1450_3500: 0}).prune(signature())
+
+    bands = pruned.frequency_band_to_sound_peaks
+    assert FrequencyBand._1450_3500 not in bands
+    assert peak_keys(bands[FrequencyBand._520_1450]) == peak_keys(
+        strongest_peaks(full.frequency_band_to_sound_peaks[FrequencyBand._520_1450], 10))
+    assert peak_keys(bands[FrequencyBand._250_520]) == peak_keys(full.frequency_band_to_sound_peaks[FrequencyBand._250_520])
+
+
+def test_total_cap_keeps_exactly_the_strongest_in_order():
+    full = signature()
+    all_peaks = [peak for peaks in full.frequency_band_to_sound_peaks.values() for peak in peaks]
+    assert len(all_peaks) > 50
+
+    pruned = SignatureBudget(max_total_peaks=50).prune(signature())
+
+    kept = [peak for peaks in pruned.frequency_band_to_sound_peaks.values() for peak in peaks]
+    assert len(kept) == 50
+    assert peak_keys(kept) == peak_keys(strongest_peaks(all_peaks, 50))
+    for peaks in pruned.frequency_band_to_sound_peaks.values():
+        assert [peak.fft_pass_number for peak in peaks] == sorted(peak.fft_pass_number for peak in peaks)
+    assert pruned.encode_to_binary() != full.encode_to_binary()
+
+
+def test_stop_at_first_limit():
+    def first_signature(budget):
+        generator = SignatureGenerator()
+        generator.MAX_TIME_SECONDS, generator.MAX_PEAKS = 3.1, 40
+        generator.budget = budget
+        generator.feed_input(samples(10).tolist())
+        return generator.get_next_signature()
+
+    def peak_count(signature):
+        return sum(len(peaks) for peaks in signature.frequency_band_to_sound_peaks.values())
+
+    both_limits = first_signature(None)
+    first_limit = first_signature(SignatureBudget(stop_at_first_limit=True))
+
+    assert both_limits.number_samples >= 3.1 * 16000 and peak_count(both_limits) >= 40
+    assert first_limit.number_samples < 3.1 * 16000 and peak_count(first_limit) >= 40
+    assert first_limit.number_samples < both_limits.number_samples
@@ -0,0 +1,71 @@
+"""RecordingCache: signatures computed on the writer thread, and eviction when idle"""
+import os
+import time
+from io import BytesIO
+
+import numpy as np
+import pytest
+
+from custom_shazam_api.cache import FORMAT_SIGNATURE, RecordingCache
+
+sf = pytest.importorskip('soundfile')
+
+
+def wav_bytes(seconds):
+    samples = (np.random.default_rng(0).standard_normal(int(seconds * 16000)) * 3000).astype(np.int16)
+    with BytesIO() as wav_data:
+        sf.write(wav_data, samples, 16000, format='WAV', subtype='PCM_16')
+        return wav_data.getvalue()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    recording_cache = RecordingCache(str(tmp_path), storage_format=FORMAT_SIGNATURE)
+    yield recording_cache
+    recording_cache.close()
+
+
+def test_signature_of_a_recording_is_stored(cache):
+    cache.put('recording', wav_bytes(3))
+    cache.flush()
+    path = cache.get_path('recording')
+    assert path is not None and os.path.getsize(path) > 0
+
+
+def test_recording_too_short_for_a_signature_leaves_no_file(cache, tmp_path):
+    cache.put('too_short', wav_bytes(0.005))  # 80 samples, less than one 128 sample hop
+    cache.flush()
+    assert 'too_short' not in cache
+    assert not (tmp_path / 'too_short.sig').exists()
+
+
+def test_entries_expired_while_closed_are_evicted_at_startup(tmp_path):
+    recording_cache = RecordingCache(str(tmp_path), storage_format=FORMAT_SIGNATURE)
+    recording_cache.put('old', wav_bytes(3))
+    recording_cache.put('recent', wav_bytes(3))
+    recording_cache.flush()
+    recording_cache.get_entry('old').created -= 3600
+    recording_cache.set_metadata('recent', {'title': 'Song'})  # Saves the index with the older time
+    recording_cache.close()
+
+    reopened = RecordingCache(str(tmp_path), max_age_seconds=600, storage_format=FORMAT_SIGNATURE)
+    reopened.flush()
+    assert 'old' not in reopened and 'recent' in reopened
+    assert not (tmp_path / 'old.sig').exists()
+    reopened.close()
+
+
+def test_entries_expire_while_nothing_is_written(tmp_path):
+    recording_cache = RecordingCache(str(tmp_path), max_age_seconds=0.3, storage_format=FORMAT_SIGNATURE,
+                                     evict_interval=0.05)
+    recording_cache.put('recording', wav_bytes(3))
+    recording_cache.flush()
+    assert 'recording' in recording_cache
+
+    deadline = time.monotonic() + 5
+    while 'recording' in recording_cache and time.monotonic() < deadline:
+        time.sleep(0.05)
+    recording_cache.close()
+
+    assert 'recording' not in recording_cache
+    assert not (tmp_path / 'recording.sig').exists()
@@ -0,0 +1,48 @@
+"""Streaming decoder: signatures of audio streamed through ffmpeg, in bounded chunks"""
+import shutil
+
+import numpy as np
+import pytest
+
+from custom_shazam_api.decoder import FFMPEG, DecodeError, decode_pcm, iter_signatures, stream_signature
+from custom_shazam_api.parallel import generate_signature_parallel
+
+pytestmark = pytest.mark.skipif(shutil.which(FFMPEG) is None, reason="ffmpeg is not on PATH")
+
+
+@pytest.fixture(scope='module')
+def song_path(tmp_path_factory):
+    import soundfile as sf
+    rng = np.random.default_rng(1)
+    time = np.arange(12 * 16000) / 16000
+    tones = sum(np.sin(2 * np.pi * frequency * time) * (time % 1.5 < 0.75) for frequency in (440, 660, 1250, 2500))
+    samples = ((tones * 0.15 + rng.standard_normal(len(time)) * 0.05) * 32767).astype(np.int16)
+    path = str(tmp_path_factory.mktemp('decoder') / 'song.wav')
+    sf.write(path, samples, 16000, subtype='PCM_16')
+    return path
+
+
+@pytest.mark.parametrize('chunk_seconds', [0.3, 1., 5.])
+def test_streamed_signature_is_the_whole_file_signature(song_path, chunk_seconds):
+    whole_file = generate_signature_parallel(decode_pcm(song_path), chunk_seconds=4.)
+    streamed = stream_signature(song_path, chunk_seconds)
+    assert streamed.number_samples == whole_file.number_samples
+    assert streamed.encode_to_binary() == whole_file.encode_to_binary()
+
+
+def test_streaming_from_bytes_or_path_is_the_same(song_path):
+    with open(song_path, 'rb') as song_file:
+        song_data = song_file.read()
+    assert stream_signature(song_data).encode_to_binary() == stream_signature(song_path).encode_to_binary()
+
+
+def test_iter_signatures_covers_the_file(song_path):
+    signatures = list(iter_signatures(song_path))
+    offsets = [offset for offset, signature in signatures]
+    assert offsets == sorted(offsets) and offsets[-1] == pytest.approx(12, abs=0.01)
+    assert all(signature.number_samples <= 8 * 16000 for offset, signature in signatures)
+
+
+def test_unreadable_input_raises_decode_error(tmp_path):
+    with pytest.raises(DecodeError):
+        stream_signature(str(tmp_path / 'missing.mp3'))
@@ -0,0 +1,76 @@
+"""DeviceRegistry: change detection by device id, and re-initialization held off by open streams"""
+from custom_shazam_api.devices import DeviceRegistry, device_ids
+
+
+def device(index, name, hostapi=0, inputs=2):
+    return {'index': index, 'name': name, 'hostapi': hostapi, 'max_input_channels': inputs, 'max_output_channels': 0}
+
+
+class FakeDevices:
+    """Devices listed by a DeviceRegistry, recording whether PortAudio would have been re-initialized"""
+
+    def __init__(self, *devices):
+        self.devices = list(devices)
+        self.calls = []
+
+    def __call__(self, reinitialize):
+        self.calls.append(reinitialize)
+        return [dict(listed) for listed in self.devices]
+
+
+def registry(*devices):
+    fake_devices = FakeDevices(*devices)
+    device_registry = DeviceRegistry(enumerate_function=fake_devices)
+    changes = []
+    device_registry.add_listener(lambda added, removed: changes.append((
+        [listed['index'] for listed in added], [listed['index'] for listed in removed])))
+    return device_registry, fake_devices, changes
+
+
+def test_identical_devices_get_ordinals():
+    ids = device_ids([device(3, 'USB Audio Device'), device(1, 'USB Audio Device'), device(2, 'USB Audio Device', 1)])
+    assert ids == {1: ('USB Audio Device', 0, 0), 3: ('USB Audio Device', 0, 1), 2: ('USB Audio Device', 1, 0)}
+
+
+def test_the_first_enumeration_is_no_change():
+    device_registry, fake_devices, changes = registry(device(0, 'Mic'), device(1, 'Speakers', inputs=0))
+    assert device_registry.refresh() == ([], [])
+    assert [listed['name'] for listed in device_registry.input_devices()] == ['Mic']
+    assert changes == []
+
+
+def test_added_removed_and_moved_devices():
+    device_registry, fake_devices, changes = registry(device(0, 'Mic'), device(1, 'USB Audio Device'))
+    device_registry.refresh()
+
+    fake_devices.devices.append(device(2, 'USB Audio Device'))  # An identical one is plugged in
+    added, removed = device_registry.refresh()
+    assert [listed['index'] for listed in added] == [2] and removed == []
+    assert device_registry.device_id(2) == ('USB Audio Device', 0, 1)
+
+    fake_devices.devices = [device(0, 'USB Audio Device'), device(1, 'USB Audio Device')]  # The mic goes away
+    added, removed = device_registry.refresh()
+    assert added == [] and [listed['name'] for listed in removed] == ['Mic']
+    assert device_registry.find_id(('USB Audio Device', 0, 1))['index'] == 1
+    assert not device_registry.is_available(2)
+
+    fake_devices.devices = [device(5, 'USB Audio Device'), device(6, 'USB Audio Device')]  # Renumbered only
+    assert device_registry.refresh() == ([], [])
+    assert device_registry.find_id(('USB Audio Device', 0, 0))['index'] == 5
+
+    assert device_registry.refresh() == ([], [])  # Nothing changed
+    assert changes == [([2], []), ([], [0]), ([], [])]
+
+
+def test_reinitialization_waits_for_open_streams():
+    device_registry, fake_devices, changes = registry(device(0, 'Mic'))
+    device_registry.refresh()
+
+    with device_registry.stream_open():
+        device_registry.request_reinitialize()
+        device_registry.refresh()
+        device_registry.refresh(reinitialize=True)
+
+    device_registry.refresh()
+    device_registry.refresh()
+    assert fake_devices.calls == [False, False, False, True, False]
@@ -0,0 +1,82 @@
+"""ChangeGate decisions, and the LevelMeter updates fed from capture callbacks"""
+import numpy as np
+import pytest
+
+from custom_shazam_api.gate import (REASON_BELOW_THRESHOLD, REASON_CHANGED, REASON_FIRST_WINDOW, REASON_FORCED,
+                                    REASON_SILENT, REASON_UNCHANGED, ChangeGate, LevelMeter)
+
+RATE = 44100
+
+
+def window(frequencies, seconds=5., level=0.2, seed=0, start=0.):
+    """Tones and some noise, as int16: windows of the same frequencies sound like the same song"""
+    rng = np.random.default_rng(seed)
+    time = start + np.arange(int(seconds * RATE)) / RATE
+    tones = sum(np.sin(2 * np.pi * frequency * time) for frequency in frequencies) / len(frequencies)
+    return ((tones + rng.standard_normal(len(time)) * 0.1) * level * 32767).astype(np.int16)
+
+
+SONG = (440, 660, 1250, 2500)
+OTHER_SONG = (300, 900, 1800, 4000)
+
+
+def test_silent_and_quiet_windows_are_skipped():
+    gate = ChangeGate()
+    silent = gate.check(np.zeros(RATE, dtype=np.int16), RATE)
+    quiet = gate.check(window(SONG, level=0.004), RATE)  # About -57 dBFS RMS, peaks at -46 dBFS
+
+    assert (silent.should_recognize, silent.reason) == (False, REASON_SILENT)
+    assert (quiet.should_recognize, quiet.reason) == (False, REASON_BELOW_THRESHOLD)
+    assert gate.reference_profile is None and gate.consecutive_skips == 0
+
+
+def test_unchanged_content_is_skipped_until_forced():
+    gate = ChangeGate(max_consecutive_skips=2)
+    decisions = [gate.check(window(SONG, seed=seed, start=seed * 5.), RATE) for seed in range(5)]
+
+    assert [decision.reason for decision in decisions] == [
+        REASON_FIRST_WINDOW, REASON_UNCHANGED, REASON_UNCHANGED, REASON_FORCED, REASON_UNCHANGED]
+    assert [decision.should_recognize for decision in decisions] == [True, False, False, True, False]
+    assert all(decision.similarity >= gate.similarity_threshold for decision in decisions[1:])
+
+
+def test_changed_content_is_recognized():
+    gate = ChangeGate()
+    gate.check(window(SONG), RATE)
+    decision = gate.check(window(OTHER_SONG, seed=1), RATE)
+
+    assert (decision.should_recognize, decision.reason) == (True, REASON_CHANGED)
+    assert decision.similarity < gate.similarity_threshold
+
+    gate.reset()
+    assert gate.check(window(OTHER_SONG, seed=2), RATE).reason == REASON_FIRST_WINDOW
+
+
+def test_gate_works_on_float_stereo():
+    gate = ChangeGate()
+    mono = window(SONG).astype(np.float32) / 32768
+    stereo = np.stack([mono, mono * 0.5], axis=1)
+    assert gate.check(stereo, RATE).reason == REASON_FIRST_WINDOW
+    assert gate.check(window(SONG, seed=1), RATE).reason == REASON_UNCHANGED
+
+
+@pytest.mark.parametrize('block_size', [64, 512, 4096])
+def test_level_meter_updates_about_20_times_a_second(block_size):
+    levels = []
+    meter = LevelMeter(RATE, on_level=lambda rms, peak: levels.append((rms, peak)))
+    samples = window(SONG, seconds=2.)
+
+    for start in range(0, len(samples), block_size):
+        meter.process(samples[start:start + block_size])
+
+    # Updates come at the end of the first block reaching 1/20 s, or after every block when blocks are longer
+    blocks_per_update = -(-meter.samples_per_update // block_size)
+    assert meter.samples_per_update == RATE // 20
+    assert len(levels) == len(samples) // (blocks_per_update * block_size)
+    if block_size == 64:
+        assert len(levels) == pytest.approx(40, abs=1)
+
+    floats = samples.astype(np.float64) / 32768
+    assert meter.rms == pytest.approx(np.sqrt(np.mean(floats ** 2)), rel=1e-4)
+    assert meter.total_peak == pytest.approx(np.abs(floats).max())
+    assert all(0 < rms <= peak for rms, peak in levels)
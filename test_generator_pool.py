@@ -0,0 +1,48 @@
+"""SignatureGeneratorPool: a reused generator gives the signatures of a fresh one"""
+import numpy as np
+import pytest
+
+from custom_shazam_api import kernels
+from custom_shazam_api.algorithm import SignatureBudget, SignatureGenerator, SignatureGeneratorPool
+
+
+def samples(seconds, seed):
+    return (np.random.default_rng(seed).standard_normal(int(seconds * 16000)) * 3000).astype(np.int16).tolist()
+
+
+def signatures(signature_generator, song):
+    signature_generator.feed_input(song)
+    found = []
+    while True:
+        signature = signature_generator.get_next_signature()
+        if not signature:
+            return found
+        found.append(signature.encode_to_binary())
+
+
+@pytest.fixture(params=kernels.available_backends())
+def backend(request):
+    previous_backend = kernels.get_backend()
+    kernels.set_backend(request.param)
+    yield request.param
+    kernels.set_backend(previous_backend)
+
+
+def test_a_released_generator_is_as_good_as_new(backend):
+    pool = SignatureGeneratorPool(max_idle=1)
+    song = samples(4, seed=1)
+
+    with pool.generator() as used:
+        # Left in another state: other limits, float32, a budget, and input not consumed yet
+        used.MAX_TIME_SECONDS, used.MAX_PEAKS = 1.5, 20
+        used.dtype = np.float32
+        used.budget = SignatureBudget(max_total_peaks=10, stop_at_first_limit=True)
+        used.feed_input(samples(3, seed=2))
+        assert used.get_next_signature()
+
+    with pool.generator() as reused:
+        assert reused is used
+        reused_signatures = signatures(reused, song)
+
+    assert len(reused_signatures) == 2
+    assert reused_signatures == signatures(SignatureGenerator(), song)
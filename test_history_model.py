@@ -0,0 +1,67 @@
+"""HistoryModel: songs inserted at their place, in batches, with older days loaded on demand"""
+import pytest
+
+QtCore = pytest.importorskip('PyQt6.QtCore')
+
+from shazam_forever import HistoryModel  # Only importable with PyQt6
+
+DISPLAY = QtCore.Qt.ItemDataRole.DisplayRole
+USER = QtCore.Qt.ItemDataRole.UserRole
+
+
+@pytest.fixture(scope='module', autouse=True)
+def application():
+    return QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([])
+
+
+def song(title, timestamp, source=None):
+    return {'title': title, 'artist': 'Artist', 'timestamp': timestamp, 'source': source}
+
+
+def titles(model):
+    return [model.data(model.index(row), USER)['title'] for row in range(model.rowCount())]
+
+
+def inserted_rows(model):
+    rows = []
+    model.rowsInserted.connect(lambda parent, first, last: rows.append((first, last)))
+    return rows
+
+
+def test_add_song_inserts_one_row_at_its_time():
+    model = HistoryModel()
+    model.set_songs([song('c', '20260101_120000'), song('a', '20260101_100000')])
+    rows = inserted_rows(model)
+
+    model.add_song(song('d', '20260101_130000'))
+    model.add_song(song('b', '20260101_110000'))  # A late match, backfilled
+
+    assert titles(model) == ['d', 'c', 'b', 'a']
+    assert rows == [(0, 0), (2, 2)]
+    assert model.data(model.index(0), DISPLAY) == 'd by Artist (2026-01-01 13:00:00)'
+
+
+def test_songs_are_shown_in_batches_and_older_days_loaded_last():
+    older_days = [[song('yesterday', '20251231_120000', 'Radio')]]
+    model = HistoryModel(load_older=lambda: older_days.pop() if older_days else None, batch_size=2)
+    model.set_songs([song(str(minute), '20260101_12%02d00' % minute) for minute in range(3, 0, -1)])
+    assert model.rowCount() == 2 and model.canFetchMore(QtCore.QModelIndex())
+
+    model.add_song(song('0', '20260101_120000'))  # Among the rows not fetched yet
+    assert model.rowCount() == 2
+
+    while model.canFetchMore(QtCore.QModelIndex()):
+        model.fetchMore(QtCore.QModelIndex())
+    assert titles(model) == ['3', '2', '1', '0', 'yesterday']
+    assert model.data(model.index(4), DISPLAY) == '[Radio] yesterday by Artist (2025-12-31 12:00:00)'
+
+
+def test_remove_song_removes_that_entry():
+    model = HistoryModel()
+    first, second = song('same', '20260101_120000'), song('same', '20260101_120000')
+    model.set_songs([first, second])
+
+    model.remove_song(second)
+
+    assert model.rowCount() == 1
+    assert model.data(model.index(0), USER) is first
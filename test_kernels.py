@@ -0,0 +1,49 @@
+"""Signature backends: the compiled kernel gives the same signatures as the Python code"""
+from io import BytesIO
+
+import numpy as np
+import pytest
+
+from custom_shazam_api import kernels
+from custom_shazam_api.api import Shazam
+
+pytestmark = pytest.mark.skipif(len(kernels.available_backends()) < 2, reason="only the Python backend is available")
+
+
+def noise_wav(seconds, seed=0):
+    import soundfile as sf
+    samples = (np.random.default_rng(seed).standard_normal(int(seconds * 16000)) * 3000).astype(np.int16)
+    with BytesIO() as wav_data:
+        sf.write(wav_data, samples, 16000, format='WAV', subtype='PCM_16')
+        return wav_data.getvalue()
+
+
+def signatures_of(song_data, backend):
+    """Every signature Shazam.recognizeSong() would send, with one backend"""
+    previous_backend = kernels.get_backend()
+    kernels.set_backend(backend)
+    try:
+        shazam = Shazam(song_data)
+        signature_generator = shazam.createSignatureGenerator(shazam.normalizateAudioData(song_data))
+        signatures = []
+        while True:
+            signature = signature_generator.get_next_signature()
+            if not signature:
+                return signatures
+            signatures.append(signature.encode_to_binary())
+    finally:
+        kernels.set_backend(previous_backend)
+
+
+def test_check_parity_on_a_short_clip():
+    report = kernels.check_parity(seconds=4)
+    assert report['identical']
+
+
+def test_backends_agree_on_a_clip_longer_than_36_seconds():
+    # recognizeSong() skips ahead in clips over 36 s, which used to move backwards below 96 s
+    song_data = noise_wav(40)
+    python_signatures = signatures_of(song_data, kernels.BACKEND_PYTHON)
+    numba_signatures = signatures_of(song_data, kernels.BACKEND_NUMBA)
+    assert len(python_signatures) == 5  # 40 s in 8 s signatures, from the start
+    assert numba_signatures == python_signatures
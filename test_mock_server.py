@@ -0,0 +1,121 @@
+"""serve_http keep-alive and limits, and the mock Shazam server matching catalogued audio end to end"""
+import asyncio
+import json
+from io import BytesIO
+
+import numpy as np
+import pytest
+
+from custom_shazam_api.api import Shazam
+from custom_shazam_api.loadtest import MODE_FULL, MODE_REQUEST, run_load_test, start_mock_server_thread
+from custom_shazam_api.matcher import LocalMatcher
+from custom_shazam_api.mock_server import MockShazamServer, add_files_to_catalogue, serve_http
+
+
+async def read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise asyncio.IncompleteReadError(b'', None)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers['content-length']))
+    return int(status_line.split()[1]), headers, json.loads(body)
+
+
+def exchange(requests, max_body_bytes=None):
+    """Send raw requests on one connection to serve_http, returning the responses and what the handler saw"""
+    seen = []
+
+    async def handle(method, target, headers, body):
+        seen.append((method, target, body))
+        if target == '/fail':
+            raise KeyError('bug')
+        return 200, {'length': len(body)}, {'X-Request': str(len(seen))}
+
+    async def main():
+        server = await asyncio.start_server(lambda reader, writer: serve_http(reader, writer, handle, max_body_bytes),
+                                            '127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+        responses = []
+        for request in requests:
+            writer.write(request)
+            await writer.drain()
+            try:
+                responses.append(await asyncio.wait_for(read_response(reader), 5))
+            except asyncio.IncompleteReadError:
+                responses.append(None)  # The server closed the connection
+        closed = await asyncio.wait_for(reader.read(), 5) == b''
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return responses, closed
+
+    responses, closed = asyncio.run(main())
+    return responses, seen, closed
+
+
+def post(target, body, *headers):
+    return (b'POST %s HTTP/1.1\r\nHost: test\r\nContent-Length: %d\r\n' % (target.encode(), len(body)) +
+            b''.join(header + b'\r\n' for header in headers) + b'\r\n' + body)
+
+
+def test_requests_share_a_keep_alive_connection():
+    responses, seen, closed = exchange([post('/a', b'one'), post('/fail', b''), post('/b', b'three', b'Connection: close')])
+
+    assert [status for status, headers, payload in responses] == [200, 500, 200]
+    assert responses[0][2] == {'length': 3} and responses[0][1]['x-request'] == '1'
+    assert responses[2][2] == {'length': 5}
+    assert seen == [('POST', '/a', b'one'), ('POST', '/fail', b''), ('POST', '/b', b'three')]
+    assert closed  # After the "Connection: close" request
+
+
+def test_bodies_over_the_limit_are_refused_unread():
+    responses, seen, closed = exchange([post('/a', b'x' * 100), post('/a', b'')], max_body_bytes=10)
+
+    status, headers, payload = responses[0]
+    assert status == 413 and 'error' in payload
+    assert responses[1] is None and closed
+    assert seen == []
+
+
+@pytest.fixture(scope='module')
+def song_path(tmp_path_factory):
+    sf = pytest.importorskip('soundfile')
+    rng = np.random.default_rng(3)
+    time = np.arange(20 * 16000) / 16000
+    tones = sum(np.sin(2 * np.pi * frequency * time) * (time % period < period / 2)
+                for frequency, period in ((440, 1.1), (880, 1.7), (1320, 0.9), (2640, 1.3)))
+    samples = ((tones * 0.15 + rng.standard_normal(len(time)) * 0.05) * 32767).astype(np.int16)
+    path = str(tmp_path_factory.mktemp('mock_server') / 'Catalogued Song.wav')
+    sf.write(path, samples, 16000, subtype='PCM_16')
+    return path
+
+
+def excerpt(path, start, seconds):
+    import soundfile as sf
+    samples, samplerate = sf.read(path, dtype='int16')
+    with BytesIO() as wav_data:
+        sf.write(wav_data, samples[int(start * samplerate):int((start + seconds) * samplerate)], samplerate,
+                 format='WAV', subtype='PCM_16')
+        return wav_data.getvalue()
+
+
+@pytest.mark.parametrize('mode', [MODE_FULL, MODE_REQUEST])
+def test_the_mock_server_matches_a_catalogued_file(song_path, mode, monkeypatch):
+    monkeypatch.setattr(Shazam, 'api_url', Shazam.api_url)
+    monkeypatch.setattr(Shazam, 'guard', None)
+    server = MockShazamServer(add_files_to_catalogue(LocalMatcher(), [song_path]))
+    api_url = start_mock_server_thread(server)  # On an ephemeral port
+
+    report = run_load_test([excerpt(song_path, 6., 5.), excerpt(song_path, 12.5, 4.)], api_url, clients=2,
+                           total_requests=4, mode=mode)
+
+    assert report['outcomes'] == {'matched': 4, 'unmatched': 0}
+    assert server.stats['requests'] == server.stats['matches'] == 4
+    response = next(Shazam(excerpt(song_path, 12.5, 4.)).recognizeSong())[1]
+    assert response['track']['title'] == 'Catalogued Song'
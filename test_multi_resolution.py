@@ -0,0 +1,82 @@
+"""Shazam.recognizeSongMultiResolution: the first confident answer wins, and what has not started is cancelled"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+import pytest
+
+from custom_shazam_api.api import Shazam
+
+sf = pytest.importorskip('soundfile')
+
+MATCH = {'matches': [{'id': '1'}], 'track': {'title': 'Song'}}
+NO_MATCH = {'matches': []}
+
+
+def wav_bytes(seconds):
+    samples = (np.random.default_rng(0).standard_normal(int(seconds * 16000)) * 3000).astype(np.int16)
+    with BytesIO() as wav_data:
+        sf.write(wav_data, samples, 16000, format='WAV', subtype='PCM_16')
+        return wav_data.getvalue()
+
+
+class StubShazam(Shazam):
+    """Answers each window after a delay chosen by its length in seconds, recording the lengths sent"""
+
+    def __init__(self, song_data, answers):
+        super().__init__(song_data)
+        self.answers = answers  # Length in seconds: (delay, response)
+        self.sent = []
+
+    def sendRecognizeRequest(self, sig):
+        seconds = round(sig.number_samples / 16000)
+        self.sent.append(seconds)
+        delay, response = self.answers[seconds]
+        time.sleep(delay)
+        return response
+
+
+def test_the_first_confident_answer_wins():
+    windows = ((0, 3), (0, 4), (0, 5), (0, 6))
+    shazam = StubShazam(wav_bytes(6), {3: (0.01, NO_MATCH), 4: (0.05, NO_MATCH), 5: (0.1, MATCH), 6: (2., MATCH)})
+
+    start = time.monotonic()
+    answers = list(shazam.recognizeSongMultiResolution(windows))
+    elapsed = time.monotonic() - start
+
+    assert answers == [(3., NO_MATCH), (4., NO_MATCH), (5., MATCH)]
+    assert shazam.lastSignature.number_samples == 5 * 16000
+    assert elapsed < 1.  # The 6 second window still in flight is not waited for
+    assert sorted(shazam.sent) == [3, 4, 5, 6]
+
+
+def test_windows_not_started_are_cancelled():
+    windows = ((0, 3), (0, 4), (0, 5), (0, 6))
+    shazam = StubShazam(wav_bytes(6), {3: (0., MATCH), 4: (0., MATCH), 5: (0., MATCH), 6: (0., MATCH)})
+    release = threading.Event()
+    submitted = []
+
+    class BlockingExecutor(ThreadPoolExecutor):
+        """One worker: the first signature is computed, the next one waits for `release`, the others queue up"""
+
+        def submit(self, fn, *args, **kwargs):
+            if submitted:
+                original = fn
+
+                def fn(*args, **kwargs):
+                    release.wait(5)
+                    return original(*args, **kwargs)
+
+            submitted.append(super().submit(fn, *args, **kwargs))
+            return submitted[-1]
+
+    with BlockingExecutor(max_workers=1) as executor:
+        answers = list(shazam.recognizeSongMultiResolution(windows, executor))
+        cancelled = [future.cancelled() for future in submitted]
+        release.set()
+
+    assert answers == [(3., MATCH)]
+    assert shazam.sent == [3]
+    assert cancelled == [False, False, True, True]  # The second signature had started: it runs to completion
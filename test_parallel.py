@@ -0,0 +1,52 @@
+"""Parallel signatures: chunks across processes give exactly the serial signature"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from custom_shazam_api.algorithm import SignatureGenerator
+from custom_shazam_api.parallel import WARMUP_FRAMES, generate_signature_parallel
+from custom_shazam_api.spectrogram import HOP, SpectrogramSession
+
+
+def song_samples(seconds):
+    rng = np.random.default_rng(2)
+    time = np.arange(int(seconds * 16000)) / 16000
+    tones = sum(np.sin(2 * np.pi * frequency * time) * (time % 1.3 < 0.6) for frequency in (523, 784, 1568, 3100))
+    return ((tones * 0.15 + rng.standard_normal(len(time)) * 0.05) * 32767).astype(np.int16)
+
+
+def serial_signature(samples):
+    session = SpectrogramSession()
+    session.feed(samples)
+    return session.signature(0, len(samples) // HOP * HOP)
+
+
+@pytest.mark.parametrize('seconds, chunk_seconds', [
+    (9, 2.),  # Several chunks, each warming up on the one before
+    (9 + 77 / 16000, 3.),  # A length that is not a whole number of hops
+    (1, 20.),  # A single chunk, computed in this process
+])
+def test_parallel_signature_is_the_serial_signature(seconds, chunk_seconds):
+    samples = song_samples(seconds)
+    with ThreadPoolExecutor(4) as executor:
+        parallel = generate_signature_parallel(samples, executor, chunk_seconds=chunk_seconds)
+    assert parallel.encode_to_binary() == serial_signature(samples).encode_to_binary()
+
+
+def test_chunks_shorter_than_the_warmup_are_widened():
+    samples = song_samples(3)
+    with ThreadPoolExecutor(4) as executor:
+        parallel = generate_signature_parallel(samples, executor, chunk_seconds=WARMUP_FRAMES * HOP / 16000 / 4)
+    assert parallel.encode_to_binary() == serial_signature(samples).encode_to_binary()
+
+
+def test_worker_processes_give_the_signature_of_a_fresh_generator():
+    samples = song_samples(6)
+    with ProcessPoolExecutor(2) as executor:
+        parallel = generate_signature_parallel(samples, executor, chunk_seconds=2.)
+
+    signature_generator = SignatureGenerator()
+    signature_generator.MAX_TIME_SECONDS = 60
+    signature_generator.feed_input(samples.tolist())
+    assert parallel.encode_to_binary() == signature_generator.get_next_signature().encode_to_binary()
@@ -0,0 +1,101 @@
+"""Pipeline: bounded stages, what they drop or coalesce, and how it is counted"""
+from concurrent.futures import Future
+
+import pytest
+
+from custom_shazam_api.pipeline import COALESCE, DROP_NEWEST, DROP_OLDEST, Pipeline, Stage, completed_future
+
+
+class Gate:
+    """A stage `run` whose items only finish when the test completes them"""
+
+    def __init__(self):
+        self.running = []  # (item, future)
+
+    def __call__(self, item):
+        future = Future()
+        self.running.append((item, future))
+        return future
+
+    def finish(self, position=0):
+        item, future = self.running.pop(position)
+        future.set_result(None)
+
+
+def single_stage(policy, **options):
+    gate = Gate()
+    drops = []
+    pipeline = Pipeline([Stage('work', gate, policy=policy, **options)], on_drop=lambda stage, item: drops.append(item))
+    return pipeline, gate, drops
+
+
+def test_drop_oldest_keeps_the_newest_items():
+    pipeline, gate, drops = single_stage(DROP_OLDEST, max_queued=2)
+    assert all(pipeline.put(item) for item in range(4))  # 0 runs, 1 and 2 wait, then 3 pushes 1 out
+    assert drops == [1]
+    metrics = pipeline.metrics()['work']
+    assert (metrics['received'], metrics['dropped'], metrics['queued'], metrics['in_flight']) == (4, 1, 2, 1)
+
+    gate.finish()
+    assert [item for item, future in gate.running] == [2]
+
+
+def test_drop_newest_refuses_the_new_item():
+    pipeline, gate, drops = single_stage(DROP_NEWEST, max_queued=1)
+    assert pipeline.put('a') and pipeline.put('b')
+    assert not pipeline.put('c')
+    assert drops == ['c']
+    assert pipeline.metrics()['work']['dropped'] == 1
+
+
+def test_coalesce_replaces_the_waiting_item_of_the_same_key():
+    pipeline, gate, drops = single_stage(COALESCE, max_queued=2, key=lambda item: item[0])
+    for item in (('mic', 1), ('mic', 2), ('line', 1), ('mic', 3)):
+        assert pipeline.put(item)
+    assert drops == [('mic', 2)]
+    metrics = pipeline.metrics()['work']
+    assert (metrics['coalesced'], metrics['dropped'], metrics['queued']) == (1, 0, 2)
+
+
+def test_one_item_per_key_in_flight():
+    pipeline, gate, drops = single_stage(DROP_OLDEST, max_queued=4, max_in_flight=2, key=lambda item: item[0])
+    for item in (('mic', 1), ('mic', 2), ('line', 1)):
+        pipeline.put(item)
+    assert [item for item, future in gate.running] == [('mic', 1), ('line', 1)]
+
+    gate.finish(0)
+    assert [item for item, future in gate.running] == [('line', 1), ('mic', 2)]
+
+
+def test_results_go_on_to_the_next_stage_and_failures_are_reported():
+    results, errors = [], []
+
+    def double(item):
+        if item < 0:
+            raise ValueError('negative')
+        return completed_future(item * 2)
+
+    pipeline = Pipeline([Stage('double', double), Stage('collect', lambda item: completed_future(results.append(item)))],
+                        on_error=lambda stage, item, error: errors.append((stage, item, str(error))))
+    pipeline.put(1)
+    pipeline.put(-1)
+    assert results == [2]
+    assert errors == [('double', -1, 'negative')]
+    metrics = pipeline.metrics()
+    assert (metrics['double']['completed'], metrics['double']['failed'], metrics['collect']['completed']) == (1, 1, 1)
+
+
+def test_close_forgets_queued_items_and_refuses_new_ones():
+    pipeline, gate, drops = single_stage(DROP_OLDEST, max_queued=2)
+    pipeline.put('running')
+    pipeline.put('queued')
+    pipeline.close()
+    assert not pipeline.put('late')
+    assert pipeline.busy()  # Still running
+    gate.finish()
+    assert not pipeline.busy() and not gate.running
+
+
+def test_coalesce_needs_a_key():
+    with pytest.raises(ValueError):
+        Stage('work', Gate(), policy=COALESCE)
@@ -0,0 +1,160 @@
+"""RequestGuard and CircuitBreaker: what is counted, and when the circuit opens, also across processes"""
+import os
+import time
+
+import pytest
+import requests
+
+from custom_shazam_api.pool import worker_context
+from custom_shazam_api.ratelimit import CLOSED, HALF_OPEN, OPEN, CircuitOpenError, RequestGuard
+
+
+def response(status_code):
+    resp = requests.Response()
+    resp.status_code = status_code
+    resp.url = 'http://shazam.invalid/discovery'
+    return resp
+
+
+def guard(**options):
+    options = dict(rate=1000., burst=1000., retry_base_delay=0., retry_max_delay=0., **options)
+    return RequestGuard(**options)
+
+
+def sender(*status_codes):
+    """A send() answering with these status codes in turn, counting its calls"""
+    answers = list(status_codes)
+    calls = []
+
+    def send():
+        calls.append(len(calls))
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return response(answer)
+
+    return send, calls
+
+
+def test_success_is_counted_once():
+    request_guard = guard()
+    send, calls = sender(200)
+    assert request_guard.call(send).status_code == 200
+    metrics = request_guard.metrics()
+    assert (metrics['requests'], metrics['successes'], metrics['retries'], metrics['failures']) == (1, 1, 0, 0)
+    assert metrics['circuit'] == CLOSED
+
+
+def test_retries_that_succeed_are_no_failure():
+    request_guard = guard(failure_threshold=2, max_retries=2)
+    send, calls = sender(503, 429, 200)
+    request_guard.call(send)
+    metrics = request_guard.metrics()
+    assert len(calls) == 3
+    assert (metrics['retries'], metrics['failures'], metrics['upstream_5xx'], metrics['upstream_429']) == (2, 0, 1, 1)
+    assert metrics['circuit'] == CLOSED
+
+
+def test_one_breaker_failure_per_call_once_retries_are_exhausted():
+    request_guard = guard(failure_threshold=2, max_retries=2)
+
+    send, calls = sender(503, 503, 503)
+    with pytest.raises(requests.HTTPError):
+        request_guard.call(send)
+    assert len(calls) == 3
+    assert request_guard.metrics()['failures'] == 1
+    assert request_guard.breaker.current_state == CLOSED  # 3 failed attempts, but 1 failed call
+
+    send, calls = sender(requests.ConnectionError(), requests.ConnectionError(), requests.ConnectionError())
+    with pytest.raises(requests.ConnectionError):
+        request_guard.call(send)
+    assert request_guard.metrics()['failures'] == 2
+    assert request_guard.breaker.current_state == OPEN
+
+    send, calls = sender(200)
+    with pytest.raises(CircuitOpenError):
+        request_guard.call(send)
+    assert not calls
+    assert request_guard.metrics()['rejected'] == 1
+
+
+def test_a_half_open_probe_keeps_its_retries():
+    request_guard = guard(failure_threshold=1, recovery_timeout=0., max_retries=2)
+    with request_guard.state.update() as state:
+        request_guard.breaker._get(state).update(state=OPEN, changed=0.)
+
+    send, calls = sender(503, 200)
+    request_guard.call(send)
+    assert len(calls) == 2
+    assert request_guard.metrics()['rejected'] == 0
+    assert request_guard.breaker.current_state == CLOSED
+
+
+def test_a_failed_half_open_probe_opens_the_circuit():
+    request_guard = guard(failure_threshold=5, recovery_timeout=60., max_retries=1)
+    with request_guard.state.update() as state:
+        request_guard.breaker._get(state).update(state=HALF_OPEN, changed=time.time())
+
+    send, calls = sender(500, 500)
+    with pytest.raises(requests.HTTPError):
+        request_guard.call(send)
+    assert len(calls) == 2
+    assert request_guard.breaker.current_state == OPEN
+
+
+def take_tokens(state_path, attempts, results):
+    """In another process: try to take tokens from a bucket of 5 shared through the state file"""
+    request_guard = RequestGuard(rate=0.001, burst=5., state_path=state_path)
+    results.put((os.getpid(), sum(request_guard.bucket.try_acquire() == 0. for _ in range(attempts))))
+
+
+def send_failing():
+    return response(503)
+
+
+def fail_twice(state_path, results):
+    """In another process: two calls failing with a 503, without retries"""
+    request_guard = RequestGuard(rate=1000., burst=1000., failure_threshold=4, max_retries=0, state_path=state_path)
+    for _ in range(2):
+        try:
+            request_guard.call(send_failing)
+        except requests.HTTPError:
+            pass
+    results.put(os.getpid())
+
+
+def run_processes(target, *args):
+    context = worker_context()
+    results = context.Queue()
+    processes = [context.Process(target=target, args=args + (results,)) for _ in range(2)]
+    for process in processes:
+        process.start()
+    outcomes = [results.get(timeout=60) for process in processes]
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+    return outcomes
+
+
+def test_processes_sharing_a_state_file_share_one_bucket(tmp_path):
+    state_path = str(tmp_path / 'guard.json')
+    outcomes = run_processes(take_tokens, state_path, 8)
+
+    assert len({pid for pid, granted in outcomes}) == 2 and os.getpid() not in dict(outcomes)
+    assert sum(granted for pid, granted in outcomes) == 5
+    assert RequestGuard(rate=0.001, burst=5., state_path=state_path).bucket.try_acquire() > 0
+
+
+def test_processes_sharing_a_state_file_share_one_breaker(tmp_path):
+    state_path = str(tmp_path / 'guard.json')
+    run_processes(fail_twice, state_path)
+
+    request_guard = RequestGuard(rate=1000., burst=1000., failure_threshold=4, state_path=state_path)
+    metrics = request_guard.metrics()
+    assert (metrics['requests'], metrics['failures'], metrics['upstream_5xx']) == (4, 4, 4)
+    assert metrics['circuit'] == OPEN  # 2 failures in each process, 4 in all
+
+    send, calls = sender(200)
+    with pytest.raises(CircuitOpenError):
+        request_guard.call(send)
+    assert not calls
@@ -0,0 +1,116 @@
+"""RequeryQueue: deduplicated, persistent retries with backoff, held back by live recognitions"""
+import threading
+import time
+
+import numpy as np
+
+from custom_shazam_api.ratelimit import CircuitOpenError
+from custom_shazam_api.requery import RequeryQueue, fingerprint_hash
+from custom_shazam_api.spectrogram import SpectrogramSession
+
+MATCH = {'matches': [{'id': '1'}], 'track': {'title': 'Song'}}
+
+
+def signature(seed):
+    samples = (np.random.default_rng(seed).standard_normal(3 * 16000) * 3000).astype(np.int16)
+    session = SpectrogramSession()
+    session.feed(samples)
+    return session.signature().encode_to_binary()
+
+
+def requery_queue(tmp_path, *answers, **options):
+    """A queue whose recognize() gives these answers in turn (exceptions are raised), recording matches"""
+    answers = list(answers)
+    matches = []
+
+    def recognize(decoded_signature):
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    queue = RequeryQueue(str(tmp_path / 'requery.json'), lambda entry, response: matches.append((entry, response)),
+                         recognize, **options)
+    return queue, matches
+
+
+def test_a_fingerprint_is_only_queued_once(tmp_path):
+    queue, matches = requery_queue(tmp_path)
+    first = signature(0)
+    same_peaks = b'\0' * 48 + first[48:]  # Another header, e.g. another recording time
+
+    assert queue.add(first, 'Mic')
+    assert not queue.add(same_peaks, 'Mic')
+    assert queue.add(signature(1), 'Mic')
+    assert len(queue) == 2
+
+
+def test_backoff_grows_until_max_attempts(tmp_path):
+    queue, matches = requery_queue(tmp_path, {}, {}, {'track': {}}, base_delay=60., max_attempts=3)
+    queue.add(signature(0))
+    entry = queue.due_entries(now=time.time() + 3600)[0]
+
+    delays = []
+    for attempts in (1, 2):
+        before = time.time()
+        queue._retry(entry)
+        assert entry.attempts == attempts
+        delays.append(entry.next_attempt - before)
+
+    assert 60 * 2 * 0.75 <= delays[0] <= 60 * 2 * 1.25 + 1
+    assert 60 * 4 * 0.75 <= delays[1] <= 60 * 4 * 1.25 + 1
+
+    queue._retry(entry)  # A track without matches is no confident match either
+    assert len(queue) == 0 and matches == []
+
+
+def test_a_match_is_handed_back_and_dequeued(tmp_path):
+    queue, matches = requery_queue(tmp_path, MATCH)
+    queue.add(signature(0), 'Mic', {'timestamp': '20260101_120000'})
+    queue._retry(queue.due_entries(now=time.time() + 3600)[0])
+
+    assert len(queue) == 0
+    [(entry, response)] = matches
+    assert response == MATCH and entry.context == {'timestamp': '20260101_120000'}
+
+
+def test_held_back_requests_are_no_attempt(tmp_path):
+    queue, matches = requery_queue(tmp_path, CircuitOpenError('open'), max_attempts=1)
+    queue.add(signature(0))
+    entry = queue.due_entries(now=time.time() + 3600)[0]
+
+    queue._retry(entry)
+
+    assert len(queue) == 1 and entry.attempts == 0 and entry.next_attempt > time.time()
+
+
+def test_entries_survive_a_restart(tmp_path):
+    queue, matches = requery_queue(tmp_path, {})
+    queue.add(signature(0), 'Mic', {'timestamp': '20260101_120000'})
+    queue.add(signature(1), 'Line in')
+    queue._retry(queue._entries[fingerprint_hash(signature(0))])
+
+    restarted, matches = requery_queue(tmp_path)
+
+    assert len(restarted) == 2
+    for fingerprint, entry in queue._entries.items():
+        loaded = restarted._entries[fingerprint]
+        assert loaded.to_json() == entry.to_json()
+    assert restarted._entries[fingerprint_hash(signature(0))].attempts == 1
+
+
+def test_retries_wait_while_live_recognitions_run(tmp_path):
+    busy = threading.Event()
+    busy.set()
+    retried = threading.Event()
+    queue = RequeryQueue(str(tmp_path / 'requery.json'), lambda entry, response: None,
+                         lambda decoded_signature: retried.set() or {}, busy.is_set,
+                         base_delay=0., max_requests_per_minute=6000., poll_interval=0.01)
+    queue.add(signature(0))
+    queue.start()
+    try:
+        assert not retried.wait(0.2)
+        busy.clear()
+        assert retried.wait(5)
+    finally:
+        queue.stop()
@@ -0,0 +1,206 @@
+"""Recognition service: single-flight request sharing, PCM uploads and the HTTP routes"""
+import asyncio
+import json
+import wave
+from concurrent.futures import Future
+from io import BytesIO
+
+import numpy as np
+import pytest
+
+from custom_shazam_api.api import Shazam
+from custom_shazam_api.pool import RecognitionPool
+from custom_shazam_api.ratelimit import OPEN, RequestGuard
+from custom_shazam_api.service import RecognitionService, ServiceError, SingleFlight, pcm_to_wav
+from custom_shazam_api.spectrogram import SpectrogramSession
+
+MATCH = {'matches': [{'id': '1'}], 'track': {'title': 'Song', 'subtitle': 'Artist'}}
+
+
+def test_concurrent_callers_share_one_call():
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'match'
+
+    async def main():
+        single_flight = SingleFlight()
+        outcomes = await asyncio.gather(*(single_flight.do('signature', work) for _ in range(3)))
+        return outcomes, len(single_flight)
+
+    outcomes, pending = asyncio.run(main())
+    assert len(calls) == 1
+    assert outcomes == [('match', False), ('match', True), ('match', True)]
+    assert pending == 0
+
+
+def test_other_keys_and_later_callers_run_again():
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0)
+        return len(calls)
+
+    async def main():
+        single_flight = SingleFlight()
+        first = await asyncio.gather(single_flight.do('a', work), single_flight.do('b', work))
+        later = await single_flight.do('a', work)
+        return first, later
+
+    first, later = asyncio.run(main())
+    assert [shared for result, shared in first] == [False, False]
+    assert later == (3, False)
+
+
+def test_a_failure_reaches_every_caller_and_frees_the_key():
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise RuntimeError('upstream down')
+
+    async def main():
+        single_flight = SingleFlight()
+        outcomes = await asyncio.gather(single_flight.do('k', fail), single_flight.do('k', fail), return_exceptions=True)
+        return outcomes, len(single_flight)
+
+    outcomes, pending = asyncio.run(main())
+    assert all(isinstance(outcome, RuntimeError) for outcome in outcomes)
+    assert pending == 0
+
+
+def test_a_caller_going_away_does_not_cancel_the_others():
+    async def work():
+        await asyncio.sleep(0.05)
+        return 'match'
+
+    async def main():
+        single_flight = SingleFlight()
+        leaving = asyncio.ensure_future(single_flight.do('k', work))
+        staying = asyncio.ensure_future(single_flight.do('k', work))
+        await asyncio.sleep(0.01)
+        leaving.cancel()
+        return await staying
+
+    assert asyncio.run(main()) == ('match', True)
+
+
+def test_pcm_to_wav():
+    wav_data = pcm_to_wav(b'\x01\x00\x02\x00' * 8, 16000, 2)
+    with wave.open(BytesIO(wav_data)) as wav_file:
+        assert (wav_file.getnchannels(), wav_file.getframerate(), wav_file.getnframes()) == (2, 16000, 8)
+
+    with pytest.raises(ServiceError) as error:
+        pcm_to_wav(b'\x01\x00\x02', 16000, 1)
+    assert error.value.status == 400
+
+
+def service(**options):
+    """A service on threads, whose upstream requests all answer MATCH without any network"""
+    recognition_service = RecognitionService(RecognitionPool(max_workers=1, use_processes=False), **options)
+    sent = []
+
+    def submit_request(result):
+        sent.append(result)
+        result.response = MATCH
+        future = Future()
+        future.set_result(result)
+        return future
+
+    recognition_service.pool.submit_request = submit_request
+    return recognition_service, sent
+
+
+def signature_request():
+    samples = (np.random.default_rng(0).standard_normal(4 * 16000) * 3000).astype(np.int16)
+    session = SpectrogramSession()
+    session.feed(samples)
+    return json.dumps({'signature_uri': session.signature().encode_to_uri()}).encode('utf-8')
+
+
+JSON = {'content-type': 'application/json'}
+
+
+@pytest.mark.parametrize('method, target, status', [
+    ('GET', '/nowhere', 404),
+    ('POST', '/recognize/more', 404),
+    ('GET', '/recognize', 405),
+])
+def test_unknown_routes_and_methods(method, target, status):
+    recognition_service, sent = service()
+    status_code, payload, headers = asyncio.run(recognition_service.handle_request(method, target, {}, b''))
+    assert status_code == status and 'error' in payload
+    assert headers == ({'Allow': 'POST'} if status == 405 else {})
+    assert recognition_service.status_counts == {status: 1} and sent == []
+
+
+def test_a_signature_is_recognized():
+    recognition_service, sent = service()
+    status, payload, headers = asyncio.run(recognition_service.handle_request('POST', '/recognize', JSON, signature_request()))
+    assert status == 200 and payload['matched'] and payload['response'] == MATCH
+    assert payload['shared'] is False and len(sent) == 1
+
+
+@pytest.mark.parametrize('body', [b'{"signature_uri": 5}', b'{"signature": {}}', b'[]', b'not json'])
+def test_malformed_signature_requests_are_a_400(body):
+    recognition_service, sent = service()
+    status, payload, headers = asyncio.run(recognition_service.handle_request('POST', '/recognize', JSON, body))
+    assert status == 400 and sent == []
+
+
+def test_recordings_over_max_pending_are_a_503():
+    recognition_service, sent = service(max_pending=1)
+    waiting = Future()  # The one signature worker never finishes
+    recognition_service.pool.submit_signature = lambda audio: waiting
+
+    async def main():
+        first = asyncio.ensure_future(recognition_service.handle_request('POST', '/recognize', {}, b'first recording'))
+        await asyncio.sleep(0.01)
+        second = await recognition_service.handle_request('POST', '/recognize', {}, b'second recording')
+        first.cancel()
+        return second
+
+    status, payload, headers = asyncio.run(main())
+    assert status == 503 and headers == {'Retry-After': '1'}
+    assert recognition_service.stats['overloaded'] == 1 and sent == []
+
+
+def test_audio_too_short_for_a_signature_is_a_422():
+    pytest.importorskip('soundfile')
+    recognition_service, sent = service()
+    silence = b'\x00\x00' * 100  # Less than the 128 samples of one spectrogram hop
+    status, payload, headers = asyncio.run(recognition_service.handle_request(
+        'POST', '/recognize?rate=16000&channels=1', {'content-type': 'audio/pcm'}, silence))
+    assert status == 422 and recognition_service.stats['too_short'] == 1 and sent == []
+    recognition_service.pool.shutdown()
+
+
+def test_health_follows_the_circuit(monkeypatch):
+    recognition_service, sent = service()
+    monkeypatch.setattr(Shazam, 'guard', None)
+    assert asyncio.run(recognition_service.handle_request('GET', '/health', {}, b''))[0] == 200
+
+    monkeypatch.setattr(Shazam, 'guard', RequestGuard(failure_threshold=1))
+    Shazam.guard.breaker.record_failure()
+    status, payload, headers = asyncio.run(recognition_service.handle_request('GET', '/health', {}, b''))
+    assert status == 503 and payload['circuit'] == OPEN
+
+
+def test_metrics(monkeypatch):
+    monkeypatch.setattr(Shazam, 'guard', None)
+    recognition_service, sent = service()
+    asyncio.run(recognition_service.handle_request('POST', '/recognize', JSON, signature_request()))
+    asyncio.run(recognition_service.handle_request('GET', '/nowhere', {}, b''))
+
+    status, metrics, headers = asyncio.run(recognition_service.handle_request('GET', '/metrics', {}, b''))
+
+    assert status == 200
+    assert (metrics['requests'], metrics['recognitions'], metrics['upstream_requests'], metrics['matched']) == (1, 1, 1, 1)
+    assert (metrics['in_flight'], metrics['pending_signatures'], metrics['workers']) == (0, 0, 1)
+    assert metrics['status'] == {'200': 1, '404': 1}
+    assert set(metrics['latency_ms']) == {'total', 'signature', 'request'}
+    assert metrics['latency_ms']['signature'] == {}  # No audio was uploaded
+    assert set(metrics['latency_ms']['total']) == {'p50', 'p90', 'p99', 'max'}
+    assert 'guard' not in metrics
+    json.dumps(metrics)
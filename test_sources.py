@@ -0,0 +1,162 @@
+"""Audio sources: capture format negotiation, conversion to the signature format and the file player"""
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from custom_shazam_api.sources import (FALLBACK_SAMPLE_RATES, FILE_PLAYER_NAME, SIGNATURE_SAMPLE_RATE, AudioSource,
+                                       FilePlayerSource, StopCapture, negotiate_capture_format, to_signature_format)
+
+
+class FakeSource(AudioSource):
+    """A source supporting only some (samplerate, dtype) formats, recording what was probed"""
+
+    def __init__(self, formats):
+        self.formats = set(formats)
+        self.probed = []
+
+    def enumerate_devices(self, reinitialize=False):
+        return []
+
+    def supports_input(self, device, samplerate, channels, dtype):
+        self.probed.append((samplerate, dtype))
+        return (samplerate, dtype) in self.formats
+
+    def open_stream(self, samplerate, channels, device, callback, finished_callback=None, dtype='float32'):
+        raise NotImplementedError
+
+
+def tone(samplerate, seconds=1., frequency=1000.):
+    return (np.sin(2 * np.pi * frequency * np.arange(int(seconds * samplerate)) / samplerate) * 0.5).astype(np.float32)
+
+
+@pytest.mark.parametrize('formats, expected', [
+    ({(16000, 'int16'), (48000, 'int16')}, (16000, 'int16')),
+    ({(16000, 'float32'), (48000, 'int16')}, (16000, 'float32')),  # The rate matters more than the sample type
+    ({(48000, 'float32'), (44100, 'int16')}, (44100, 'int16')),  # Then the lowest rate
+    ({(96000, 'float32')}, (96000, 'float32')),
+])
+def test_the_lowest_supported_rate_is_chosen(formats, expected):
+    source = FakeSource(formats)
+    capture_format = negotiate_capture_format(source, 0, 1)
+    assert (capture_format.samplerate, capture_format.dtype) == expected
+    assert capture_format.native == (expected == (16000, 'int16'))
+    assert source.probed[-1] == expected and len(set(source.probed)) == len(source.probed)
+
+
+def test_formats_are_probed_in_order_then_the_default_rate_is_used():
+    source = FakeSource([])
+    capture_format = negotiate_capture_format(source, 0, 2, default_samplerate=44100.)
+
+    assert source.probed == [(samplerate, dtype) for samplerate in (SIGNATURE_SAMPLE_RATE,) + FALLBACK_SAMPLE_RATES
+                             for dtype in ('int16', 'float32')]
+    assert (capture_format.samplerate, capture_format.dtype) == (44100, 'float32')
+
+
+def test_16_khz_int16_is_already_in_the_signature_format():
+    samples = (tone(16000) * 32767).astype(np.int16)
+    assert to_signature_format(samples, 16000) is samples
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'int16'])
+def test_48_khz_is_decimated_by_averaging(dtype):
+    samples = tone(48000)
+    if dtype == 'int16':
+        samples = (samples * 32767).astype(np.int16)
+
+    converted = to_signature_format(samples, 48000)
+
+    assert converted.dtype == np.int16 and len(converted) == 16000
+    expected = tone(48000).reshape(-1, 3).mean(axis=1) * 32767
+    assert np.abs(converted - expected).max() <= 2
+
+
+def test_stereo_float_is_mixed_down():
+    mono = tone(32000)
+    converted = to_signature_format(np.stack([mono, mono * 0.5], axis=1), 32000)
+    assert converted.shape == (16000,)
+    assert np.abs(converted - mono.reshape(-1, 2).mean(axis=1) * 0.75 * 32767).max() <= 1
+
+
+def test_22050_hz_is_resampled_linearly():
+    converted = to_signature_format(tone(22050, seconds=2.), 22050)
+
+    assert converted.dtype == np.int16 and len(converted) == 32000
+    spectrum = np.abs(np.fft.rfft(converted / 32767))
+    assert np.argmax(spectrum) * SIGNATURE_SAMPLE_RATE / len(converted) == pytest.approx(1000, abs=1)
+    assert np.abs(converted).max() == pytest.approx(0.5 * 32767, rel=0.02)
+
+
+@pytest.fixture
+def ramp_path(tmp_path):
+    """One second of 16 KHz audio whose every sample tells where it is in the file"""
+    sf = pytest.importorskip('soundfile')
+    path = str(tmp_path / 'ramp.wav')
+    sf.write(path, np.arange(16000, dtype=np.float32) / 16000, 16000, subtype='FLOAT')
+    return path
+
+
+def capture(player, blocks, dtype='float32', channels=2):
+    """Stream from the file player until `blocks` blocks came in, then raise StopCapture"""
+    received = []
+    finished = []
+    done = threading.Event()
+
+    def callback(indata, frames, time_info, status):
+        received.append(indata.copy())
+        if len(received) == blocks:
+            raise StopCapture()
+
+    def finished_callback():
+        finished.append(len(received))
+        done.set()
+
+    with player.open_stream(16000, channels, 0, callback, finished_callback, dtype):
+        assert done.wait(5)
+    return received, finished
+
+
+def test_stop_capture_ends_the_stream_once(ramp_path):
+    player = FilePlayerSource([ramp_path], realtime=False, blocksize=1000)
+    received, finished = capture(player, 3)
+
+    assert finished == [3]  # Called once, after the last block, and nothing came in after StopCapture
+    assert [block.shape for block in received] == [(1000, 2)] * 3
+    assert all(block.dtype == np.float32 for block in received)
+    assert np.array_equal(received[0][:, 0], received[0][:, 1])
+
+
+def test_leaving_the_with_block_ends_the_stream_once(ramp_path):
+    player = FilePlayerSource([ramp_path], realtime=True, blocksize=160)
+    finished = []
+    with player.open_stream(16000, 1, 0, lambda *args: None, lambda: finished.append(1)):
+        time.sleep(0.05)
+    assert finished == [1]
+
+
+def test_fast_mode_resumes_where_the_last_stream_stopped(ramp_path):
+    player = FilePlayerSource([ramp_path], realtime=False, blocksize=3000)
+    first, finished = capture(player, 2, channels=1)
+    second, finished = capture(player, 4, channels=1)  # Loops past the end of the file
+
+    samples = np.concatenate(first + second)[:, 0]
+    assert np.array_equal(samples, (np.arange(18000, dtype=np.float32) % 16000) / 16000)
+
+
+def test_int16_streams(ramp_path):
+    player = FilePlayerSource([ramp_path], realtime=False, blocksize=1000)
+    received, finished = capture(player, 2, dtype='int16')
+
+    assert all(block.dtype == np.int16 and block.shape == (1000, 2) for block in received)
+    assert np.abs(received[1][:, 0] - np.arange(1000, 2000) / 16000 * 32767).max() <= 1
+
+
+def test_the_file_player_is_one_virtual_device(ramp_path):
+    player = FilePlayerSource([ramp_path], channels=2)
+    [device] = player.enumerate_devices()
+    assert (device['name'], device['index'], device['max_input_channels']) == (FILE_PLAYER_NAME, 0, 2)
+    with pytest.raises(ValueError):
+        player.open_stream(16000, 3, 0, lambda *args: None)
+    with pytest.raises(ValueError):
+        player.open_stream(16000, 1, 1, lambda *args: None)